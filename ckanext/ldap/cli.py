@@ -1,5 +1,19 @@
+import json
+
 import click
 from ckan.plugins import toolkit
+from flask import current_app
+
+from ckanext.ldap.lib import credentials, fake_ldap, groups
+from ckanext.ldap.lib.loadtest import run_load_test
+from ckanext.ldap.lib.search import find_ldap_user, flush_lookup_cache
+from ckanext.ldap.lib.sync import (
+    GROUP_FILTER,
+    describe_membership_changes,
+    sync_directory,
+    sync_group_memberships,
+    sync_replication,
+)
 
 
 def get_commands():
@@ -38,3 +52,347 @@ def setup_org():
             context, {'id': organization_id, 'name': organization_id}
         )
         click.secho('New organisation created', fg='green')
+
+
+@ldap.command(name='flush-cache')
+def flush_cache():
+    """
+    Empties the cache of LDAP directory lookups in every CKAN process.
+    """
+    flush_lookup_cache()
+    click.secho(
+        'LDAP lookup cache flushed, running processes will drop their cached lookups '
+        'within a few seconds',
+        fg='green',
+    )
+
+
+@ldap.command(name='purge-credentials')
+@click.argument('user')
+def purge_credentials(user):
+    """
+    Removes a user's verified password from the credential cache, so that their next
+    login is checked by the LDAP server.
+
+    USER is a login name or a DN.
+    """
+    if '=' in user:
+        dn = user
+    else:
+        ldap_user_dict = find_ldap_user(user)
+        if ldap_user_dict is None:
+            raise click.ClickException(f'No LDAP user found for {user}')
+        dn = ldap_user_dict['cn']
+    if credentials.forget(dn):
+        click.secho(f'Purged the cached credentials of {dn}', fg='green')
+    else:
+        click.secho(f'No cached credentials for {dn}', fg='yellow')
+    if toolkit.config['ckanext.ldap.store'] == 'memory':
+        click.secho(
+            'The memory store is private to each CKAN process, so this has no effect '
+            'on running processes. Use the redis store to be able to purge them.',
+            fg='yellow',
+        )
+
+
+@ldap.command(name='sync')
+@click.option(
+    '--filter',
+    'filter_str',
+    help='LDAP filter matching the users to sync. Defaults to '
+    'ckanext.ldap.search.filter with the login replaced by *.',
+)
+@click.option(
+    '--page-size',
+    default=500,
+    show_default=True,
+    help='Number of entries to request from the LDAP server at a time.',
+)
+@click.option(
+    '--batch-size',
+    default=500,
+    show_default=True,
+    help='Number of users to write to the database per transaction.',
+)
+@click.option(
+    '--workers',
+    default=1,
+    show_default=True,
+    help='Number of threads writing batches of users to the database.',
+)
+@click.option(
+    '--incremental',
+    is_flag=True,
+    help='Only fetch the entries modified since the last sync (using modifyTimestamp).',
+)
+@click.option(
+    '--syncrepl',
+    is_flag=True,
+    help='Use RFC 4533 content synchronisation to fetch the entries changed since the '
+    'last --syncrepl run.',
+)
+@click.option(
+    '--persist',
+    is_flag=True,
+    help='With --syncrepl, keep running and apply changes as they are made.',
+)
+def sync(filter_str, page_size, batch_size, workers, incremental, syncrepl, persist):
+    """
+    Creates or updates a CKAN user for every user in the LDAP directory.
+    """
+    if persist and not syncrepl:
+        raise click.UsageError('--persist can only be used with --syncrepl')
+    if syncrepl:
+        stats = sync_replication(
+            filter_str=filter_str,
+            persist=persist,
+            batch_size=batch_size,
+            workers=workers,
+        )
+    else:
+        stats = sync_directory(
+            filter_str=filter_str,
+            page_size=page_size,
+            batch_size=batch_size,
+            workers=workers,
+            incremental=incremental,
+        )
+    for outcome in ['created', 'updated', 'migrated', 'unchanged', 'deleted']:
+        click.secho(f'{outcome}: {stats[outcome]}', fg='green')
+    for outcome in ['conflicts', 'skipped', 'errors']:
+        click.secho(
+            f'{outcome}: {stats[outcome]}', fg='red' if stats[outcome] else 'green'
+        )
+
+
+@ldap.command(name='sync-groups')
+@click.option(
+    '--filter',
+    'filter_str',
+    default=GROUP_FILTER,
+    help='LDAP filter matching the groups. Defaults to groupOfNames, '
+    'groupOfUniqueNames and group entries.',
+)
+@click.option(
+    '--member-attribute',
+    default='member',
+    show_default=True,
+    help="The attribute holding the DNs of a group's members.",
+)
+@click.option(
+    '--page-size',
+    default=500,
+    show_default=True,
+    help='Number of entries to request from the LDAP server at a time.',
+)
+@click.option(
+    '--batch-size',
+    default=500,
+    show_default=True,
+    help='Number of changes to write to the database per transaction.',
+)
+@click.option(
+    '--dry-run', is_flag=True, help='List the changes that would be made and exit.'
+)
+def sync_groups(filter_str, member_attribute, page_size, batch_size, dry_run):
+    """
+    Sets the organization memberships (and sysadmin status) of every LDAP user from
+    their LDAP groups, using ckanext.ldap.groups.mapping.
+    """
+    if not groups.enabled():
+        raise click.ClickException('ckanext.ldap.groups.mapping is not set')
+    stats, changes = sync_group_memberships(
+        filter_str=filter_str,
+        member_attribute=member_attribute,
+        page_size=page_size,
+        batch_size=batch_size,
+        dry_run=dry_run,
+    )
+    if dry_run:
+        for line in describe_membership_changes(changes):
+            click.echo(line)
+    verb = 'would be ' if dry_run else ''
+    click.secho(f'groups: {stats["groups"]}', fg='green')
+    for outcome in [
+        'added',
+        'changed',
+        'removed',
+        'sysadmin_granted',
+        'sysadmin_revoked',
+    ]:
+        click.secho(f'{verb}{outcome}: {stats[outcome]}', fg='green')
+    # members which couldn't be matched to a CKAN user, e.g. users who have never
+    # logged in, or haven't since their DN was recorded
+    for outcome in ['unknown_members', 'unlocated_users']:
+        click.secho(
+            f'{outcome}: {stats[outcome]}', fg='yellow' if stats[outcome] else 'green'
+        )
+    for outcome in ['missing_groups', 'missing_organizations', 'errors']:
+        click.secho(
+            f'{outcome}: {stats[outcome]}', fg='red' if stats[outcome] else 'green'
+        )
+
+
+@ldap.command(name='loadtest')
+@click.option('--users', default=1000, show_default=True, help='Number of LDAP users.')
+@click.option(
+    '--logins', default=2000, show_default=True, help='Number of logins to make.'
+)
+@click.option(
+    '--rate',
+    default=50.0,
+    show_default=True,
+    help='Target logins per second, 0 for as fast as possible.',
+)
+@click.option(
+    '--threads', default=8, show_default=True, help='Number of concurrent logins.'
+)
+@click.option(
+    '--collision-rate',
+    default=0.1,
+    show_default=True,
+    help="Fraction of users whose CKAN user name collides with another user's.",
+)
+@click.option(
+    '--alt-only-rate',
+    default=0.05,
+    show_default=True,
+    help='Fraction of users only found by the alternative search filter.',
+)
+@click.option(
+    '--failure-rate',
+    default=0.05,
+    show_default=True,
+    help='Fraction of logins using the wrong password.',
+)
+@click.option(
+    '--latency',
+    default=0.0,
+    show_default=True,
+    help='Milliseconds each LDAP operation takes.',
+)
+@click.option('--seed', type=int, help='Seed for the generated directory and logins.')
+@click.option(
+    '--prefix',
+    help='The start of every generated user\'s id. Defaults to "loadtest" and a random '
+    'suffix, so that every run creates new users.',
+)
+@click.option(
+    '--output',
+    type=click.Path(dir_okay=False, writable=True),
+    help='Write the report to this file as JSON.',
+)
+@click.option(
+    '--write-ldif',
+    type=click.File('w'),
+    help='Write the generated directory to this LDIF file (e.g. to load it into a real '
+    'server) and exit.',
+)
+@click.option(
+    '--keep-users',
+    is_flag=True,
+    help="Don't delete the users created by the test afterwards.",
+)
+@click.option('--yes', is_flag=True, help="Don't ask for confirmation.")
+@click.pass_context
+def loadtest(
+    ctx,
+    users,
+    logins,
+    rate,
+    threads,
+    collision_rate,
+    alt_only_rate,
+    failure_rate,
+    latency,
+    seed,
+    prefix,
+    output,
+    write_ldif,
+    keep_users,
+    yes,
+):
+    """
+    Logs in generated users through the LDAP login handler at a target rate and reports
+    the throughput, latency and DB queries and LDAP operations per login.
+
+    An in-process fake LDAP server is used, so no LDAP server is needed, but users are
+    created in the CKAN database. They are deleted afterwards with user_delete (unless
+    --keep-users is given). The test refuses to run if any of the users it would create
+    already exist.
+    """
+    if write_ldif is not None:
+        fake_ldap.write_ldif(
+            fake_ldap.generate_users(
+                users,
+                collision_rate=collision_rate,
+                alt_only_rate=alt_only_rate,
+                seed=seed,
+                prefix=prefix or 'loadtest',
+            ),
+            write_ldif,
+        )
+        click.secho(f'Wrote {users} users', fg='green')
+        return
+
+    if not yes:
+        click.confirm(
+            f'This will create up to {users} users in the CKAN database, continue?',
+            abort=True,
+        )
+    # the ckan command puts the flask app in the context's meta
+    app = ctx.meta.get('flask_app') or current_app._get_current_object()
+    try:
+        report = run_load_test(
+            app,
+            users=users,
+            logins=logins,
+            rate=rate,
+            threads=threads,
+            collision_rate=collision_rate,
+            alt_only_rate=alt_only_rate,
+            failure_rate=failure_rate,
+            latency=latency / 1000,
+            seed=seed,
+            prefix=prefix,
+            cleanup=not keep_users,
+        )
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+    click.secho(
+        f'{report["logins"]} logins in {report["duration"]:.1f}s, '
+        f'{report["throughput"]:.1f} logins/s',
+        fg='green',
+    )
+    for kind, kind_report in report['by_kind'].items():
+        kind_latency = kind_report['latency']
+        click.echo(
+            f'{kind:<14} n={kind_latency["count"]:<6} '
+            f'p50={kind_latency["p50"]:.1f}ms p90={kind_latency["p90"]:.1f}ms '
+            f'p99={kind_latency["p99"]:.1f}ms '
+            f'queries/login={kind_report["db_queries_per_login"]:.1f}'
+        )
+    click.echo(f'DB queries per login: {report["db_queries_per_login"]:.1f}')
+    ldap_operations = ', '.join(
+        f'{operation}={count:.2f}'
+        for operation, count in report['ldap_operations_per_login'].items()
+    )
+    click.echo(f'LDAP operations per login: {ldap_operations}')
+    problems = report['unexpected'] + report['errors']
+    click.secho(
+        f'unexpected outcomes: {report["unexpected"]}, errors: {report["errors"]}',
+        fg='red' if problems else 'green',
+    )
+    created = report['users']
+    if created['removed']:
+        click.echo(f'Deleted the {created["removed"]} users created by the test')
+    elif created['created']:
+        prefix = report['parameters']['prefix']
+        click.echo(
+            f'Kept the {created["created"]} users created by the test ({prefix})'
+        )
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+        click.secho(f'Report written to {output}', fg='green')
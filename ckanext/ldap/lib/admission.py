@@ -0,0 +1,210 @@
+# !/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-ldap
+# Created by the Natural History Museum in London, UK
+
+import logging
+import math
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from ckan.plugins import toolkit
+
+from ckanext.ldap.lib import metrics
+from ckanext.ldap.lib.exceptions import OverloadedError, StoreError
+from ckanext.ldap.lib.store import get_store
+
+log = logging.getLogger(__name__)
+
+# the name of the slots in the store
+SLOTS = 'admission'
+
+
+class AdmissionController:
+    """
+    Limits the number of requests talking to the LDAP server at once, so that when the
+    server is slow only the requests which need it are stuck waiting, rather than every
+    worker.
+
+    Requests take a slot from the store (so with the redis store the limit applies
+    across every CKAN process). When there isn't a free slot, up to queue_size requests
+    in each process wait for up to timeout seconds for one. Any others are refused
+    straight away.
+    """
+
+    def __init__(
+        self, store, limit, queue_size=10, timeout=2, lease=60, poll_interval=0.05
+    ):
+        """
+        :param store: the store holding the slots
+        :param limit: the number of requests that can talk to the LDAP server at once
+        :param queue_size: the number of requests in this process that can wait for a
+            slot (Default value = 10)
+        :param timeout: seconds a request waits for a slot (Default value = 2)
+        :param lease: seconds after which a slot that hasn't been given back (e.g.
+            because the process holding it died) is freed (Default value = 60)
+        :param poll_interval: seconds between attempts to take a slot whilst waiting
+            (Default value = 0.05)
+        """
+        self.store = store
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.waiting = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _record(self, in_use):
+        metrics.set_saturation(in_use / self.limit)
+
+    def _try_acquire(self, token):
+        try:
+            taken, in_use = self.store.acquire(SLOTS, token, self.limit, self.lease)
+        except StoreError as e:
+            # better to risk overloading the server than to refuse every login
+            log.warning(f'Admitting request without a slot: {e}')
+            metrics.count_error('store_error')
+            return True
+        self._record(in_use)
+        return taken
+
+    def _refuse(self, reason):
+        metrics.count_rejection(reason)
+        raise OverloadedError(reason, max(1, math.ceil(self.timeout)))
+
+    def acquire(self, token):
+        """
+        Take a slot, waiting for one if needed.
+
+        :param token: a unique token identifying the request
+        :raises OverloadedError: if the wait queue is full or no slot became free in
+            time
+        """
+        if self._try_acquire(token):
+            return
+        with self._lock:
+            if self.waiting >= self.queue_size:
+                queue_full = True
+            else:
+                queue_full = False
+                self.waiting += 1
+        if queue_full:
+            self._refuse('queue_full')
+        try:
+            deadline = time.monotonic() + self.timeout
+            while time.monotonic() < deadline:
+                time.sleep(min(self.poll_interval, deadline - time.monotonic()))
+                if self._try_acquire(token):
+                    return
+        finally:
+            with self._lock:
+                self.waiting -= 1
+        self._refuse('timeout')
+
+    def release(self, token):
+        """
+        Give back a slot taken using acquire.
+
+        :param token: the token used to take the slot
+        """
+        try:
+            self._record(self.store.release(SLOTS, token))
+        except StoreError as e:
+            log.warning(f'Could not give back slot, it will expire: {e}')
+
+    @contextmanager
+    def admitted(self):
+        """
+        Context manager which holds a slot whilst active. It is reentrant: if the
+        current thread already holds a slot, no other slot is taken.
+
+        :raises OverloadedError: if the request can't be admitted
+        """
+        if getattr(self._local, 'token', None) is not None:
+            yield
+            return
+        token = uuid.uuid4().hex
+        self.acquire(token)
+        self._local.token = token
+        try:
+            yield
+        finally:
+            self._local.token = None
+            self.release(token)
+
+    def report_saturation(self):
+        """
+        Update the saturation gauge with the number of slots currently in use.
+        """
+        try:
+            self._record(self.store.count(SLOTS))
+        except StoreError as e:
+            log.debug(f'Could not count slots: {e}')
+
+
+class _Unlimited:
+    """
+    Stands in for an AdmissionController when admission control is disabled.
+    """
+
+    @contextmanager
+    def admitted(self):
+        yield
+
+    def report_saturation(self):
+        pass
+
+
+_admission = None
+_admission_lock = threading.Lock()
+
+
+def get_admission():
+    """
+    Get the process wide admission controller, creating it from the config if needed.
+
+    :returns: an AdmissionController, or a stand in which admits everything if
+        ckanext.ldap.admission.limit is 0
+    """
+    global _admission
+    with _admission_lock:
+        if _admission is None:
+            limit = toolkit.config['ckanext.ldap.admission.limit']
+            if limit <= 0:
+                _admission = _Unlimited()
+            else:
+                _admission = AdmissionController(
+                    get_store(),
+                    limit,
+                    queue_size=toolkit.config['ckanext.ldap.admission.queue_size'],
+                    timeout=toolkit.config['ckanext.ldap.admission.timeout'],
+                    lease=toolkit.config['ckanext.ldap.admission.lease'],
+                )
+        return _admission
+
+
+def reset_admission():
+    """
+    Drop the process wide admission controller so that it is recreated (with the current
+    config) on next use.
+    """
+    global _admission
+    with _admission_lock:
+        _admission = None
+
+
+@contextmanager
+def admitted():
+    """
+    Context manager which holds a slot from the process wide admission controller whilst
+    active.
+
+    :raises OverloadedError: if the request can't be admitted
+    """
+    with get_admission().admitted():
+        yield
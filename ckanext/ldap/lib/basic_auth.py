@@ -0,0 +1,187 @@
+# !/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-ldap
+# Created by the Natural History Museum in London, UK
+
+import hashlib
+import hmac
+import logging
+import os
+import threading
+
+from ckan.plugins import toolkit
+
+from ckanext.ldap.lib import identity, metrics
+from ckanext.ldap.lib.admission import admitted
+from ckanext.ldap.lib.cache import MISSING, TTLCache
+from ckanext.ldap.lib.exceptions import (
+    MultipleMatchError,
+    OverloadedError,
+    UserConflictError,
+)
+from ckanext.ldap.lib.search import authenticate_ldap_user
+from ckanext.ldap.lib.throttle import check_login_attempt
+from ckanext.ldap.routes import _helpers
+
+log = logging.getLogger(__name__)
+
+# the cache keys are keyed hashes of the credentials, so that the cache never holds a
+# password, and the key is only ever in this process' memory
+_secret = os.urandom(32)
+# cached for credentials whose login isn't an LDAP user, which are left to CKAN
+_UNKNOWN = object()
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def enabled():
+    """
+    Check whether HTTP Basic authentication against LDAP is enabled.
+
+    :returns: True if ckanext.ldap.basic_auth.enabled is set
+    """
+    return toolkit.config['ckanext.ldap.basic_auth.enabled']
+
+
+def get_cache():
+    """
+    Get the process wide cache of checked Basic credentials, creating it from the config
+    if needed. Accepted credentials map to the CKAN user name, rejected ones to None and
+    ones whose login isn't an LDAP user to _UNKNOWN.
+
+    :returns: a TTLCache
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = TTLCache(
+                toolkit.config['ckanext.ldap.cache.size'],
+                toolkit.config['ckanext.ldap.basic_auth.cache_ttl'],
+                toolkit.config['ckanext.ldap.basic_auth.negative_ttl'],
+            )
+        return _cache
+
+
+def reset_cache():
+    """
+    Drop the process wide cache of checked Basic credentials so that it is recreated
+    (with the current config) on next use.
+    """
+    global _cache
+    with _cache_lock:
+        _cache = None
+
+
+def _cache_key(login, password):
+    message = f'{login.strip().lower()}\0{password}'.encode('utf-8')
+    return hmac.new(_secret, message, hashlib.sha256).hexdigest()
+
+
+def get_credentials():
+    """
+    Get the login and password from the current request's Authorization header, if it
+    uses the Basic scheme.
+
+    :returns: a 2-tuple of the login and password, or None if there aren't any
+    """
+    authorization = toolkit.request.authorization
+    if authorization is None or (authorization.type or '').lower() != 'basic':
+        return None
+    if not authorization.username or authorization.password is None:
+        return None
+    return authorization.username, authorization.password
+
+
+def identify_request():
+    """
+    Identify the user making the current request from its Basic credentials.
+
+    The credentials are checked with authenticate_ldap_user, so the search runs on a
+    pooled connection (as does the bind, if ckanext.ldap.login.same_connection is set)
+    and recently verified passwords are accepted from the credential cache. The outcome
+    is cached for ckanext.ldap.basic_auth.cache_ttl seconds
+    (ckanext.ldap.basic_auth.negative_ttl if they were rejected). An API client sending
+    the same credentials with every request therefore costs the LDAP server one search
+    and bind per cache period, not one per request. Attempts which aren't in the cache
+    are throttled like logins through the login form.
+
+    Credentials whose login isn't found in LDAP are left alone (so that e.g. a proxy in
+    front of CKAN can use Basic authentication itself), and the request carries on as if
+    they weren't there. Only a known LDAP user with the wrong password gets a 401.
+
+    :returns: a 2-tuple of the CKAN user name (or None) and the response to send instead
+        of handling the request (or None)
+    """
+    credentials = get_credentials()
+    if credentials is None:
+        return None, None
+    login, password = credentials
+
+    cache = get_cache()
+    key = _cache_key(login, password)
+    user_name = cache.get(key)
+    if user_name is not MISSING:
+        if user_name is _UNKNOWN:
+            metrics.count_basic_auth('cached_unknown')
+            return None, None
+        if user_name is None:
+            metrics.count_basic_auth('cached_failure')
+            return None, _helpers.basic_auth_failed()
+        metrics.count_basic_auth('cached')
+        return user_name, None
+
+    throttled = check_login_attempt(toolkit.request.remote_addr, login)
+    if throttled:
+        limit, wait = throttled
+        metrics.count_basic_auth(f'throttled_{limit}')
+        return None, _helpers.login_throttled(wait)
+    try:
+        with admitted():
+            ldap_user_dict, authenticated = authenticate_ldap_user(
+                login, password, known=_helpers.get_known_location(login)
+            )
+    except MultipleMatchError as e:
+        log.warning(f'Basic authentication failed for {login}: {e}')
+        metrics.count_basic_auth('multiple_match')
+        return None, _helpers.basic_auth_failed()
+    except OverloadedError as e:
+        metrics.count_basic_auth('overloaded')
+        return None, _helpers.login_overloaded(e.retry_after)
+
+    if ldap_user_dict is None:
+        # remembered briefly (the server may have been down) so that a client sending
+        # these credentials with every request isn't throttled
+        cache.set(key, _UNKNOWN, ttl=cache.negative_ttl)
+        metrics.count_basic_auth('unknown')
+        return None, None
+    if not authenticated:
+        # the user exists so the password was rejected, which is worth remembering (a
+        # client with a stale password tends to keep retrying it)
+        cache.set(key, None)
+        metrics.count_basic_auth('failure')
+        return None, _helpers.basic_auth_failed()
+
+    try:
+        user_name = _helpers.get_or_create_ldap_user(ldap_user_dict)
+    except UserConflictError as e:
+        log.warning(f'Basic authentication failed for {login}: {e}')
+        metrics.count_basic_auth('user_conflict')
+        return None, _helpers.basic_auth_failed()
+    cache.set(key, user_name)
+    metrics.count_basic_auth('success')
+    return user_name, None
+
+
+def log_in(user_name):
+    """
+    Make the given user the current user for the rest of the request. Nothing is written
+    to the session, as the client sends its credentials with every request.
+
+    :param user_name: the CKAN user name
+    """
+    toolkit.c.user = user_name
+    # CKAN 2.10+ identifies the user with flask-login
+    if toolkit.check_ckan_version(min_version='2.10.0'):
+        identity.log_in_request(user_name)
@@ -0,0 +1,279 @@
+# !/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-ldap
+# Created by the Natural History Museum in London, UK
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from ckan.lib.redis import connect_to_redis
+from ckan.plugins import toolkit
+from flask import g, has_request_context
+from redis.exceptions import RedisError
+
+log = logging.getLogger(__name__)
+
+# returned by TTLCache.get when there is no (unexpired) entry for the key
+MISSING = object()
+
+
+class TTLCache:
+    """
+    A thread-safe, size bounded, least recently used cache whose entries expire.
+
+    Entries with a value of None are treated as negative entries (i.e. "we looked and
+    there is nothing there") and are kept for negative_ttl seconds rather than ttl.
+    """
+
+    def __init__(self, max_size, ttl, negative_ttl=None):
+        """
+        :param max_size: the maximum number of entries to hold
+        :param ttl: seconds to keep entries for
+        :param negative_ttl: seconds to keep None entries for (Default value = ttl)
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        """
+        :returns: the number of entries held, including any which have expired but
+            haven't been evicted yet
+        """
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Get the value stored for the given key.
+
+        :param key: the key
+        :returns: the value, or MISSING if there is no unexpired value for the key
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return MISSING
+
+    def set(self, key, value, ttl=None):
+        """
+        Store a value for the given key, evicting the least recently used entries if the
+        cache is full.
+
+        :param key: the key
+        :param value: the value
+        :param ttl: seconds to keep the value for (Default value = ttl or negative_ttl,
+            depending on the value)
+        """
+        if self.max_size <= 0:
+            return
+        if ttl is None:
+            ttl = self.negative_ttl if value is None else self.ttl
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        """
+        Remove the entry for the given key, if there is one.
+
+        :param key: the key
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def invalidate(self, predicate):
+        """
+        Remove all the entries for which predicate(key, value) is true.
+
+        :param predicate: a callable taking a key and a value
+        :returns: the number of entries removed
+        """
+        with self._lock:
+            keys = [
+                key
+                for key, (_, value) in self._entries.items()
+                if predicate(key, value)
+            ]
+            for key in keys:
+                del self._entries[key]
+        return len(keys)
+
+    def clear(self):
+        """
+        Remove all the entries and reset the hit/miss counters.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        :returns: a dictionary containing the size, hits and misses of the cache
+        """
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key: the first caller (the leader) does the
+    work, and callers arriving whilst it is in progress wait for it and receive the
+    same result, or have the same exception raised. Once the call has finished the next
+    caller for the key starts a new one, so nothing is cached.
+    """
+
+    def __init__(self, on_coalesce=None):
+        """
+        :param on_coalesce: callable which is called (with no arguments) whenever a
+            caller waits for a call in progress rather than doing the work (Default
+            value = None)
+        """
+        self.coalesced = 0
+        self._on_coalesce = on_coalesce
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, function):
+        """
+        Call the given function, unless a call for the same key is already in progress
+        in which case wait for that one instead.
+
+        :param key: the key identifying the work
+        :param function: a callable taking no arguments
+        :returns: the return value of function
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.coalesced += 1
+        if not leader:
+            if self._on_coalesce is not None:
+                self._on_coalesce()
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = function()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+def redis_key(*parts):
+    """
+    Create a redis key for this extension, namespaced by the site id so that several
+    CKAN instances can share a redis database.
+
+    :param parts: the parts of the key
+    :returns: the key as a string
+    """
+    return ':'.join(['ckanext-ldap', toolkit.config.get('ckan.site_id', ''), *parts])
+
+
+class SharedGeneration:
+    """
+    A counter stored in redis which is used to tell every CKAN process that it should
+    flush a local cache.
+
+    Processes only check the counter every interval seconds so this costs at most one
+    redis round trip per interval.
+    """
+
+    def __init__(self, name, interval=5):
+        """
+        :param name: the name of the counter
+        :param interval: seconds between checks of the counter (Default value = 5)
+        """
+        self.name = name
+        self.interval = interval
+        self._seen = None
+        self._checked = None
+
+    def changed(self):
+        """
+        Check whether the counter has been bumped since it was last checked.
+
+        :returns: True if the counter has changed, False if it hasn't or if it wasn't
+            checked because the last check was less than interval seconds ago
+        """
+        now = time.monotonic()
+        first_check = self._checked is None
+        if not first_check and now - self._checked < self.interval:
+            return False
+        self._checked = now
+        try:
+            current = connect_to_redis().get(redis_key(self.name))
+        except RedisError as e:
+            log.debug(f'Could not check {self.name} in redis: {e}')
+            return False
+        changed = not first_check and current != self._seen
+        self._seen = current
+        return changed
+
+    def bump(self):
+        """
+        Increment the counter, causing every process to see a change on its next check.
+        """
+        connect_to_redis().incr(redis_key(self.name))
+
+
+def request_cache(name):
+    """
+    Get a dictionary which lives for the duration of the current request. Outside of a
+    request a new, empty dictionary is returned every time, so nothing is cached.
+
+    :param name: the name of the cache
+    :returns: a dictionary
+    """
+    if not has_request_context():
+        return {}
+    caches = g.setdefault('_ckanext_ldap_caches', {})
+    return caches.setdefault(name, {})
+
+
+def clear_request_cache(*names):
+    """
+    Empty the given request caches.
+
+    :param names: the names of the caches
+    """
+    if has_request_context():
+        caches = g.get('_ckanext_ldap_caches', {})
+        for name in names:
+            caches.pop(name, None)
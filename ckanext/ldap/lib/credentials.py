@@ -0,0 +1,136 @@
+# !/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-ldap
+# Created by the Natural History Museum in London, UK
+
+import hashlib
+import hmac
+import logging
+import os
+
+from ckan.plugins import toolkit
+
+from ckanext.ldap.lib import metrics
+from ckanext.ldap.lib.exceptions import StoreError
+from ckanext.ldap.lib.store import get_store
+
+log = logging.getLogger(__name__)
+
+# scrypt parameters: 16MiB of memory and tens of milliseconds of CPU per hash, so that
+# stolen verifiers are expensive to attack
+SCRYPT_N = 2**14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_LENGTH = 16
+
+
+def hash_password(password, salt=None, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P):
+    """
+    Create a verifier for the given password using scrypt.
+
+    :param password: the password
+    :param salt: the salt (Default value = 16 random bytes)
+    :param n: the scrypt CPU/memory cost (Default value = SCRYPT_N)
+    :param r: the scrypt block size (Default value = SCRYPT_R)
+    :param p: the scrypt parallelisation (Default value = SCRYPT_P)
+    :returns: a string containing the parameters, salt and hash
+    """
+    if salt is None:
+        salt = os.urandom(SALT_LENGTH)
+    digest = hashlib.scrypt(
+        password.encode('utf-8'), salt=salt, n=n, r=r, p=p, dklen=32
+    )
+    return f'scrypt${n}${r}${p}${salt.hex()}${digest.hex()}'
+
+
+def check_password(password, verifier):
+    """
+    Check the given password against a verifier created by hash_password.
+
+    :param password: the password
+    :param verifier: the verifier
+    :returns: True if the password matches, False if not
+    """
+    try:
+        algorithm, n, r, p, salt, digest = verifier.split('$')
+        if algorithm != 'scrypt':
+            return False
+        expected = hash_password(
+            password, salt=bytes.fromhex(salt), n=int(n), r=int(r), p=int(p)
+        )
+    except ValueError:
+        return False
+    return hmac.compare_digest(expected.rsplit('$', 1)[1], digest)
+
+
+def enabled():
+    """
+    Check whether the verified credential cache is enabled.
+
+    :returns: True if ckanext.ldap.credential_cache.ttl is greater than 0
+    """
+    return toolkit.config['ckanext.ldap.credential_cache.ttl'] > 0
+
+
+def _key(dn):
+    return f'credentials:{dn.strip().lower()}'
+
+
+def verify(dn, password):
+    """
+    Check whether the given password was verified against the LDAP server for the given
+    DN within the last ckanext.ldap.credential_cache.ttl seconds.
+
+    :param dn: the DN of the user
+    :param password: the password
+    :returns: True if it was, False if not (or if the cache is disabled)
+    """
+    if not enabled() or not password:
+        return False
+    try:
+        verifier = get_store().get(_key(dn))
+    except StoreError as e:
+        log.warning(f'Could not check the credential cache: {e}')
+        metrics.count_error('store_error')
+        return False
+    if verifier is None:
+        metrics.count_credential_cache('miss')
+        return False
+    if not check_password(password, verifier):
+        # e.g. the user has changed their password, so check it with the server
+        metrics.count_credential_cache('mismatch')
+        return False
+    metrics.count_credential_cache('hit')
+    return True
+
+
+def remember(dn, password):
+    """
+    Store a verifier for a password which the LDAP server has accepted for the given DN.
+
+    :param dn: the DN of the user
+    :param password: the password
+    """
+    if not enabled() or not password:
+        return
+    try:
+        get_store().set(
+            _key(dn),
+            hash_password(password),
+            toolkit.config['ckanext.ldap.credential_cache.ttl'],
+        )
+    except StoreError as e:
+        log.warning(f'Could not update the credential cache: {e}')
+        metrics.count_error('store_error')
+
+
+def forget(dn):
+    """
+    Remove the verifier stored for the given DN, so that their next login is checked by
+    the LDAP server.
+
+    :param dn: the DN of the user
+    :returns: True if there was a verifier, False if not
+    """
+    return get_store().delete(_key(dn))
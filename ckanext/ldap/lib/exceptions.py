@@ -4,10 +4,64 @@
 # This file is part of ckanext-ldap
 # Created by the Natural History Museum in London, UK
 
+import ldap
+
 
 class MultipleMatchError(Exception):
+    """
+    Raised when a login matches more than one entry in the directory.
+    """
+
     pass
 
 
 class UserConflictError(Exception):
+    """
+    Raised when an LDAP user's name is taken by a CKAN user who isn't an LDAP user and
+    ckanext.ldap.migrate is off.
+    """
+
+    pass
+
+
+class PoolTimeoutError(Exception):
+    """
+    Raised when no pooled LDAP connection becomes free within
+    ckanext.ldap.pool.checkout_timeout seconds.
+    """
+
     pass
+
+
+class NoServerAvailableError(ldap.SERVER_DOWN):
+    """
+    Raised without contacting any server when every LDAP server is known to be down.
+
+    This is a SERVER_DOWN so that it is handled like any other unreachable server.
+    """
+
+    pass
+
+
+class StoreError(Exception):
+    """
+    Raised when the redis store (see ckanext.ldap.store) can't be reached.
+    """
+
+    pass
+
+
+class OverloadedError(Exception):
+    """
+    Raised when a request can't be admitted because too many requests are already
+    talking to the LDAP server.
+    """
+
+    def __init__(self, reason, retry_after):
+        """
+        :param reason: why the request was refused ('queue_full' or 'timeout')
+        :param retry_after: seconds after which the request is worth retrying
+        """
+        super().__init__(f'Too many requests are waiting for LDAP ({reason})')
+        self.reason = reason
+        self.retry_after = retry_after
@@ -0,0 +1,592 @@
+# !/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-ldap
+# Created by the Natural History Museum in London, UK
+"""
+An in-process stand-in for an LDAP server, for benchmarks and load tests.
+
+It supports the operations this extension uses (simple binds, searches with the paged
+results control and WhoAmI) and the filters it needs (and, or, not, equality, presence,
+substrings and ordering), with optional injected latency per operation. It is not a
+complete or standards compliant server.
+"""
+
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+import ldap
+import ldap.dn
+from ldap.controls import SimplePagedResultsControl
+
+BASE_DN = 'ou=people,dc=example,dc=com'
+SERVICE_DN = 'cn=service,dc=example,dc=com'
+SERVICE_PASSWORD = 'service'
+
+# the config needed to use a directory created by generate_users
+CONFIG = {
+    'ckanext.ldap.uri': 'ldap://fake',
+    # searches and binds go to the same (fake) server
+    'ckanext.ldap.search.uri': '',
+    'ckanext.ldap.bind.uri': '',
+    'ckanext.ldap.base_dn': BASE_DN,
+    'ckanext.ldap.search.filter': '(&(objectClass=person)(uid={login}))',
+    'ckanext.ldap.search.alt': '(mail={login})',
+    'ckanext.ldap.search.alt_msg': 'Please use your unique id',
+    'ckanext.ldap.username': 'uid',
+    'ckanext.ldap.email': 'mail',
+    'ckanext.ldap.fullname': 'cn',
+    'ckanext.ldap.auth.dn': SERVICE_DN,
+    'ckanext.ldap.auth.password': SERVICE_PASSWORD,
+}
+
+
+class FakeDirectory:
+    """
+    A set of LDAP entries and the passwords of the accounts that can bind.
+
+    Every operation on a connection to the directory is counted (see counts) and sleeps
+    for latency seconds first.
+    """
+
+    def __init__(self, latency=0.0):
+        """
+        :param latency: seconds each operation takes (Default value = 0)
+        """
+        self.latency = latency
+        self._entries = {}
+        self._passwords = {SERVICE_DN.lower(): SERVICE_PASSWORD}
+        # (attribute name, value) -> entry keys, so that searches for a user don't have
+        # to scan every entry
+        self._index = defaultdict(set)
+        self._lock = threading.Lock()
+        self._counts = Counter()
+
+    def __len__(self):
+        """
+        :returns: the number of entries in the directory
+        """
+        return len(self._entries)
+
+    def add_entry(self, dn, attributes, password=None):
+        """
+        Add an entry to the directory.
+
+        :param dn: the DN of the entry
+        :param attributes: a dictionary of attribute names to lists of values (str or
+            bytes)
+        :param password: the password the entry can bind with (Default value = the first
+            userPassword value, if there is one)
+        """
+        attributes = {
+            name: [v if isinstance(v, bytes) else str(v).encode() for v in values]
+            for name, values in attributes.items()
+        }
+        if password is None:
+            password = next(
+                (
+                    values[0].decode()
+                    for name, values in attributes.items()
+                    if name.lower() == 'userpassword' and values
+                ),
+                None,
+            )
+        key = dn.lower()
+        with self._lock:
+            self._entries[key] = (dn, attributes)
+            for name, values in attributes.items():
+                for value in values:
+                    self._index[(name.lower(), value.decode().lower())].add(key)
+            if password is not None:
+                self._passwords[dn.lower()] = password
+
+    def load_ldif(self, ldif_file):
+        """
+        Add the entries in an LDIF file to the directory.
+
+        :param ldif_file: a file object
+        :returns: the number of entries added
+        """
+        # imported here as only this method needs it
+        from ldif import LDIFRecordList
+
+        parser = LDIFRecordList(ldif_file)
+        parser.parse()
+        for dn, attributes in parser.all_records:
+            self.add_entry(dn, attributes)
+        return len(parser.all_records)
+
+    @property
+    def counts(self):
+        """
+        A copy of the number of times each operation has been performed.
+        """
+        with self._lock:
+            return Counter(self._counts)
+
+    def reset_counts(self):
+        """
+        Reset the operation counts to zero.
+        """
+        with self._lock:
+            self._counts.clear()
+
+    def initialize(self, uri, **kwargs):
+        """
+        Drop in replacement for ldap.initialize which connects to this directory.
+
+        :param uri: ignored
+        :returns: a FakeLDAPObject
+        """
+        self._operation('connect')
+        return FakeLDAPObject(self)
+
+    @contextmanager
+    def installed(self):
+        """
+        Context manager which makes every new LDAP connection in this process connect to
+        this directory rather than a real server.
+        """
+        original = ldap.initialize
+        ldap.initialize = self.initialize
+        try:
+            yield self
+        finally:
+            ldap.initialize = original
+
+    def _operation(self, name):
+        with self._lock:
+            self._counts[name] += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def _check_password(self, dn, password):
+        with self._lock:
+            expected = self._passwords.get(dn.lower())
+        return expected is not None and expected == password
+
+    def _search(self, base, scope, filter_str, attributes):
+        base = base.lower()
+        parsed = parse_filter(filter_str)
+        with self._lock:
+            keys = parsed.candidates(self._index)
+            if keys is None:
+                entries = list(self._entries.items())
+            else:
+                entries = [(key, self._entries[key]) for key in sorted(keys)]
+        results = []
+        for key, (dn, entry_attributes) in entries:
+            if scope == ldap.SCOPE_BASE:
+                in_scope = key == base
+            elif scope == ldap.SCOPE_ONELEVEL:
+                in_scope = (
+                    key.endswith(',' + base) and key.count(',') == base.count(',') + 1
+                )
+            else:
+                in_scope = key == base or key.endswith(',' + base)
+            if in_scope and parsed.matches(entry_attributes):
+                results.append((dn, _select(entry_attributes, attributes)))
+        return results
+
+
+def _select(entry_attributes, attributes):
+    if not attributes or '*' in attributes:
+        return {name: list(values) for name, values in entry_attributes.items()}
+    wanted = {name.lower(): name for name in attributes}
+    return {
+        wanted[name.lower()]: list(values)
+        for name, values in entry_attributes.items()
+        if name.lower() in wanted
+    }
+
+
+class FakeLDAPObject:
+    """
+    A connection to a FakeDirectory, implementing the parts of
+    ldap.ldapobject.LDAPObject used by this extension.
+    """
+
+    def __init__(self, directory):
+        """
+        :param directory: the FakeDirectory to connect to
+        """
+        self.directory = directory
+        self.bound_as = ''
+        self._options = {}
+        self._results = {}
+        self._next_msgid = 1
+
+    def set_option(self, option, value):
+        """
+        Set an option, which is only remembered.
+
+        :param option: the ldap.OPT_* option
+        :param value: the value
+        """
+        self._options[option] = value
+
+    def get_option(self, option):
+        """
+        Get an option set with set_option.
+
+        :param option: the ldap.OPT_* option
+        :returns: the value, or None if it hasn't been set
+        """
+        return self._options.get(option)
+
+    def simple_bind_s(self, who='', cred='', serverctrls=None, clientctrls=None):
+        """
+        Bind as the given DN, or anonymously if who is empty.
+
+        :param who: the DN to bind as (Default value = '')
+        :param cred: the password (Default value = '')
+        :param serverctrls: ignored (Default value = None)
+        :param clientctrls: ignored (Default value = None)
+        :raises ldap.INVALID_CREDENTIALS: if the password is wrong
+        """
+        self.directory._operation('bind')
+        if who and not self.directory._check_password(who, cred):
+            self.bound_as = ''
+            raise ldap.INVALID_CREDENTIALS({'desc': 'Invalid credentials'})
+        self.bound_as = who
+
+    def bind_s(self, who, cred, method=None):
+        """
+        Bind as the given DN (see simple_bind_s).
+
+        :param who: the DN to bind as
+        :param cred: the password
+        :param method: ignored (Default value = None)
+        """
+        return self.simple_bind_s(who, cred)
+
+    def sasl_interactive_bind_s(self, who, auth, *args, **kwargs):
+        """
+        Bind as the service account, whatever the SASL credentials.
+
+        :param who: ignored
+        :param auth: ignored
+        """
+        self.directory._operation('bind')
+        self.bound_as = SERVICE_DN
+
+    def whoami_s(self, *args, **kwargs):
+        """
+        Get the identity the connection is bound as.
+
+        :returns: "dn:<DN>", or an empty string if the connection is anonymous
+        """
+        self.directory._operation('whoami')
+        return f'dn:{self.bound_as}' if self.bound_as else ''
+
+    def search_s(
+        self, base, scope, filterstr='(objectClass=*)', attrlist=None, attrsonly=0
+    ):
+        """
+        Search the directory.
+
+        :param base: the DN to search under
+        :param scope: the ldap.SCOPE_* scope
+        :param filterstr: the filter (Default value = '(objectClass=*)')
+        :param attrlist: the attributes to return (Default value = all of them)
+        :param attrsonly: ignored (Default value = 0)
+        :returns: a list of (dn, attributes) tuples
+        """
+        self.directory._operation('search')
+        return self.directory._search(base, scope, filterstr, attrlist)
+
+    def search_ext(
+        self,
+        base,
+        scope,
+        filterstr='(objectClass=*)',
+        attrlist=None,
+        attrsonly=0,
+        serverctrls=None,
+        clientctrls=None,
+        timeout=-1,
+        sizelimit=0,
+    ):
+        """
+        Start a search (see search_s), honouring the paged results control. The results
+        are fetched with result3.
+
+        :param serverctrls: the controls, of which only SimplePagedResultsControl is
+            used (Default value = None)
+        :returns: the message id
+        """
+        self.directory._operation('search')
+        results = self.directory._search(base, scope, filterstr, attrlist)
+        controls = []
+        for control in serverctrls or []:
+            if control.controlType == SimplePagedResultsControl.controlType:
+                start = int(control.cookie or 0)
+                end = start + control.size
+                cookie = str(end).encode() if end < len(results) else b''
+                results = results[start:end]
+                controls.append(SimplePagedResultsControl(False, control.size, cookie))
+        msgid = self._next_msgid
+        self._next_msgid += 1
+        self._results[msgid] = (results, controls)
+        return msgid
+
+    def result3(self, msgid=ldap.RES_ANY, all=1, timeout=None):
+        """
+        Get the results of a search started with search_ext.
+
+        :param msgid: the message id returned by search_ext
+        :param all: ignored (Default value = 1)
+        :param timeout: ignored (Default value = None)
+        :returns: a 4-tuple of the result type, the results, the message id and the
+            response controls
+        """
+        results, controls = self._results.pop(msgid)
+        return ldap.RES_SEARCH_RESULT, results, msgid, controls
+
+    def unbind_s(self):
+        """
+        Close the connection.
+        """
+        self.directory._operation('unbind')
+
+    unbind = unbind_s
+
+
+_TOKEN = re.compile(r'\(|\)|[^()]+')
+_ITEM = re.compile(r'^([^=<>~]+)(=|>=|<=|~=)(.*)$', re.DOTALL)
+
+
+class _Filter:
+    """
+    A parsed LDAP filter.
+    """
+
+    def __init__(self, operator, children=None, name=None, test=None, value=None):
+        self.operator = operator
+        self.children = children or []
+        self.name = name
+        self.test = test
+        # the value for equality items, which can be looked up in the index
+        self.value = value
+
+    def matches(self, attributes):
+        """
+        :param attributes: an entry's attributes
+        :returns: whether the entry matches the filter
+        """
+        if self.operator == '&':
+            return all(child.matches(attributes) for child in self.children)
+        if self.operator == '|':
+            return any(child.matches(attributes) for child in self.children)
+        if self.operator == '!':
+            return not self.children[0].matches(attributes)
+        for attribute, values in attributes.items():
+            if attribute.lower() == self.name:
+                return any(self.test(v.decode().lower()) for v in values)
+        return False
+
+    def candidates(self, index):
+        """
+        Narrow down the entries that could match using the equality index.
+
+        :param index: a dictionary of (attribute name, value) to sets of entry keys
+        :returns: a set of entry keys, or None if every entry could match
+        """
+        if self.operator == '&':
+            found = [child.candidates(index) for child in self.children]
+            found = sorted((keys for keys in found if keys is not None), key=len)
+            return found[0].intersection(*found[1:]) if found else None
+        if self.operator == '|':
+            found = [child.candidates(index) for child in self.children]
+            if any(keys is None for keys in found):
+                return None
+            return set().union(*found)
+        if self.value is not None:
+            return index.get((self.name, self.value), set())
+        return None
+
+
+def parse_filter(filter_str):
+    """
+    Parse an LDAP filter.
+
+    :param filter_str: the filter, e.g. (&(objectClass=person)(uid=bob))
+    :returns: a _Filter
+    """
+    filter_str = filter_str.strip()
+    if not filter_str.startswith('('):
+        filter_str = f'({filter_str})'
+    tokens = _TOKEN.findall(filter_str)
+    try:
+        parsed, position = _parse(tokens, 0)
+    except IndexError:
+        position = None
+    if position != len(tokens):
+        raise ldap.FILTER_ERROR({'desc': f'Bad search filter: {filter_str}'})
+    return parsed
+
+
+def _parse(tokens, position):
+    if tokens[position] != '(':
+        raise ldap.FILTER_ERROR({'desc': 'Bad search filter'})
+    position += 1
+    token = tokens[position]
+    if token in ('&', '|', '!'):
+        children = []
+        position += 1
+        while tokens[position] == '(':
+            child, position = _parse(tokens, position)
+            children.append(child)
+        parsed = _Filter(token, children=children)
+    else:
+        parsed = _item(token)
+        position += 1
+    if tokens[position] != ')':
+        raise ldap.FILTER_ERROR({'desc': 'Bad search filter'})
+    return parsed, position + 1
+
+
+def _unescape(value):
+    return re.sub(r'\\([0-9a-fA-F]{2})', lambda m: chr(int(m.group(1), 16)), value)
+
+
+def _item(token):
+    match = _ITEM.match(token)
+    if match is None:
+        raise ldap.FILTER_ERROR({'desc': f'Bad search filter item: {token}'})
+    name, operator, value = match.groups()
+    name = name.strip().lower()
+
+    if operator == '=' and value == '*':
+        return _Filter('present', name=name, test=lambda v: True)
+    if operator == '=' and '*' in value:
+        parts = (re.escape(_unescape(part).lower()) for part in value.split('*'))
+        regex = re.compile(f'^{".*".join(parts)}$', re.DOTALL)
+        return _Filter(
+            'substring', name=name, test=lambda v: regex.match(v) is not None
+        )
+    value = _unescape(value).lower()
+    if operator == '>=':
+        return _Filter(operator, name=name, test=lambda v: v >= value)
+    if operator == '<=':
+        return _Filter(operator, name=name, test=lambda v: v <= value)
+    return _Filter('=', name=name, test=lambda v: v == value, value=value)
+
+
+def generate_users(
+    count,
+    collision_rate=0.1,
+    alt_only_rate=0.05,
+    password='password',
+    seed=None,
+    prefix='user',
+):
+    """
+    Generate a synthetic set of users.
+
+    Some users are given LDAP ids which only differ in characters that are not allowed
+    in CKAN user names, so that they collide when they are mapped to CKAN names (e.g.
+    "smith.3" and "smith+3"). Some users are "alt-only" users, which are only found by
+    the alternative search filter in CONFIG: they aren't people and log in with their
+    email address.
+
+    :param count: the number of users
+    :param collision_rate: the fraction of users whose CKAN name collides with another
+        user's (Default value = 0.1)
+    :param alt_only_rate: the fraction of users that only the alternative search filter
+        finds (Default value = 0.05)
+    :param password: the password of every user (Default value = 'password')
+    :param seed: seed for the random choices, for repeatable directories (Default value
+        = None)
+    :param prefix: the start of every user's id (Default value = 'user')
+    :returns: a list of dictionaries defining 'dn', 'uid', 'mail', 'cn', 'password',
+        'alt_only' and 'login' (what the user types in the login form)
+    """
+    rng = random.Random(seed)
+    users = []
+    # these all map to "_" in CKAN names
+    separators = ['.', '+', ' ', '@', '=']
+    variants = Counter()
+    for i in range(count):
+        if users and rng.random() < collision_rate:
+            # a variant of an earlier user's id, whose CKAN name is the same as the
+            # CKAN names of up to 4 other variants (e.g. user3.0, user3+0 -> user3_0)
+            base = users[rng.randrange(len(users))]['uid']
+            n = variants[base]
+            variants[base] += 1
+            uid = f'{base}{separators[n % len(separators)]}{n // len(separators)}'
+        else:
+            uid = f'{prefix}{i}'
+        alt_only = rng.random() < alt_only_rate
+        mail = f'{prefix}{i}@example.com'
+        users.append(
+            {
+                'dn': f'uid={ldap.dn.escape_dn_chars(uid)},{BASE_DN}',
+                'uid': uid,
+                'mail': mail,
+                'cn': f'User {i}',
+                'password': password,
+                'alt_only': alt_only,
+                'login': mail if alt_only else uid,
+            }
+        )
+    return users
+
+
+def user_entry(user):
+    """
+    Create the LDAP attributes for a user created by generate_users.
+
+    :param user: the user dictionary
+    :returns: a dictionary of attribute names to lists of values
+    """
+    return {
+        'objectClass': ['account'] if user['alt_only'] else ['person', 'inetOrgPerson'],
+        'uid': [user['uid']],
+        'mail': [user['mail']],
+        'cn': [user['cn']],
+        'userPassword': [user['password']],
+    }
+
+
+def write_ldif(users, output):
+    """
+    Write the given users as LDIF, e.g. to load them into a real server.
+
+    :param users: the dictionaries returned by generate_users
+    :param output: a file object
+    """
+    # imported here as only this function needs it
+    from ldif import LDIFWriter
+
+    writer = LDIFWriter(output)
+    for user in users:
+        writer.unparse(
+            user['dn'],
+            {
+                name: [v.encode() for v in values]
+                for name, values in user_entry(user).items()
+            },
+        )
+
+
+def make_directory(users, latency=0.0):
+    """
+    Create a FakeDirectory containing the given users.
+
+    :param users: the dictionaries returned by generate_users
+    :param latency: seconds each operation takes (Default value = 0)
+    :returns: a FakeDirectory
+    """
+    directory = FakeDirectory(latency=latency)
+    for user in users:
+        attributes = user_entry(user)
+        # operational, so it isn't part of user_entry (and the LDIF)
+        attributes['entryUUID'] = [str(uuid.uuid5(uuid.NAMESPACE_URL, user['dn']))]
+        directory.add_entry(user['dn'], attributes, password=user['password'])
+    return directory
@@ -0,0 +1,317 @@
+# !/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-ldap
+# Created by the Natural History Museum in London, UK
+
+import functools
+import json
+import logging
+import threading
+
+from ckan.model import Group, Member, Session
+from ckan.plugins import toolkit
+from sqlalchemy import or_
+
+from ckanext.ldap.lib.cache import MISSING, TTLCache
+from ckanext.ldap.lib.search import find_ldap_groups, normalise_dn
+
+log = logging.getLogger(__name__)
+
+# the target which makes the members of a group sysadmins
+SYSADMIN = 'sysadmin'
+# the organization roles, from least to most privileged
+CAPACITIES = ('member', 'editor', 'admin')
+
+_memberships = None
+_memberships_lock = threading.Lock()
+
+
+def enabled():
+    """
+    Check whether organization memberships are set from the user's directory groups.
+
+    :returns: True if ckanext.ldap.groups.mapping is set
+    """
+    return bool(toolkit.config.get('ckanext.ldap.groups.mapping'))
+
+
+def parse_mapping(value):
+    """
+    Parse a group mapping. The mapping is a JSON object whose keys are group DNs and
+    whose values are a target, or a list of targets, for the members of the group. A
+    target is either "<organization>:<role>" or "sysadmin".
+
+    :param value: the JSON string
+    :raises ValueError: if the mapping is invalid
+    :returns: a dictionary of normalised group DNs to lists of targets, each either
+        SYSADMIN or a 2-tuple of the organization (name or id) and the role
+    """
+    try:
+        raw = json.loads(value)
+    except ValueError as e:
+        raise ValueError(f'not valid JSON ({e})')
+    if not isinstance(raw, dict):
+        raise ValueError('must be a JSON object of group DNs to targets')
+    mapping = {}
+    for group_dn, targets in raw.items():
+        if isinstance(targets, str):
+            targets = [targets]
+        if not isinstance(targets, list):
+            raise ValueError(f'the targets of {group_dn} must be a string or a list')
+        parsed = []
+        for target in targets:
+            if target == SYSADMIN:
+                parsed.append(SYSADMIN)
+                continue
+            organization, _, capacity = str(target).rpartition(':')
+            if not organization or capacity not in CAPACITIES:
+                raise ValueError(
+                    f'{target} is not "sysadmin" or "<organization>:<role>" where the '
+                    f'role is one of {", ".join(CAPACITIES)}'
+                )
+            parsed.append((organization, capacity))
+        mapping.setdefault(normalise_dn(group_dn), []).extend(parsed)
+    return mapping
+
+
+@functools.lru_cache(maxsize=8)
+def _parse_cached(value):
+    return parse_mapping(value)
+
+
+def get_mapping():
+    """
+    Get the parsed ckanext.ldap.groups.mapping (see parse_mapping).
+
+    :returns: a dictionary of normalised group DNs to lists of targets
+    """
+    value = toolkit.config.get('ckanext.ldap.groups.mapping')
+    return _parse_cached(value) if value else {}
+
+
+def mapped_organizations(mapping=None):
+    """
+    Get the organizations the mapping can add users to. Memberships of any other
+    organization are left alone.
+
+    :param mapping: the parsed mapping (Default value = get_mapping())
+    :returns: a set of organization names (or ids)
+    """
+    mapping = get_mapping() if mapping is None else mapping
+    return {
+        target[0]
+        for targets in mapping.values()
+        for target in targets
+        if target != SYSADMIN
+    }
+
+
+def manages_sysadmin(mapping=None):
+    """
+    Check whether the mapping decides who is a sysadmin, i.e. whether any group maps to
+    "sysadmin".
+
+    :param mapping: the parsed mapping (Default value = get_mapping())
+    :returns: True or False
+    """
+    mapping = get_mapping() if mapping is None else mapping
+    return any(SYSADMIN in targets for targets in mapping.values())
+
+
+def revokes_sysadmin(mapping=None):
+    """
+    Check whether LDAP users who aren't members of a group mapped to "sysadmin" should
+    stop being sysadmins. This needs ckanext.ldap.groups.manage_sysadmin as well as a
+    group mapped to "sysadmin", so that sysadmin status given by hand isn't removed
+    unless asked for.
+
+    :param mapping: the parsed mapping (Default value = get_mapping())
+    :returns: True or False
+    """
+    return toolkit.config['ckanext.ldap.groups.manage_sysadmin'] and manages_sysadmin(
+        mapping
+    )
+
+
+def resolve_roles(group_dns, mapping=None):
+    """
+    Work out the roles the members of the given groups should have. If several groups
+    give a role in the same organization, the most privileged one wins.
+
+    :param group_dns: the normalised DNs of the groups
+    :param mapping: the parsed mapping (Default value = get_mapping())
+    :returns: a 2-tuple of a dictionary of organization (as named in the mapping) to
+        role, and whether they should be a sysadmin
+    """
+    mapping = get_mapping() if mapping is None else mapping
+    roles = {}
+    sysadmin = False
+    for group_dn in group_dns:
+        for target in mapping.get(group_dn, []):
+            if target == SYSADMIN:
+                sysadmin = True
+                continue
+            organization, capacity = target
+            roles[organization] = highest(capacity, roles.get(organization))
+    return roles, sysadmin
+
+
+def highest(*capacities):
+    """
+    Get the most privileged of the given roles.
+
+    :param capacities: roles, any of which can be None
+    :returns: the role, or None if they are all None
+    """
+    capacities = [capacity for capacity in capacities if capacity is not None]
+    return max(capacities, key=CAPACITIES.index) if capacities else None
+
+
+def diff_memberships(current, desired, keep=()):
+    """
+    Compare the current memberships with the desired ones.
+
+    :param current: a dictionary of keys (e.g. organization ids) to current roles
+    :param desired: a dictionary of the same keys to the roles they should have
+    :param keep: keys which are never removed, even if they aren't desired (Default
+        value = ())
+    :returns: a 2-tuple of a dictionary of the keys whose role needs setting to the
+        role, and a set of the keys which need removing
+    """
+    to_set = {
+        key: capacity
+        for key, capacity in desired.items()
+        if current.get(key) != capacity
+    }
+    to_remove = {key for key in current if key not in desired and key not in keep}
+    return to_set, to_remove
+
+
+def get_membership_cache():
+    """
+    Get the process wide cache of the groups each user is a member of, creating it from
+    the config if needed.
+
+    :returns: a TTLCache
+    """
+    global _memberships
+    with _memberships_lock:
+        if _memberships is None:
+            _memberships = TTLCache(
+                toolkit.config['ckanext.ldap.cache.size'],
+                toolkit.config['ckanext.ldap.groups.cache_ttl'],
+            )
+    return _memberships
+
+
+def reset_membership_cache():
+    """
+    Drop the process wide membership cache so that it is recreated (with the current
+    config) on next use.
+    """
+    global _memberships
+    with _memberships_lock:
+        _memberships = None
+
+
+def get_user_groups(ldap_user_dict):
+    """
+    Get the groups the given LDAP user is a member of, from the membership cache if they
+    were resolved in the last ckanext.ldap.groups.cache_ttl seconds. Otherwise they are
+    taken from the user's memberOf attribute if the server provided it, or found with a
+    group search (see search.find_ldap_groups).
+
+    :param ldap_user_dict: Dictionary as returned by find_ldap_user
+    :raises OverloadedError: if admission control refuses the search
+    :returns: a frozenset of normalised group DNs, or None if they couldn't be found
+    """
+    cache = get_membership_cache()
+    key = normalise_dn(ldap_user_dict['cn'])
+    group_dns = cache.get(key)
+    if group_dns is MISSING:
+        group_dns = find_ldap_groups(
+            ldap_user_dict['cn'], direct=ldap_user_dict.get('member_of')
+        )
+        if group_dns is None:
+            # don't cache failures, they would stop memberships being updated
+            return None
+        group_dns = frozenset(group_dns)
+        cache.set(key, group_dns)
+    return group_dns
+
+
+def get_organizations(refs):
+    """
+    Get the ids of the active organizations with the given names or ids.
+
+    :param refs: organization names or ids
+    :returns: a dictionary mapping each name or id that was found to the organization's
+        id
+    """
+    refs = list(refs)
+    if not refs:
+        return {}
+    query = Session.query(Group.id, Group.name).filter(
+        Group.is_organization == True,  # noqa: E712
+        Group.state == 'active',
+        or_(Group.name.in_(refs), Group.id.in_(refs)),
+    )
+    found = {}
+    for group_id, name in query:
+        for ref in (name, group_id):
+            if ref in refs:
+                found[ref] = group_id
+    return found
+
+
+def resolve_organizations(mapping=None):
+    """
+    Get the ids of the organizations in the mapping, and of ckanext.ldap.organization.id
+    (which users are never removed from), with one query.
+
+    :param mapping: the parsed mapping (Default value = get_mapping())
+    :returns: a 2-tuple of a dictionary mapping the names (or ids) used in the mapping
+        to the ids of the organizations that exist, and the id of
+        ckanext.ldap.organization.id (or None)
+    """
+    refs = mapped_organizations(mapping)
+    default = toolkit.config.get('ckanext.ldap.organization.id')
+    found = get_organizations(refs | {default} if default else refs)
+    return {ref: found[ref] for ref in refs if ref in found}, found.get(default)
+
+
+def get_user_memberships(user_id, organization_ids):
+    """
+    Get the given user's roles in the given organizations, with one query.
+
+    :param user_id: the CKAN user's id
+    :param organization_ids: the organizations' ids
+    :returns: a dictionary of organization id to role, for the organizations the user is
+        an active member of
+    """
+    organization_ids = list(organization_ids)
+    if not organization_ids:
+        return {}
+    query = Session.query(Member.group_id, Member.capacity).filter(
+        Member.table_name == 'user',
+        Member.table_id == user_id,
+        Member.state == 'active',
+        Member.group_id.in_(organization_ids),
+    )
+    return dict(query)
+
+
+def get_organization_members(organization_id):
+    """
+    Get the roles of all the users in the given organization, with one query.
+
+    :param organization_id: the organization's id
+    :returns: a dictionary of user id to role, for the organization's active members
+    """
+    query = Session.query(Member.table_id, Member.capacity).filter(
+        Member.group_id == organization_id,
+        Member.table_name == 'user',
+        Member.state == 'active',
+    )
+    return dict(query)
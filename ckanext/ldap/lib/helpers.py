@@ -8,16 +8,41 @@ from urllib.parse import parse_qs, urlparse
 from ckan.common import session
 from ckan.plugins import toolkit
 
+from ckanext.ldap.lib import identity
+from ckanext.ldap.model.ldap_user import LdapUser
+
 
 def is_ldap_user():
     """
-    Helper function for determining if current user is LDAP user.
+    Helper function for determining if current user is LDAP user, i.e. logged in through
+    the LDAP login form (and so holding a valid identity cookie, if they are enabled).
 
     :returns: boolean
     """
+    if identity.enabled():
+        return identity.identify_request() is not None
     return 'ckanext-ldap-user' in session
 
 
+def get_ldap_user_ids(users):
+    """
+    Helper function for finding out which of the given users are LDAP users, using a
+    single query for all of them (rather than one per user when rendering a list).
+
+    :param users: an iterable of user dicts, user objects or user ids
+    :returns: the set of the ids of the given users which are LDAP users
+    """
+    user_ids = [
+        user['id'] if isinstance(user, dict) else getattr(user, 'id', user)
+        for user in users
+    ]
+    return {
+        user_id
+        for user_id, ldap_user in LdapUser.by_user_ids(user_ids).items()
+        if ldap_user is not None
+    }
+
+
 def get_login_action():
     """
     Returns ldap login handler.
@@ -0,0 +1,253 @@
+# !/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-ldap
+# Created by the Natural History Museum in London, UK
+
+import base64
+import hashlib
+import hmac
+import logging
+import threading
+import time
+
+from ckan.model import Session, User
+from ckan.plugins import toolkit
+
+from ckanext.ldap.lib.cache import MISSING, TTLCache
+from ckanext.ldap.lib.exceptions import StoreError
+from ckanext.ldap.lib.store import get_store
+
+log = logging.getLogger(__name__)
+
+# the name of the cookie holding the signed user id
+COOKIE_NAME = 'ckanext-ldap-identity'
+# seconds to remember a user id's name for, which is how long a rename (or deletion)
+# takes to be noticed
+NAME_TTL = 60
+# seconds to remember whether a token has been revoked for, which is how long a logout
+# takes to be noticed by the other CKAN processes
+REVOCATION_TTL = 10
+
+_names = None
+_revocations = None
+_names_lock = threading.Lock()
+
+
+def enabled():
+    """
+    Check whether logins are remembered with a signed identity cookie rather than in the
+    session.
+
+    :returns: True if ckanext.ldap.identity_cookie.enabled is set
+    """
+    return toolkit.config['ckanext.ldap.identity_cookie.enabled']
+
+
+def get_secret(config=None):
+    """
+    Get the key used to sign identity cookies: the
+    ckanext.ldap.identity_cookie.secret option, falling back to CKAN's own secret.
+
+    :param config: the config to read (Default value = toolkit.config)
+    :returns: the key as bytes, or None if no secret is configured
+    """
+    config = toolkit.config if config is None else config
+    secret = (
+        config.get('ckanext.ldap.identity_cookie.secret')
+        or config.get('SECRET_KEY')
+        or config.get('beaker.session.secret')
+    )
+    return secret.encode('utf-8') if secret else None
+
+
+def _sign(payload):
+    digest = hmac.new(get_secret(), payload.encode('utf-8'), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode('ascii')
+
+
+def make_token(user_id, now=None):
+    """
+    Create a signed token identifying the given user, which expires after
+    ckanext.ldap.identity_cookie.max_age seconds.
+
+    :param user_id: the CKAN user's id
+    :param now: the current unix time (Default value = time.time())
+    :returns: the token, a string
+    """
+    now = time.time() if now is None else now
+    expires = int(now) + toolkit.config['ckanext.ldap.identity_cookie.max_age']
+    payload = f'{user_id}.{expires}'
+    return f'{payload}.{_sign(payload)}'
+
+
+def read_token(token, now=None):
+    """
+    Check the signature and expiry of a token created by make_token.
+
+    :param token: the token
+    :param now: the current unix time (Default value = time.time())
+    :returns: the user id, or None if the token is invalid or has expired
+    """
+    try:
+        user_id, expires, signature = token.rsplit('.', 2)
+        expires = int(expires)
+    except (AttributeError, ValueError):
+        return None
+    if not hmac.compare_digest(_sign(f'{user_id}.{expires}'), signature):
+        log.debug('Ignoring an identity cookie with a bad signature')
+        return None
+    if expires <= (time.time() if now is None else now):
+        return None
+    return user_id
+
+
+def get_user_name(user_id):
+    """
+    Get the name of the active CKAN user with the given id, from a process wide cache
+    which is refreshed every NAME_TTL seconds.
+
+    :param user_id: the CKAN user's id
+    :returns: the user name, or None if there is no such active user
+    """
+    global _names
+    with _names_lock:
+        if _names is None:
+            _names = TTLCache(toolkit.config['ckanext.ldap.cache.size'], NAME_TTL)
+    user_name = _names.get(user_id)
+    if user_name is MISSING:
+        user_name = (
+            Session.query(User.name)
+            .filter(User.id == user_id, User.state == 'active')
+            .scalar()
+        )
+        _names.set(user_id, user_name)
+    return user_name
+
+
+def reset_names():
+    """
+    Drop the process wide caches of user names and revocations so that they are
+    recreated (with the current config) on next use.
+    """
+    global _names, _revocations
+    with _names_lock:
+        _names = None
+        _revocations = None
+
+
+def _get_revocations():
+    global _revocations
+    with _names_lock:
+        if _revocations is None:
+            _revocations = TTLCache(
+                toolkit.config['ckanext.ldap.cache.size'], REVOCATION_TTL
+            )
+        return _revocations
+
+
+def _revocation_key(token):
+    # the signature is unique to the token
+    return f'identity:revoked:{token.rsplit(".", 1)[-1]}'
+
+
+def revoke(token, now=None):
+    """
+    Revoke a token (e.g. when its user logs out) so that copies of it are refused for
+    the rest of its life. The revocation is kept in the store (see ckanext.ldap.store)
+    until the token would have expired anyway, so with the memory store it only applies
+    to this process.
+
+    :param token: the token
+    :param now: the current unix time (Default value = time.time())
+    """
+    now = time.time() if now is None else now
+    if read_token(token, now) is None:
+        return
+    key = _revocation_key(token)
+    expires = int(token.rsplit('.', 2)[1])
+    try:
+        get_store().set(key, '1', max(1, expires - int(now)))
+    except StoreError as e:
+        log.warning(f'Could not revoke an identity cookie: {e}')
+    _get_revocations().set(key, True)
+
+
+def is_revoked(token):
+    """
+    Check whether a token has been revoked, remembering the answer for REVOCATION_TTL
+    seconds. If the store can't be reached the token is treated as not revoked.
+
+    :param token: the token
+    :returns: True if the token has been revoked, False if not
+    """
+    revocations = _get_revocations()
+    key = _revocation_key(token)
+    revoked = revocations.get(key)
+    if revoked is MISSING:
+        try:
+            revoked = get_store().get(key) is not None
+        except StoreError as e:
+            log.warning(f'Could not check whether an identity cookie is revoked: {e}')
+            return False
+        revocations.set(key, revoked)
+    return revoked
+
+
+def identify_request():
+    """
+    Identify the user making the current request from their identity cookie.
+
+    :returns: the CKAN user name, or None if there is no valid cookie
+    """
+    token = toolkit.request.cookies.get(COOKIE_NAME)
+    if not token:
+        return None
+    user_id = read_token(token)
+    if user_id is None or is_revoked(token):
+        return None
+    return get_user_name(user_id)
+
+
+def log_in_request(user_name):
+    """
+    On CKAN 2.10+, make the given user flask-login's current user for the rest of the
+    request. Unlike toolkit.login_user this doesn't write anything to the session, as
+    the identity cookie identifies the user on the next request.
+
+    :param user_name: the CKAN user name
+    """
+    user_obj = User.by_name(user_name)
+    if user_obj is not None:
+        # where flask-login keeps the current user of the request, current_user only
+        # loads the user from the session if this isn't set
+        toolkit.g._login_user = user_obj
+
+
+def set_cookie(response, user_id):
+    """
+    Add an identity cookie for the given user to the response.
+
+    :param response: the response
+    :param user_id: the CKAN user's id
+    """
+    response.set_cookie(
+        COOKIE_NAME,
+        make_token(user_id),
+        max_age=toolkit.config['ckanext.ldap.identity_cookie.max_age'],
+        secure=toolkit.config['ckanext.ldap.identity_cookie.secure'],
+        httponly=True,
+        samesite='Lax',
+    )
+
+
+def clear_cookie(response):
+    """
+    Remove the identity cookie from the browser. The cookie should be revoked too (see
+    revoke), as this doesn't stop copies of it from being used.
+
+    :param response: the response
+    :returns: the response
+    """
+    response.delete_cookie(COOKIE_NAME)
+    return response
@@ -0,0 +1,70 @@
+# !/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-ldap
+# Created by the Natural History Museum in London, UK
+
+import logging
+
+from ckan.model import Session
+from ckan.plugins import toolkit
+
+try:
+    # rq 1.5+ (CKAN 2.10+)
+    from rq import Retry
+except ImportError:
+    Retry = None
+
+log = logging.getLogger(__name__)
+
+
+def enabled():
+    """
+    Check whether the parts of a login the user doesn't need to wait for are run as
+    background jobs.
+
+    :returns: True if ckanext.ldap.jobs.enabled is set
+    """
+    return toolkit.config['ckanext.ldap.jobs.enabled']
+
+
+def enqueue(function, *args):
+    """
+    Run the given function on CKAN's background job queue. The function must be
+    idempotent, as a failed job is put back on the queue up to ckanext.ldap.jobs.retries
+    times (with rq 1.5+). It goes to the back of the queue straight away rather than
+    after a delay, as CKAN's worker doesn't run rq's scheduler, so the worker carries on
+    with the other jobs in the meantime.
+
+    :param function: a module level function (so that the worker can import it)
+    :param args: the arguments to call it with, which must be picklable
+    :returns: the job
+    """
+    retries = toolkit.config['ckanext.ldap.jobs.retries']
+    rq_kwargs = {}
+    if retries > 0 and Retry is not None:
+        rq_kwargs['retry'] = Retry(max=retries)
+    return toolkit.enqueue_job(
+        run,
+        args=[function, *args],
+        title=f'ckanext-ldap: {function.__name__}',
+        rq_kwargs=rq_kwargs,
+    )
+
+
+def run(function, *args):
+    """
+    Call the given function, rolling back the session if it raises an error so that the
+    worker can carry on with other jobs. This is what enqueue actually queues.
+
+    :param function: the function
+    :param args: the arguments to call it with
+    :returns: the return value of function
+    """
+    try:
+        return function(*args)
+    except Exception as e:
+        # a failed flush leaves the session unusable until it is rolled back
+        Session.rollback()
+        log.warning(f'{function.__name__} failed: {e}')
+        raise
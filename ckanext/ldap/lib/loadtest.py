@@ -0,0 +1,420 @@
+# !/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-ldap
+# Created by the Natural History Museum in London, UK
+
+import logging
+import random
+import re
+import secrets
+import statistics
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from ckan import model
+from ckan.plugins import toolkit
+from sqlalchemy import event
+
+from ckanext.ldap.lib import fake_ldap
+from ckanext.ldap.lib.admission import reset_admission
+from ckanext.ldap.lib.pool import reset_pool
+from ckanext.ldap.lib.search import reset_lookup_cache
+from ckanext.ldap.lib.servers import reset_servers
+from ckanext.ldap.model.ldap_user import LdapUser
+
+log = logging.getLogger(__name__)
+
+LOGIN_URL = '/ldap_login_handler'
+# the page whose form carries the CSRF token the login handler checks on CKAN 2.10+
+LOGIN_FORM_URL = '/user/login'
+# throttling and admission control would turn logins into 429s and 503s and skew the
+# throughput and latencies, so the load test runs without them
+CONFIG = {
+    **fake_ldap.CONFIG,
+    'ckanext.ldap.throttle.enabled': False,
+    'ckanext.ldap.admission.limit': 0,
+}
+
+
+def percentile(timings, percent):
+    """
+    Get the given percentile of a list of timings (nearest rank).
+
+    :param timings: a list of timings
+    :param percent: the percentile, 0-100
+    :returns: the timing at that percentile, or None if there are no timings
+    """
+    if not timings:
+        return None
+    ordered = sorted(timings)
+    index = max(0, min(len(ordered) - 1, round(percent / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarise(timings):
+    """
+    Summarise a list of timings.
+
+    :param timings: a list of timings in seconds
+    :returns: a dictionary of the count, mean, p50, p90, p99 and max in milliseconds
+    """
+    if not timings:
+        return {'count': 0}
+    return {
+        'count': len(timings),
+        'mean': statistics.mean(timings) * 1000,
+        'p50': percentile(timings, 50) * 1000,
+        'p90': percentile(timings, 90) * 1000,
+        'p99': percentile(timings, 99) * 1000,
+        'max': max(timings) * 1000,
+    }
+
+
+class QueryCounter:
+    """
+    Counts the SQL statements executed on each thread.
+    """
+
+    def __init__(self, engine):
+        """
+        :param engine: the SQLAlchemy engine to count the statements of
+        """
+        self.engine = engine
+        self._local = threading.local()
+
+    def _count(self, *args, **kwargs):
+        self._local.count = getattr(self._local, 'count', 0) + 1
+
+    @property
+    def count(self):
+        """
+        The number of statements executed on the current thread.
+        """
+        return getattr(self._local, 'count', 0)
+
+    @contextmanager
+    def listening(self):
+        """
+        Context manager which counts statements whilst active.
+        """
+        event.listen(self.engine, 'before_cursor_execute', self._count)
+        try:
+            yield self
+        finally:
+            event.remove(self.engine, 'before_cursor_execute', self._count)
+
+
+@contextmanager
+def fake_directory_config(directory):
+    """
+    Context manager which points this extension at the given fake directory, with
+    throttling and admission control turned off, restoring the config (and dropping the
+    pooled connections, cached lookups and admission controller) afterwards.
+
+    :param directory: a FakeDirectory
+    """
+    saved = {key: toolkit.config.get(key) for key in CONFIG}
+    toolkit.config.update(CONFIG)
+    reset_pool()
+    reset_servers()
+    reset_lookup_cache()
+    reset_admission()
+    try:
+        with directory.installed():
+            yield
+    finally:
+        for key, value in saved.items():
+            if value is None:
+                toolkit.config.pop(key, None)
+            else:
+                toolkit.config[key] = value
+        reset_pool()
+        reset_servers()
+        reset_lookup_cache()
+        reset_admission()
+
+
+def find_users(ldap_ids):
+    """
+    Find the CKAN users of the LDAP users with the given ids.
+
+    :param ldap_ids: the LDAP ids
+    :returns: a list of CKAN user ids
+    """
+    ldap_ids = list(ldap_ids)
+    user_ids = []
+    for batch in (ldap_ids[i : i + 500] for i in range(0, len(ldap_ids), 500)):
+        user_ids.extend(
+            user_id
+            for (user_id,) in model.Session.query(LdapUser.user_id).filter(
+                LdapUser.ldap_id.in_(batch)
+            )
+        )
+    return user_ids
+
+
+def remove_users(user_ids):
+    """
+    Delete the given CKAN users, created by a load test, with the user_delete action
+    (which also removes their memberships) and forget that they were LDAP users. The
+    deleted users keep their names.
+
+    :param user_ids: the CKAN user ids
+    :returns: the number of users deleted
+    """
+    site_user = toolkit.get_action('get_site_user')({'ignore_auth': True}, {})
+    user_delete = toolkit.get_action('user_delete')
+    for user_id in user_ids:
+        user_delete({'ignore_auth': True, 'user': site_user['name']}, {'id': user_id})
+    user_ids = list(user_ids)
+    for batch in (user_ids[i : i + 500] for i in range(0, len(user_ids), 500)):
+        model.Session.query(LdapUser).filter(LdapUser.user_id.in_(batch)).delete(
+            synchronize_session=False
+        )
+    model.Session.commit()
+    LdapUser.forget()
+    return len(user_ids)
+
+
+def get_csrf_token(client):
+    """
+    Get the CSRF token the login form carries, which the login handler checks on CKAN
+    2.10+. The token is tied to the client's session, so the client must keep cookies.
+
+    :param client: a flask test client
+    :returns: a dictionary of the token's form field to the token, empty if the form
+        doesn't carry one (e.g. on CKAN 2.9)
+    """
+    field = toolkit.config.get('WTF_CSRF_FIELD_NAME', '_csrf_token')
+    page = client.get(LOGIN_FORM_URL).get_data(as_text=True)
+    match = re.search(
+        rf'<input[^>]*name="{re.escape(field)}"[^>]*value="([^"]*)"', page
+    )
+    return {field: match.group(1)} if match else {}
+
+
+def _get_engine():
+    try:
+        # 2.11 compatibility
+        return model.ensure_engine()
+    except AttributeError:
+        return model.meta.engine
+
+
+def plan_logins(users, logins, failure_rate, seed=None):
+    """
+    Decide the logins to make: each user logs in for the first time and then again,
+    in order, with some of the logins using the wrong password.
+
+    :param users: the users returned by fake_ldap.generate_users
+    :param logins: the number of logins to make
+    :param failure_rate: the fraction of logins which use the wrong password
+    :param seed: seed for the random choices (Default value = None)
+    :returns: a list of (kind, login, password) tuples where kind is 'first', 'repeat',
+        'alt_only' (a first or repeat login found by the alternative filter) or
+        'bad_password'
+    """
+    rng = random.Random(seed)
+    seen = set()
+    plan = []
+    for i in range(logins):
+        user = users[i % len(users)]
+        if rng.random() < failure_rate:
+            plan.append(('bad_password', user['login'], 'not-the-password'))
+            continue
+        if user['alt_only']:
+            kind = 'alt_only'
+        else:
+            kind = 'repeat' if user['uid'] in seen else 'first'
+        seen.add(user['uid'])
+        plan.append((kind, user['login'], user['password']))
+    return plan
+
+
+def run_load_test(
+    app,
+    users=1000,
+    logins=2000,
+    rate=50,
+    threads=8,
+    collision_rate=0.1,
+    alt_only_rate=0.05,
+    failure_rate=0.05,
+    latency=0.0,
+    seed=None,
+    prefix=None,
+    cleanup=True,
+):
+    """
+    Log in to the given CKAN app through the LDAP login handler at a target rate from a
+    pool of threads, against a fake LDAP directory of generated users.
+
+    Logins are scheduled at fixed intervals (open loop), so a login's latency includes
+    any time it spent waiting for a free thread when CKAN can't keep up.
+
+    Each thread's client fetches the login form's CSRF token once and then keeps its
+    session, as a browser would.
+
+    The run refuses to start if any of the generated users already exist (e.g. because
+    an earlier run with the same prefix kept them), so that first logins really are
+    first logins and only users created by the run are deleted afterwards.
+
+    :param app: the CKAN flask app
+    :param users: the number of users in the directory (Default value = 1000)
+    :param logins: the number of logins to make (Default value = 2000)
+    :param rate: the target logins per second, 0 for as fast as possible (Default value
+        = 50)
+    :param threads: the number of concurrent logins (Default value = 8)
+    :param collision_rate: see fake_ldap.generate_users (Default value = 0.1)
+    :param alt_only_rate: see fake_ldap.generate_users (Default value = 0.05)
+    :param failure_rate: the fraction of logins with the wrong password (Default value =
+        0.05)
+    :param latency: seconds each LDAP operation takes (Default value = 0)
+    :param seed: seed for the random choices (Default value = None)
+    :param prefix: the start of every generated user's id (Default value = "loadtest"
+        and a random suffix)
+    :param cleanup: delete the users created by this run afterwards (Default value =
+        True)
+    :raises ValueError: if any of the generated users already exist
+    :returns: the report, as a dictionary
+    """
+    if prefix is None:
+        prefix = f'loadtest{secrets.token_hex(3)}-'
+    directory_users = fake_ldap.generate_users(
+        users,
+        collision_rate=collision_rate,
+        alt_only_rate=alt_only_rate,
+        seed=seed,
+        prefix=prefix,
+    )
+    ldap_ids = [user['uid'] for user in directory_users]
+    existing = len(find_users(ldap_ids))
+    if existing:
+        raise ValueError(
+            f'{existing} of the generated users already exist, use another prefix'
+        )
+    directory = fake_ldap.make_directory(directory_users, latency=latency)
+    plan = plan_logins(directory_users, logins, failure_rate, seed=seed)
+    queries = QueryCounter(_get_engine())
+
+    results = []
+    results_lock = threading.Lock()
+    local = threading.local()
+
+    def login(scheduled, kind, login_name, password):
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+            local.csrf = get_csrf_token(local.client)
+        started = time.perf_counter()
+        before = queries.count
+        try:
+            response = local.client.post(
+                LOGIN_URL,
+                data={'login': login_name, 'password': password, **local.csrf},
+            )
+            # logins redirect, to the login form if they failed (anything else, e.g. a
+            # 400 for a missing CSRF token, is a failure too)
+            failed = response.status_code != 302 or LOGIN_FORM_URL in (
+                response.headers.get('Location', '')
+            )
+            status = response.status_code
+        except Exception as e:
+            log.exception(f'Login for {login_name} raised an error: {e}')
+            failed = True
+            status = None
+        finished = time.perf_counter()
+        result = {
+            'kind': kind,
+            'latency': finished - scheduled,
+            'service_time': finished - started,
+            'queries': queries.count - before,
+            'status': status,
+            # bad passwords are meant to fail, everything else is meant to succeed
+            'unexpected': failed != (kind == 'bad_password'),
+        }
+        with results_lock:
+            results.append(result)
+
+    with fake_directory_config(directory), queries.listening():
+        # don't count the pool filling up in the first login
+        directory.reset_counts()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            for i, (kind, login_name, password) in enumerate(plan):
+                scheduled = start + (i / rate if rate > 0 else 0)
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(login, scheduled, kind, login_name, password)
+        duration = time.perf_counter() - start
+
+    created = find_users(ldap_ids)
+    removed = remove_users(created) if cleanup else 0
+    report = build_report(
+        results,
+        duration,
+        directory.counts,
+        parameters={
+            'users': users,
+            'logins': logins,
+            'rate': rate,
+            'threads': threads,
+            'collision_rate': collision_rate,
+            'alt_only_rate': alt_only_rate,
+            'failure_rate': failure_rate,
+            'latency_ms': latency * 1000,
+            'seed': seed,
+            'prefix': prefix,
+            'cleanup': cleanup,
+        },
+    )
+    report['users'] = {'created': len(created), 'removed': removed}
+    return report
+
+
+def build_report(results, duration, ldap_counts, parameters):
+    """
+    Create the load test report.
+
+    :param results: the result dictionaries of each login
+    :param duration: seconds the test took
+    :param ldap_counts: the number of each LDAP operation performed
+    :param parameters: the parameters of the test
+    :returns: the report, as a dictionary
+    """
+    by_kind = defaultdict(list)
+    for result in results:
+        by_kind[result['kind']].append(result)
+    count = len(results)
+    return {
+        'parameters': parameters,
+        'duration': duration,
+        'logins': count,
+        'throughput': count / duration if duration else 0,
+        'unexpected': sum(result['unexpected'] for result in results),
+        'errors': sum(1 for result in results if not result['status']),
+        'statuses': dict(Counter(str(result['status']) for result in results)),
+        'latency': summarise([result['latency'] for result in results]),
+        'service_time': summarise([result['service_time'] for result in results]),
+        'db_queries_per_login': (
+            sum(result['queries'] for result in results) / count if count else 0
+        ),
+        'ldap_operations_per_login': {
+            operation: total / count if count else 0
+            for operation, total in sorted(ldap_counts.items())
+        },
+        'by_kind': {
+            kind: {
+                'unexpected': sum(result['unexpected'] for result in kind_results),
+                'latency': summarise([result['latency'] for result in kind_results]),
+                'db_queries_per_login': statistics.mean(
+                    result['queries'] for result in kind_results
+                ),
+            }
+            for kind, kind_results in sorted(by_kind.items())
+        },
+    }
@@ -0,0 +1,239 @@
+# !/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-ldap
+# Created by the Natural History Museum in London, UK
+
+import hmac
+import os
+import time
+from contextlib import contextmanager
+
+from ckan.plugins import toolkit
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:
+    prometheus_client = None
+
+# LDAP operations are usually a few milliseconds, but can take seconds when a server is
+# struggling (or timing out)
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+if prometheus_client is not None:
+    LATENCY = prometheus_client.Histogram(
+        'ckanext_ldap_operation_seconds',
+        'Time spent on LDAP operations and on creating/updating LDAP users in CKAN',
+        ['operation'],
+        buckets=BUCKETS,
+    )
+    LOGINS = prometheus_client.Counter(
+        'ckanext_ldap_logins_total',
+        'Login attempts through the LDAP login handler, by outcome',
+        ['outcome'],
+    )
+    ERRORS = prometheus_client.Counter(
+        'ckanext_ldap_errors_total',
+        'Errors talking to the LDAP server, by type',
+        ['error'],
+    )
+    SERVER_LATENCY = prometheus_client.Histogram(
+        'ckanext_ldap_server_seconds',
+        'Time taken by requests to each LDAP server, by the role of the server',
+        ['role', 'server'],
+        buckets=BUCKETS,
+    )
+    SERVER_FAILURES = prometheus_client.Counter(
+        'ckanext_ldap_server_failures_total',
+        'Failures to reach each LDAP server, by the role of the server',
+        ['role', 'server'],
+    )
+    SATURATION = prometheus_client.Gauge(
+        'ckanext_ldap_admission_saturation',
+        'The fraction of the admission control slots in use',
+        # it is refreshed whenever the metrics are scraped, so the latest value is right
+        multiprocess_mode='mostrecent',
+    )
+    CREDENTIAL_CACHE = prometheus_client.Counter(
+        'ckanext_ldap_credential_cache_total',
+        'Lookups in the verified credential cache, by result',
+        ['result'],
+    )
+    BASIC_AUTH = prometheus_client.Counter(
+        'ckanext_ldap_basic_auth_total',
+        'Requests with HTTP Basic credentials, by outcome',
+        ['outcome'],
+    )
+    COALESCED = prometheus_client.Counter(
+        'ckanext_ldap_coalesced_lookups_total',
+        'Lookups which waited for an identical lookup in progress instead of searching',
+    )
+    REJECTIONS = prometheus_client.Counter(
+        'ckanext_ldap_admission_rejected_total',
+        'Requests refused by admission control, by reason',
+        ['reason'],
+    )
+
+
+def available():
+    """
+    Check whether metrics can be collected, i.e. whether prometheus_client is installed.
+
+    :returns: True if metrics are available, False if not
+    """
+    return prometheus_client is not None
+
+
+@contextmanager
+def timed(operation):
+    """
+    Context manager which records the time taken by the code it wraps in the latency
+    histogram. Nothing is recorded if prometheus_client isn't installed.
+
+    :param operation: the name of the operation (e.g. 'search')
+    """
+    if prometheus_client is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        LATENCY.labels(operation).observe(time.perf_counter() - start)
+
+
+def count_login(outcome):
+    """
+    Count a login attempt.
+
+    :param outcome: the outcome of the login (e.g. 'success' or 'LDAP1')
+    """
+    if prometheus_client is not None:
+        LOGINS.labels(outcome).inc()
+
+
+def count_error(error):
+    """
+    Count an error talking to the LDAP server.
+
+    :param error: the type of error (e.g. 'server_down')
+    """
+    if prometheus_client is not None:
+        ERRORS.labels(error).inc()
+
+
+def observe_server(role, server, seconds):
+    """
+    Record the time taken by a request to an LDAP server.
+
+    :param role: the role of the server (e.g. 'search')
+    :param server: the URI of the server
+    :param seconds: the time the request took
+    """
+    if prometheus_client is not None:
+        SERVER_LATENCY.labels(role or '', server).observe(seconds)
+
+
+def count_server_failure(role, server):
+    """
+    Count a failure to reach an LDAP server.
+
+    :param role: the role of the server (e.g. 'search')
+    :param server: the URI of the server
+    """
+    if prometheus_client is not None:
+        SERVER_FAILURES.labels(role or '', server).inc()
+
+
+def set_saturation(saturation):
+    """
+    Set the fraction of the admission control slots in use.
+
+    :param saturation: the fraction, 0-1
+    """
+    if prometheus_client is not None:
+        SATURATION.set(saturation)
+
+
+def count_rejection(reason):
+    """
+    Count a request refused by admission control.
+
+    :param reason: why it was refused (e.g. 'timeout')
+    """
+    if prometheus_client is not None:
+        REJECTIONS.labels(reason).inc()
+
+
+def count_credential_cache(result):
+    """
+    Count a lookup in the verified credential cache.
+
+    :param result: 'hit', 'miss' or 'mismatch'
+    """
+    if prometheus_client is not None:
+        CREDENTIAL_CACHE.labels(result).inc()
+
+
+def count_basic_auth(outcome):
+    """
+    Count a request with HTTP Basic credentials.
+
+    :param outcome: the outcome of checking the credentials (e.g. 'cached' or 'success')
+    """
+    if prometheus_client is not None:
+        BASIC_AUTH.labels(outcome).inc()
+
+
+def count_coalesced():
+    """
+    Count a lookup which waited for an identical lookup in progress.
+    """
+    if prometheus_client is not None:
+        COALESCED.inc()
+
+
+def _multiprocess_dir():
+    return os.environ.get('PROMETHEUS_MULTIPROC_DIR') or os.environ.get(
+        'prometheus_multiproc_dir'
+    )
+
+
+def generate():
+    """
+    Render the metrics in the Prometheus text format. If PROMETHEUS_MULTIPROC_DIR is set
+    (which must be the case when running several worker processes, e.g. under gunicorn
+    or uwsgi) the metrics of all the processes are aggregated.
+
+    :returns: a 2-tuple of the response body and its content type
+    """
+    if _multiprocess_dir():
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return prometheus_client.generate_latest(
+        registry
+    ), prometheus_client.CONTENT_TYPE_LATEST
+
+
+def authorised(authorization, user_obj=None):
+    """
+    Check whether a request may read the metrics. It must either be made by a logged in
+    sysadmin or carry ckanext.ldap.metrics.token as a bearer token (which is how
+    Prometheus authenticates scrapes).
+
+    :param authorization: the request's Authorization header, or None
+    :param user_obj: the logged in User object, or None (Default value = None)
+    :returns: True if the request may read the metrics, False if not
+    """
+    if user_obj is not None and user_obj.sysadmin:
+        return True
+    token = toolkit.config.get('ckanext.ldap.metrics.token')
+    if not token or not authorization:
+        return False
+    scheme, _, credentials = authorization.partition(' ')
+    return scheme.lower() == 'bearer' and hmac.compare_digest(
+        credentials.strip().encode('utf-8'), token.encode('utf-8')
+    )
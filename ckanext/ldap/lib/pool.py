@@ -0,0 +1,519 @@
+# !/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-ldap
+# Created by the Natural History Museum in London, UK
+
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import ldap
+import ldap.sasl
+from ckan.plugins import toolkit
+
+from ckanext.ldap.lib import metrics
+from ckanext.ldap.lib.exceptions import NoServerAvailableError, PoolTimeoutError
+from ckanext.ldap.lib.servers import DISCONNECT_ERRORS, SEARCH, get_servers
+
+log = logging.getLogger(__name__)
+
+
+def open_connection(uri=None, factory=None):
+    """
+    Open a new, unbound connection to the LDAP server.
+
+    :param uri: the URI to connect to (Default value = the ckanext.ldap.uri option, if
+        it lists several servers they are tried in order by libldap)
+    :param factory: callable taking the same arguments as ldap.initialize, used to
+        create an instance of an LDAPObject subclass (Default value = ldap.initialize)
+    :returns: an LDAPObject
+    """
+    # python-ldap connects lazily, so this only measures the set up and the network
+    # connection itself is part of the first operation (usually a bind)
+    with metrics.timed('connect'):
+        cnx = (factory or ldap.initialize)(
+            uri or toolkit.config['ckanext.ldap.uri'],
+            bytes_mode=False,
+            trace_level=toolkit.config['ckanext.ldap.trace_level'],
+        )
+        cnx.set_option(
+            ldap.OPT_NETWORK_TIMEOUT, toolkit.config['ckanext.ldap.network_timeout']
+        )
+        if toolkit.config['ckanext.ldap.operation_timeout'] > 0:
+            cnx.set_option(
+                ldap.OPT_TIMEOUT, toolkit.config['ckanext.ldap.operation_timeout']
+            )
+        if toolkit.config['ckanext.ldap.ignore_referrals']:
+            cnx.set_option(ldap.OPT_REFERRALS, 0)
+    return cnx
+
+
+def connect(factory=None, role=SEARCH, exclude=()):
+    """
+    Open a connection to the first available LDAP server for the given role (see
+    servers.ServerSet) and bind it as the service account.
+
+    :param factory: see open_connection (Default value = None)
+    :param role: the role of the server to connect to (Default value = SEARCH)
+    :param exclude: connections opened by this function whose servers shouldn't be tried
+        (Default value = ())
+    :raises NoServerAvailableError: if every server is known to be down (or excluded)
+    :returns: an LDAPObject
+    """
+
+    def open_and_bind(uri):
+        cnx = open_connection(uri, factory=factory)
+        try:
+            # python-ldap connects lazily, binding (anonymously if there is no service
+            # account) makes sure a dead server is found here
+            service_bind(cnx, rebind=True)
+        except BaseException:
+            close_connection(cnx)
+            raise
+        return cnx
+
+    return get_servers(role).connect(open_and_bind, exclude=exclude)
+
+
+def service_bind(cnx, rebind=False):
+    """
+    Bind the given connection as the service account defined by ckanext.ldap.auth.dn
+    using the configured method (SIMPLE or SASL DIGEST-MD5). If no service account is
+    configured the connection is left anonymous.
+
+    :param cnx: the LDAPObject to bind
+    :param rebind: whether the connection may currently be bound as another identity
+        (e.g. after a user bind), in which case an anonymous connection is explicitly
+        rebound anonymously (Default value = False)
+    """
+    with metrics.timed('service_bind'):
+        _service_bind(cnx, rebind)
+
+
+def _service_bind(cnx, rebind):
+    dn = toolkit.config.get('ckanext.ldap.auth.dn')
+    if not dn:
+        if rebind:
+            cnx.simple_bind_s('', '')
+        return
+
+    method = toolkit.config['ckanext.ldap.auth.method']
+    mechanism = toolkit.config['ckanext.ldap.auth.mechanism']
+    if method == 'SIMPLE':
+        cnx.bind_s(dn, toolkit.config['ckanext.ldap.auth.password'])
+    elif method == 'SASL' and mechanism == 'DIGEST-MD5':
+        auth_tokens = ldap.sasl.digest_md5(
+            dn, toolkit.config['ckanext.ldap.auth.password']
+        )
+        cnx.sasl_interactive_bind_s('', auth_tokens)
+    elif method == 'SASL':
+        log.error(f'SASL mechanism not supported: {mechanism}')
+        raise ldap.AUTH_METHOD_NOT_SUPPORTED({'desc': mechanism})
+    else:
+        log.error(f'LDAP authentication method is not supported: {method}')
+        raise ldap.AUTH_METHOD_NOT_SUPPORTED({'desc': method})
+
+
+def close_connection(cnx):
+    """
+    Unbind the given connection, ignoring any errors as the connection is being thrown
+    away anyway.
+
+    :param cnx: the LDAPObject to close
+    """
+    try:
+        cnx.unbind_s()
+    except ldap.LDAPError:
+        pass
+
+
+class _PooledConnection:
+    """
+    Book-keeping for a connection owned by a pool.
+    """
+
+    __slots__ = ('cnx', 'last_used', 'needs_rebind')
+
+    def __init__(self, cnx):
+        self.cnx = cnx
+        self.last_used = time.monotonic()
+        self.needs_rebind = False
+
+
+class ConnectionPool:
+    """
+    A thread-safe pool of LDAP connections which are bound as the service account.
+
+    Idle connections are reused LIFO so that the least recently used connections age out
+    and are reaped once they have been idle for longer than idle_timeout (whilst keeping
+    at least min_size open). Connections that have been idle for longer than
+    check_interval are checked with a WhoAmI request before they are handed out. If the
+    process forks, the connections inherited from the parent are dropped (not unbound,
+    as the sockets are shared with the parent) and the child starts with an empty pool.
+    """
+
+    def __init__(
+        self,
+        connect,
+        rebind,
+        min_size=0,
+        max_size=10,
+        idle_timeout=300,
+        checkout_timeout=10,
+        check_interval=30,
+        on_disconnect=None,
+        on_latency=None,
+    ):
+        """
+        :param connect: callable returning a new, service bound LDAPObject. When a new
+            connection has found its server to be down, it is called with exclude, a
+            list of such connections, and should connect to a different server
+        :param rebind: callable which restores the service identity on a connection
+            that has been bound as another user
+        :param min_size: the number of connections to keep open (Default value = 0)
+        :param max_size: the maximum number of connections (Default value = 10)
+        :param idle_timeout: seconds after which an idle connection is closed (Default
+            value = 300)
+        :param checkout_timeout: seconds to wait for a connection when the pool is
+            exhausted (Default value = 10)
+        :param check_interval: seconds a connection can be idle before it is checked
+            for liveness on checkout (Default value = 30)
+        :param on_disconnect: callable which is called with a checked out connection
+            that has found its server to be down (Default value = None)
+        :param on_latency: callable which is called with a connection and the seconds
+            taken by a successful run on it (Default value = None)
+        """
+        self._connect = connect
+        self._rebind = rebind
+        self.min_size = min_size
+        self.max_size = max(max_size, 1)
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        self.check_interval = check_interval
+        self._on_disconnect = on_disconnect
+        self._on_latency = on_latency
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._condition = threading.Condition()
+        self._idle = deque()
+        self._in_use = {}
+        self._size = 0
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            self._reset()
+
+    @property
+    def size(self):
+        """
+        The number of connections currently owned by this pool (idle or in use).
+        """
+        return self._size
+
+    @property
+    def idle(self):
+        """
+        The number of idle connections currently in this pool.
+        """
+        return len(self._idle)
+
+    def fill(self):
+        """
+        Open connections until the pool holds at least min_size of them.
+        """
+        self._check_fork()
+        while True:
+            with self._condition:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                entry = _PooledConnection(self._connect())
+            except BaseException:
+                self._forget()
+                raise
+            with self._condition:
+                self._idle.append(entry)
+                self._condition.notify()
+
+    def acquire(self):
+        """
+        Check out a service bound connection, waiting up to checkout_timeout seconds if
+        the pool is exhausted.
+
+        :returns: an LDAPObject which must be given back using release
+        """
+        return self._acquire()[0]
+
+    def release(self, cnx, discard=False):
+        """
+        Return a connection to the pool.
+
+        :param cnx: the LDAPObject that was checked out
+        :param discard: if True the connection is closed rather than reused (Default
+            value = False)
+        """
+        self._check_fork()
+        with self._condition:
+            entry = self._in_use.pop(id(cnx), None)
+            if entry is None:
+                # not one of ours (e.g. checked out before a fork)
+                return
+            if not discard:
+                entry.last_used = time.monotonic()
+                self._idle.append(entry)
+            else:
+                self._size -= 1
+            expired = self._reap()
+            self._condition.notify()
+        if discard:
+            close_connection(cnx)
+        for stale in expired:
+            close_connection(stale.cnx)
+
+    def mark_rebind(self, cnx):
+        """
+        Flag a checked out connection as no longer being bound as the service account
+        (e.g. because it has been used for a user bind). The service identity is
+        restored the next time the connection is checked out.
+
+        :param cnx: the LDAPObject that was checked out
+        """
+        entry = self._in_use.get(id(cnx))
+        if entry is not None:
+            entry.needs_rebind = True
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager which checks out a connection and gives it back afterwards.
+
+        If the connection is found to be broken it is discarded instead.
+        """
+        cnx = self.acquire()
+        discard = False
+        try:
+            yield cnx
+        except DISCONNECT_ERRORS:
+            discard = True
+            self._disconnected(cnx)
+            raise
+        finally:
+            self.release(cnx, discard=discard)
+
+    def run(self, function):
+        """
+        Call the given function with a checked out connection and return its result.
+
+        If a reused connection turns out to have been dropped by the server (SERVER_DOWN
+        and friends) then the idle connections are discarded as they are likely to be
+        dead too, and the function is called again with a freshly bound connection. If a
+        fresh connection fails like this the function is called again on a connection to
+        another server, until there are no other servers to try.
+
+        :param function: a callable taking an LDAPObject
+        :returns: the return value of function
+        """
+        failed = []
+        error = None
+        while True:
+            try:
+                cnx, reused = self._acquire(exclude=failed)
+            except NoServerAvailableError:
+                if not failed:
+                    raise
+                # there is nowhere else to go, report why the last server failed
+                raise error from None
+            start = time.perf_counter()
+            try:
+                result = function(cnx)
+            except DISCONNECT_ERRORS as e:
+                self._disconnected(cnx)
+                self.release(cnx, discard=True)
+                if reused:
+                    log.info('Pooled LDAP connection was lost, reconnecting')
+                    self.clear()
+                else:
+                    failed.append(cnx)
+                    # don't go round forever if connect can't avoid the failed servers
+                    if len(failed) >= self.max_size:
+                        raise
+                    log.info(f'LDAP server went away ({e}), trying another')
+                    error = e
+                continue
+            except BaseException:
+                self.release(cnx)
+                raise
+            if self._on_latency is not None:
+                self._on_latency(cnx, time.perf_counter() - start)
+            self.release(cnx)
+            return result
+
+    def clear(self):
+        """
+        Close all idle connections.
+
+        Connections currently checked out are unaffected.
+        """
+        self._check_fork()
+        with self._condition:
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+            self._condition.notify_all()
+        for entry in idle:
+            close_connection(entry.cnx)
+
+    def _disconnected(self, cnx):
+        if self._on_disconnect is not None:
+            self._on_disconnect(cnx)
+
+    def _acquire(self, exclude=()):
+        self._check_fork()
+        deadline = time.monotonic() + self.checkout_timeout
+        with self._condition:
+            while True:
+                expired = self._reap()
+                if self._idle:
+                    entry = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    entry = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeoutError(
+                        f'Timed out waiting for one of {self.max_size} LDAP connections'
+                    )
+                self._condition.wait(remaining)
+        for stale in expired:
+            close_connection(stale.cnx)
+
+        reused = entry is not None
+        if reused:
+            entry = self._prepare(entry)
+            reused = entry is not None
+        if not reused:
+            try:
+                cnx = self._connect(exclude=exclude) if exclude else self._connect()
+                entry = _PooledConnection(cnx)
+            except BaseException:
+                self._forget()
+                raise
+
+        with self._condition:
+            self._in_use[id(entry.cnx)] = entry
+        return entry.cnx, reused
+
+    def _prepare(self, entry):
+        """
+        Make sure an idle connection is usable before handing it out.
+
+        Returns None if it isn't, in which case its slot should be filled with a new
+        connection.
+        """
+        try:
+            if entry.needs_rebind:
+                self._rebind(entry.cnx)
+                entry.needs_rebind = False
+            elif time.monotonic() - entry.last_used > self.check_interval:
+                entry.cnx.whoami_s()
+        except ldap.LDAPError as e:
+            log.info(f'Discarding unusable pooled LDAP connection: {e}')
+            close_connection(entry.cnx)
+            return None
+        return entry
+
+    def _forget(self):
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+    def _reap(self):
+        """
+        Remove idle connections that have outlived idle_timeout and return them so that
+        they can be closed outside the lock.
+
+        Must be called whilst holding the lock.
+        """
+        expired = []
+        cutoff = time.monotonic() - self.idle_timeout
+        # the least recently used connections are at the left
+        while (
+            self._idle
+            and self._size > self.min_size
+            and self._idle[0].last_used < cutoff
+        ):
+            expired.append(self._idle.popleft())
+            self._size -= 1
+        return expired
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Get the process wide pool of connections to the LDAP search servers, creating it
+    from the config if needed. User binds don't use the pool (see
+    search.check_ldap_password).
+
+    :returns: a ConnectionPool
+    """
+    global _pool
+    created = False
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(
+                lambda exclude=(): connect(exclude=exclude),
+                lambda cnx: service_bind(cnx, rebind=True),
+                min_size=toolkit.config['ckanext.ldap.pool.min_size'],
+                max_size=toolkit.config['ckanext.ldap.pool.max_size'],
+                idle_timeout=toolkit.config['ckanext.ldap.pool.idle_timeout'],
+                checkout_timeout=toolkit.config['ckanext.ldap.pool.checkout_timeout'],
+                check_interval=toolkit.config['ckanext.ldap.pool.check_interval'],
+                on_disconnect=lambda cnx: get_servers(SEARCH).record_disconnect(cnx),
+                on_latency=lambda cnx, seconds: get_servers(SEARCH).record_latency(
+                    cnx, seconds
+                ),
+            )
+            created = True
+        pool = _pool
+    # opening connections can take a while if a server is slow, so don't hold up the
+    # other threads (which can use the pool meanwhile)
+    if created:
+        try:
+            pool.fill()
+        except ldap.LDAPError as e:
+            log.warning(f'Could not pre-open LDAP connections: {e}')
+    return pool
+
+
+def reset_pool():
+    """
+    Close the process wide LDAP connection pool so that it is recreated (with the
+    current config) on next use.
+    """
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.clear()
+
+
+def _after_fork():
+    global _pool_lock
+    # the lock may have been held by another thread at the point of forking
+    _pool_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
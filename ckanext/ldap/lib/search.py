@@ -5,89 +5,519 @@
 # Created by the Natural History Museum in London, UK
 
 import logging
+import threading
 
 import ldap
+import ldap.dn
+import ldap.filter
 from ckan.plugins import toolkit
 
-from ckanext.ldap.lib import helpers
-from ckanext.ldap.lib.exceptions import MultipleMatchError
+from ckanext.ldap.lib import credentials, helpers, metrics
+from ckanext.ldap.lib.admission import admitted
+from ckanext.ldap.lib.cache import MISSING, SharedGeneration, SingleFlight, TTLCache
+from ckanext.ldap.lib.exceptions import (
+    MultipleMatchError,
+    NoServerAvailableError,
+    PoolTimeoutError,
+)
+from ckanext.ldap.lib.pool import close_connection, get_pool, open_connection
+from ckanext.ldap.lib.servers import (
+    BIND,
+    DISCONNECT_ERRORS,
+    get_servers,
+    roles_share_servers,
+)
 
 log = logging.getLogger('ckanext.ldap')
 
+# returned by _run when the LDAP operation failed, so that failures aren't cached
+_FAILED = object()
+
+# the operational attribute holding an entry's permanent id (RFC 4530)
+ENTRY_UUID = 'entryUUID'
+# the attribute some servers (e.g. Active Directory, OpenLDAP with the memberof overlay)
+# maintain on each entry listing the DNs of the groups it is a member of
+MEMBER_OF = 'memberOf'
+
+_lookup_cache = None
+_lookup_cache_lock = threading.Lock()
+_lookup_generation = SharedGeneration('lookup-generation')
+# concurrent searches for the same login share one LDAP operation
+_lookups = SingleFlight(on_coalesce=metrics.count_coalesced)
+
+
+def get_lookup_cache():
+    """
+    Get the process wide cache of directory lookups, creating it from the config if
+    needed. The cache is emptied if flush_lookup_cache has been called in any process.
+
+    :returns: a TTLCache
+    """
+    global _lookup_cache
+    with _lookup_cache_lock:
+        if _lookup_cache is None:
+            _lookup_cache = TTLCache(
+                toolkit.config['ckanext.ldap.cache.size'],
+                toolkit.config['ckanext.ldap.cache.ttl'],
+                toolkit.config['ckanext.ldap.cache.negative_ttl'],
+            )
+    if _lookup_generation.changed():
+        _lookup_cache.clear()
+    return _lookup_cache
+
+
+def reset_lookup_cache():
+    """
+    Drop the process wide lookup cache so that it is recreated (with the current config)
+    on next use.
+    """
+    global _lookup_cache
+    with _lookup_cache_lock:
+        _lookup_cache = None
+
+
+def invalidate_ldap_user(login=None):
+    """
+    Remove cached lookups from this process' lookup cache.
+
+    :param login: only remove the entries for this login or LDAP username (Default value
+        = None, which removes everything)
+    :returns: the number of entries removed
+    """
+    cache = get_lookup_cache()
+    if login is None:
+        removed = len(cache)
+        cache.clear()
+        return removed
+    login = _normalise(login)
+    return cache.invalidate(
+        lambda key, value: key[0] == login
+        or (value is not None and _normalise(value['username']) == login)
+    )
+
+
+def flush_lookup_cache():
+    """
+    Empty the lookup cache in every CKAN process (within a few seconds).
+    """
+    _lookup_generation.bump()
+    invalidate_ldap_user()
+
 
 def find_ldap_user(login):
     """
     Find the LDAP user identified by 'login' in the configured ldap database.
 
+    Results (including not finding anything) are cached in the lookup cache, and the
+    search is run on a service bound connection borrowed from the connection pool.
+    Concurrent calls for the same login in this process share one search, and all get
+    its result (or its exception).
+
     :param login: The login to find in the LDAP database
     :returns: None if no user is found, a dictionary defining 'cn', 'username',
         'fullname' and 'email' otherwise.
     """
-    cnx = ldap.initialize(
-        toolkit.config['ckanext.ldap.uri'],
-        bytes_mode=False,
-        trace_level=toolkit.config['ckanext.ldap.trace_level'],
+    cache = get_lookup_cache()
+    key = _cache_key(login)
+    ldap_user_dict = cache.get(key)
+    if ldap_user_dict is MISSING:
+
+        def search():
+            result = _run(lambda cnx: _search_login(cnx, login), default=_FAILED)
+            if result is not _FAILED:
+                cache.set(key, result)
+            return result
+
+        ldap_user_dict = _lookups.do(key, search)
+        if ldap_user_dict is _FAILED:
+            return None
+    return dict(ldap_user_dict) if ldap_user_dict is not None else None
+
+
+def authenticate_ldap_user(login, password, known=None):
+    """
+    Find the LDAP user identified by 'login' and check that the given password is
+    theirs.
+
+    If the user has logged in before (known is given) and their lookup isn't cached, the
+    search is skipped: the password is checked by binding straight to their stored DN
+    (see bind_known_user). The search is only needed if that can't confirm the user,
+    e.g. because their entry has moved. If the password was verified for the stored DN
+    recently, the user is searched for (without a bind) instead.
+
+    If ckanext.ldap.login.same_connection is set, the user bind happens on the pooled
+    connection used for the search (which is then restored to the service identity
+    before it is reused), otherwise a separate connection to a bind server is used for
+    the user bind. The same connection is never used when searches and user binds go to
+    different servers.
+
+    If the password was verified recently (see credentials.verify), no bind happens.
+
+    :param login: The login to find in the LDAP database
+    :param password: The password to check
+    :param known: a 2-tuple of the DN and entryUUID (or None) the user's entry had when
+        they last logged in (Default value = None)
+    :returns: a 2-tuple containing the dictionary returned by find_ldap_user (or None if
+        no user is found) and a boolean indicating whether the password is correct
+    """
+    if known is not None and get_lookup_cache().get(_cache_key(login)) is MISSING:
+        dn, entry_uuid = known
+        if credentials.verify(dn, password):
+            # only the user's details are needed
+            ldap_user_dict = find_ldap_user(login)
+            if ldap_user_dict is None:
+                return None, False
+            if normalise_dn(ldap_user_dict['cn']) == normalise_dn(dn):
+                return ldap_user_dict, True
+            return ldap_user_dict, check_ldap_password(ldap_user_dict['cn'], password)
+        ldap_user_dict, rejected = bind_known_user(login, password, dn, entry_uuid)
+        if ldap_user_dict is not None:
+            get_lookup_cache().set(_cache_key(login), ldap_user_dict)
+            credentials.remember(dn, password)
+            return dict(ldap_user_dict), True
+        if rejected:
+            # find out whether the entry is still there, if it is there is no point in
+            # binding to it again
+            ldap_user_dict = find_ldap_user(login)
+            if ldap_user_dict is None:
+                return None, False
+            if normalise_dn(ldap_user_dict['cn']) == normalise_dn(dn):
+                return ldap_user_dict, False
+            return ldap_user_dict, check_ldap_password(ldap_user_dict['cn'], password)
+
+    if (
+        not toolkit.config['ckanext.ldap.login.same_connection']
+        or not roles_share_servers()
+    ):
+        ldap_user_dict = find_ldap_user(login)
+        if ldap_user_dict is None:
+            return None, False
+        return ldap_user_dict, check_ldap_password(ldap_user_dict['cn'], password)
+
+    pool = get_pool()
+    cache = get_lookup_cache()
+    key = _cache_key(login)
+    cached = cache.get(key)
+    if cached is None:
+        return None, False
+    if cached is not MISSING and credentials.verify(cached['cn'], password):
+        return dict(cached), True
+
+    def search_and_bind(cnx):
+        if cached is MISSING:
+            ldap_user_dict = _search_login(cnx, login)
+            cache.set(key, ldap_user_dict)
+        else:
+            ldap_user_dict = dict(cached)
+        if ldap_user_dict is None:
+            return None, False
+        if password:
+            # even a failed bind drops the service identity
+            pool.mark_rebind(cnx)
+        return ldap_user_dict, user_bind(cnx, ldap_user_dict['cn'], password)
+
+    ldap_user_dict, authenticated = _run(
+        search_and_bind, pool=pool, default=(None, False)
+    )
+    if authenticated:
+        credentials.remember(ldap_user_dict['cn'], password)
+    elif cached is not MISSING:
+        # the cached entry may be stale (e.g. the user has moved), so search next time
+        cache.pop(key)
+    return ldap_user_dict, authenticated
+
+
+def check_ldap_password(cn, password):
+    """
+    Checks that the given cn/password credentials work on the given CN, using a new
+    connection to the first available bind server which is always closed afterwards.
+
+    If the password was verified recently (see credentials.verify), no bind happens, so
+    the check also succeeds whilst the LDAP server is unreachable.
+
+    :param cn: Common name to log on
+    :param password: Password for cn
+    :raises OverloadedError: if admission control refuses the request
+    :returns: True on success, False on failure
+    """
+
+    def bind(server):
+        cnx = open_connection(server.uri)
+        try:
+            return user_bind(cnx, cn, password)
+        finally:
+            close_connection(cnx)
+
+    if credentials.verify(cn, password):
+        return True
+    try:
+        with admitted():
+            authenticated = get_servers(BIND).call(bind)
+    except NoServerAvailableError:
+        log.error('No LDAP server is available')
+        return False
+    except DISCONNECT_ERRORS as e:
+        # every bind server failed, this is the last one's error
+        log.error(f'LDAP server is not reachable: {e}')
+        metrics.count_error('server_down')
+        return False
+    except ldap.LDAPError as e:
+        log.error(f'Fatal LDAP Error: {e}')
+        metrics.count_error('ldap_error')
+        return False
+    if authenticated:
+        credentials.remember(cn, password)
+    return authenticated
+
+
+def bind_known_user(login, password, dn, entry_uuid=None):
+    """
+    Check the password of a user who has logged in before by binding to the DN their
+    entry had then, on a new connection to a bind server, and reading their entry on the
+    same connection. This avoids the service bind and the subtree search.
+
+    The entry is read with the search filter (so a user who no longer matches it isn't
+    let in) and must have the same entryUUID as before (so a different entry now at the
+    same DN isn't mistaken for the user's).
+
+    :param login: the login the user entered
+    :param password: the password to check
+    :param dn: the DN stored for the user
+    :param entry_uuid: the entryUUID stored for the user (Default value = None, which
+        skips the check)
+    :raises OverloadedError: if admission control refuses the request
+    :returns: a 2-tuple of the user dictionary (or None if the user couldn't be
+        confirmed this way) and a boolean indicating whether the bind was rejected
+    """
+    if not password:
+        return None, False
+    filter_str = toolkit.config['ckanext.ldap.search.filter'].format(
+        login=ldap.filter.escape_filter_chars(login)
     )
-    cnx.set_option(ldap.OPT_NETWORK_TIMEOUT, 10)
-    if toolkit.config['ckanext.ldap.ignore_referrals']:
-        cnx.set_option(ldap.OPT_REFERRALS, 0)
 
-    if toolkit.config.get('ckanext.ldap.auth.dn'):
+    def bind_and_read(server):
+        cnx = open_connection(server.uri)
         try:
-            if toolkit.config['ckanext.ldap.auth.method'] == 'SIMPLE':
-                cnx.bind_s(
-                    toolkit.config['ckanext.ldap.auth.dn'],
-                    toolkit.config['ckanext.ldap.auth.password'],
-                )
-            elif toolkit.config['ckanext.ldap.auth.method'] == 'SASL':
-                if toolkit.config['ckanext.ldap.auth.mechanism'] == 'DIGEST-MD5':
-                    auth_tokens = ldap.sasl.digest_md5(
-                        toolkit.config['ckanext.ldap.auth.dn'],
-                        toolkit.config['ckanext.ldap.auth.password'],
-                    )
-                    cnx.sasl_interactive_bind_s('', auth_tokens)
-                else:
-                    log.error(
-                        f'SASL mechanism not supported: '
-                        f'{toolkit.config["ckanext.ldap.auth.mechanism"]}'
-                    )
-                    return None
-            else:
-                log.error(
-                    f'LDAP authentication method is not supported: '
-                    f'{toolkit.config["ckanext.ldap.auth.method"]}'
+            if not user_bind(cnx, dn, password):
+                return None, True
+            with metrics.timed('read'):
+                res = cnx.search_s(
+                    dn,
+                    ldap.SCOPE_BASE,
+                    filterstr=filter_str,
+                    attrlist=user_attributes(),
                 )
-                return None
-        except ldap.SERVER_DOWN:
-            log.error('LDAP server is not reachable')
+        except (ldap.NO_SUCH_OBJECT, ldap.INSUFFICIENT_ACCESS, ldap.REFERRAL):
+            return None, False
+        finally:
+            close_connection(cnx)
+        res = [entry for entry in res if entry[0] is not None]
+        if len(res) != 1:
+            return None, False
+        return entry_to_user_dict(res[0][0], res[0][1]), False
+
+    try:
+        with admitted():
+            ldap_user_dict, rejected = get_servers(BIND).call(bind_and_read)
+    except NoServerAvailableError:
+        log.error('No LDAP server is available')
+        return None, False
+    except ldap.LDAPError as e:
+        log.warning(f'Could not bind directly to {dn}, searching instead: {e}')
+        return None, False
+    if ldap_user_dict is not None and entry_uuid is not None:
+        if ldap_user_dict.get('entry_uuid') != entry_uuid:
+            log.info(f'The entry at {dn} has changed, searching instead')
+            return None, False
+    return ldap_user_dict, rejected
+
+
+def normalise_dn(dn):
+    """
+    Put a DN into a canonical form, so that DNs which only differ in case or spacing
+    compare equal.
+
+    :param dn: the DN
+    :returns: the normalised DN
+    """
+    try:
+        rdns = ldap.dn.str2dn(dn.lower())
+    except ldap.DECODING_ERROR:
+        return dn.lower()
+    return ','.join(
+        '+'.join(f'{name}={ldap.dn.escape_dn_chars(value)}' for name, value, _ in rdn)
+        for rdn in rdns
+    )
+
+
+def find_ldap_groups(dn, direct=None):
+    """
+    Find the groups the entry with the given DN is a member of, with a single search of
+    ckanext.ldap.groups.base_dn using ckanext.ldap.groups.filter. If
+    ckanext.ldap.groups.nested is set, the groups those groups are members of are found
+    too, with one more search per level of nesting.
+
+    :param dn: the DN of the entry (usually a user)
+    :param direct: the DNs of the groups the entry is directly a member of if they are
+        already known (e.g. from its memberOf attribute), in which case they aren't
+        searched for (Default value = None)
+    :raises OverloadedError: if admission control refuses the request
+    :returns: a set of normalised group DNs, or None if the search failed
+    """
+    nested = toolkit.config['ckanext.ldap.groups.nested']
+
+    def search(cnx):
+        if direct is None:
+            groups = search_groups(cnx, [dn])
+        else:
+            groups = {normalise_dn(group) for group in direct}
+        if groups is None:
             return None
-        except ldap.INVALID_CREDENTIALS:
-            log.error(
-                'LDAP server credentials (ckanext.ldap.auth.dn and '
-                'ckanext.ldap.auth.password) invalid'
+        new = groups
+        while nested and new:
+            parents = search_groups(cnx, sorted(new))
+            if parents is None:
+                return None
+            new = parents - groups
+            groups |= new
+        return groups
+
+    if direct is not None and not nested:
+        return {normalise_dn(group) for group in direct}
+    return _run(search)
+
+
+def search_groups(cnx, member_dns):
+    """
+    Search ckanext.ldap.groups.base_dn for the groups which have any of the given DNs as
+    a member. Only the DNs of the groups are fetched.
+
+    :param cnx: The LDAP connection object
+    :param member_dns: the DNs of the members
+    :raises ldap.SERVER_DOWN: if the connection has been lost, so that the caller can
+        reconnect
+    :returns: a set of normalised group DNs, or None if the search failed
+    """
+    filters = [
+        toolkit.config['ckanext.ldap.groups.filter'].format(
+            dn=ldap.filter.escape_filter_chars(member_dn)
+        )
+        for member_dn in member_dns
+    ]
+    filter_str = filters[0] if len(filters) == 1 else f'(|{"".join(filters)})'
+    try:
+        with metrics.timed('group_search'):
+            res = cnx.search_s(
+                toolkit.config.get('ckanext.ldap.groups.base_dn')
+                or toolkit.config['ckanext.ldap.base_dn'],
+                ldap.SCOPE_SUBTREE,
+                filterstr=filter_str,
+                # no attributes, just the DNs
+                attrlist=['1.1'],
             )
-            return None
-        except ldap.LDAPError as e:
-            log.error(f'Fatal LDAP Error: {e}')
-            return None
+    except (ldap.NO_SUCH_OBJECT, ldap.REFERRAL):
+        log.error('LDAP group base DN (ckanext.ldap.groups.base_dn) does not exist')
+        return None
+    except ldap.FILTER_ERROR:
+        log.error('LDAP group filter (ckanext.ldap.groups.filter) is malformed')
+        return None
+    return {normalise_dn(group_dn) for group_dn, _ in res if group_dn is not None}
+
+
+def user_bind(cnx, cn, password):
+    """
+    Bind the given connection as the given user.
+
+    :param cnx: The LDAP connection object
+    :param cn: Common name to log on
+    :param password: Password for cn
+    :returns: True on success, False if the credentials are invalid
+    """
+    # Fail on empty password, binding with one would be an unauthenticated bind
+    if password == '':
+        log.debug('Invalid LDAP credentials')
+        return False
+    try:
+        with metrics.timed('user_bind'):
+            cnx.bind_s(cn, password)
+    except ldap.INVALID_CREDENTIALS:
+        log.debug('Invalid LDAP credentials')
+        return False
+    return True
+
+
+def _run(function, pool=None, default=None):
+    """
+    Run the given function on a pooled connection, once admitted (see
+    admission.AdmissionController), logging LDAP errors.
+
+    :param function: a callable taking an LDAPObject
+    :param pool: the pool to use (Default value = the process wide pool)
+    :param default: the value to return if an LDAP error occurs (Default value = None)
+    :raises OverloadedError: if admission control refuses the request
+    :returns: the return value of function, or default
+    """
+    try:
+        with admitted():
+            return (pool or get_pool()).run(function)
+    except NoServerAvailableError:
+        log.error('No LDAP server is available')
+    except ldap.SERVER_DOWN:
+        log.error('LDAP server is not reachable')
+        metrics.count_error('server_down')
+    except ldap.INVALID_CREDENTIALS:
+        log.error(
+            'LDAP server credentials (ckanext.ldap.auth.dn and '
+            'ckanext.ldap.auth.password) invalid'
+        )
+        metrics.count_error('service_credentials')
+    except PoolTimeoutError as e:
+        log.error(f'No LDAP connection available: {e}')
+        metrics.count_error('pool_timeout')
+    except ldap.LDAPError as e:
+        log.error(f'Fatal LDAP Error: {e}')
+        metrics.count_error('ldap_error')
+    return default
+
+
+def _normalise(login):
+    return login.strip().lower()
+
+
+def _cache_key(login):
+    """
+    Create the lookup cache key for the given login. The filters are part of the key so
+    that config changes can't return results for the old filters.
 
+    :param login: the login
+    :returns: a tuple
+    """
+    return (
+        _normalise(login),
+        toolkit.config['ckanext.ldap.search.filter'],
+        toolkit.config.get('ckanext.ldap.search.alt'),
+    )
+
+
+def _search_login(cnx, login):
+    """
+    Search for the given login using the main filter, and the alternative filter if the
+    main one doesn't find anything.
+
+    :param cnx: The LDAP connection object
+    :param login: The login to find in the LDAP database
+    :returns: see ldap_search
+    """
     filter_str = toolkit.config['ckanext.ldap.search.filter'].format(
         login=ldap.filter.escape_filter_chars(login)
     )
-    attributes = [toolkit.config['ckanext.ldap.username']]
-    if 'ckanext.ldap.fullname' in toolkit.config:
-        attributes.append(toolkit.config['ckanext.ldap.fullname'])
-    if 'ckanext.ldap.email' in toolkit.config:
-        attributes.append(toolkit.config['ckanext.ldap.email'])
-    try:
-        ret = ldap_search(cnx, filter_str, attributes, non_unique='log')
-        if ret is None and 'ckanext.ldap.search.alt' in toolkit.config:
-            filter_str = toolkit.config['ckanext.ldap.search.alt'].format(
-                login=ldap.filter.escape_filter_chars(login)
-            )
-            ret = ldap_search(cnx, filter_str, attributes, non_unique='raise')
-    finally:
-        cnx.unbind()
+    attributes = user_attributes()
+    ret = ldap_search(cnx, filter_str, attributes, non_unique='log')
+    if ret is None and 'ckanext.ldap.search.alt' in toolkit.config:
+        filter_str = toolkit.config['ckanext.ldap.search.alt'].format(
+            login=ldap.filter.escape_filter_chars(login)
+        )
+        ret = ldap_search(cnx, filter_str, attributes, non_unique='raise')
     return ret
 
 
@@ -105,21 +535,21 @@ def ldap_search(cnx, filter_str, attributes, non_unique='raise'):
                        with a message that will be displayed to the current user - such
                        as 'please use your unique id instead'). Other values will
                        silently ignore the error. (Default value = 'raise')
+    :raises ldap.SERVER_DOWN: if the connection has been lost, so that the caller can
+        reconnect
     :returns: A dictionary defining 'cn', self.ldap_username and any other attributes
               that were defined in attributes; or None if no user was found.
     """
     try:
-        res = cnx.search_s(
-            toolkit.config['ckanext.ldap.base_dn'],
-            ldap.SCOPE_SUBTREE,
-            filterstr=filter_str,
-            attrlist=attributes,
-        )
+        with metrics.timed('search'):
+            res = cnx.search_s(
+                toolkit.config['ckanext.ldap.base_dn'],
+                ldap.SCOPE_SUBTREE,
+                filterstr=filter_str,
+                attrlist=attributes,
+            )
         if toolkit.config['ckanext.ldap.ignore_referrals']:
             res = [x for x in res if x[0] is not None]
-    except ldap.SERVER_DOWN:
-        log.error('LDAP server is not reachable')
-        return None
     except ldap.OPERATIONS_ERROR as e:
         log.error(
             f'LDAP query failed. Maybe you need auth credentials for performing searches? '
@@ -144,25 +574,75 @@ def ldap_search(cnx, filter_str, attributes, non_unique='raise'):
             raise MultipleMatchError(toolkit.config['ckanext.ldap.search.alt_msg'])
         return None
     elif len(res) == 1:
-        cn = res[0][0]
-        attr = res[0][1]
-        ret = {
-            'cn': cn,
-        }
-
-        # Check required fields
-        for i in ['username', 'email']:
-            cname = 'ckanext.ldap.' + i
-            if toolkit.config[cname] not in attr or not attr[toolkit.config[cname]]:
-                log.error('LDAP search did not return a {}.'.format(i))
-                return None
-        # Set return dict
-        for i in ['username', 'fullname', 'email', 'about']:
-            cname = f'ckanext.ldap.{i}'
-            if cname in toolkit.config and toolkit.config[cname] in attr:
-                v = attr[toolkit.config[cname]]
-                if v:
-                    ret[i] = helpers.decode_str(v[0])
-        return ret
+        return entry_to_user_dict(res[0][0], res[0][1])
     else:
         return None
+
+
+def user_attributes():
+    """
+    Get the LDAP attributes that need to be fetched to create a user dictionary.
+
+    :returns: a list of attribute names
+    """
+    attributes = []
+    for i in ['username', 'fullname', 'email', 'about']:
+        cname = f'ckanext.ldap.{i}'
+        if cname in toolkit.config:
+            attributes.append(toolkit.config[cname])
+    # operational, so it is only returned when asked for
+    attributes.append(ENTRY_UUID)
+    if _member_of_wanted():
+        attributes.append(MEMBER_OF)
+    return attributes
+
+
+def _member_of_wanted():
+    return (
+        bool(toolkit.config.get('ckanext.ldap.groups.mapping'))
+        and toolkit.config['ckanext.ldap.groups.member_of']
+    )
+
+
+def entry_to_user_dict(cn, attr, log_missing=True):
+    """
+    Create a user dictionary from an LDAP entry.
+
+    :param cn: the DN of the entry
+    :param attr: the attributes of the entry, as returned by python-ldap
+    :param log_missing: whether to log an error if a required attribute is missing
+        (Default value = True)
+    :returns: A dictionary defining 'cn', 'username', 'email' and 'fullname', 'about',
+        'entry_uuid' and 'member_of' (the DNs of the user's groups) if they are
+        available; or None if a required attribute is missing.
+    """
+    ret = {
+        'cn': cn,
+    }
+
+    # Check required fields
+    for i in ['username', 'email']:
+        cname = 'ckanext.ldap.' + i
+        if toolkit.config[cname] not in attr or not attr[toolkit.config[cname]]:
+            if log_missing:
+                log.error('LDAP search did not return a {}.'.format(i))
+            return None
+    # Set return dict
+    for i in ['username', 'fullname', 'email', 'about']:
+        cname = f'ckanext.ldap.{i}'
+        if cname in toolkit.config and toolkit.config[cname] in attr:
+            v = attr[toolkit.config[cname]]
+            if v:
+                ret[i] = helpers.decode_str(v[0])
+    if attr.get(ENTRY_UUID):
+        ret['entry_uuid'] = helpers.decode_str(attr[ENTRY_UUID][0])
+    if _member_of_wanted():
+        member_of = next(
+            (values for name, values in attr.items() if name.lower() == 'memberof'),
+            None,
+        )
+        # the attribute is missing if the server doesn't maintain it, or if the user
+        # isn't a member of any groups, in which case the groups are searched for
+        if member_of:
+            ret['member_of'] = [helpers.decode_str(value) for value in member_of]
+    return ret
@@ -0,0 +1,401 @@
+# !/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-ldap
+# Created by the Natural History Museum in London, UK
+
+import logging
+import random
+import threading
+import time
+import weakref
+
+import ldap
+from ckan.plugins import toolkit
+
+from ckanext.ldap.lib import metrics
+from ckanext.ldap.lib.exceptions import NoServerAvailableError
+
+log = logging.getLogger(__name__)
+
+# errors which mean the server (or our connection to it) is unusable
+DISCONNECT_ERRORS = (ldap.SERVER_DOWN, ldap.CONNECT_ERROR, ldap.TIMEOUT)
+
+# the roles servers play: searches, which read replicas can answer, and user binds,
+# which may have to go to the primary (e.g. because of lockout policies)
+SEARCH = 'search'
+BIND = 'bind'
+
+# the weight given to each new measurement in a server's moving average latency
+LATENCY_WEIGHT = 0.2
+
+
+class CircuitBreaker:
+    """
+    Tracks the health of a server so that requests stop waiting on a server which is
+    down.
+
+    The breaker starts closed (requests are allowed). After failure_threshold
+    consecutive failures it opens and requests are refused until cooldown seconds have
+    passed, at which point it is half open: one request is allowed through as a probe.
+    If the probe succeeds the breaker closes again, if it fails the breaker opens for
+    another cooldown.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=3, cooldown=30):
+        """
+        :param failure_threshold: the number of consecutive failures after which the
+            breaker opens (Default value = 3)
+        :param cooldown: seconds to refuse requests for once the breaker has opened
+            (Default value = 30)
+        """
+        self.failure_threshold = max(failure_threshold, 1)
+        self.cooldown = cooldown
+        self.failures = 0
+        self._state = self.CLOSED
+        self._opened = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        """
+        The current state of the breaker, without claiming a probe.
+        """
+        with self._lock:
+            if self._state == self.OPEN and self._cooled_down():
+                return self.HALF_OPEN
+            return self._state
+
+    def _cooled_down(self):
+        return time.monotonic() - self._opened >= self.cooldown
+
+    def allow(self):
+        """
+        Check whether a request may be sent to the server. If the breaker is half open,
+        this claims the single probe request, so the caller must report the outcome
+        using record_success or record_failure.
+
+        :returns: True if the request may go ahead, False if not
+        """
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN and self._cooled_down():
+                self._state = self.HALF_OPEN
+            if self._state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        """
+        Record a successful request, closing the breaker.
+        """
+        with self._lock:
+            self.failures = 0
+            self._state = self.CLOSED
+            self._probing = False
+
+    def record_failure(self):
+        """
+        Record a failed request, opening the breaker if there have been too many.
+
+        :returns: True if this failure opened the breaker, False if not
+        """
+        with self._lock:
+            self.failures += 1
+            was_open = self._state == self.OPEN
+            if self._state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self._state = self.OPEN
+                self._opened = time.monotonic()
+            self._probing = False
+            return self._state == self.OPEN and not was_open
+
+
+class Server:
+    """
+    An LDAP server, the circuit breaker tracking its health and an exponentially
+    weighted moving average of its latency.
+    """
+
+    def __init__(self, uri, breaker):
+        """
+        :param uri: the server's URI
+        :param breaker: the server's CircuitBreaker
+        """
+        self.uri = uri
+        self.breaker = breaker
+        # None until the first measurement
+        self.latency = None
+
+    def __repr__(self):
+        """
+        :returns: the server's URI and the state of its circuit breaker
+        """
+        return f'Server({self.uri!r}, {self.breaker.state})'
+
+    def observe(self, seconds):
+        """
+        Add a latency measurement to the moving average.
+
+        :param seconds: the time a request to the server took
+        """
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency += LATENCY_WEIGHT * (seconds - self.latency)
+
+
+class ServerSet:
+    """
+    A set of interchangeable LDAP servers.
+
+    Requests go to the first server whose circuit breaker is closed, and fail over to
+    the next one if the server is down. Servers whose breaker is open are skipped, so
+    when every server is down requests fail straight away rather than each waiting for
+    the network timeout.
+
+    Servers are tried in the configured order unless the set is balanced, in which case
+    they are picked at random, weighted by the inverse of their observed latency. This
+    sends most requests to nearby servers whilst still measuring the others.
+    """
+
+    def __init__(
+        self,
+        uris,
+        failure_threshold=3,
+        cooldown=30,
+        role=None,
+        balanced=False,
+        rng=None,
+    ):
+        """
+        :param uris: the URIs of the servers, in order of preference
+        :param failure_threshold: see CircuitBreaker (Default value = 3)
+        :param cooldown: see CircuitBreaker (Default value = 30)
+        :param role: the role of the servers, used in metrics and log messages (Default
+            value = None)
+        :param balanced: whether to balance requests by latency rather than using the
+            configured order (Default value = False)
+        :param rng: the random.Random used to balance requests (Default value = a new
+            one)
+        """
+        self.servers = [
+            Server(uri, CircuitBreaker(failure_threshold, cooldown)) for uri in uris
+        ]
+        self.role = role
+        self.balanced = balanced
+        self._rng = rng or random.Random()
+        self._connections = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def ordered(self):
+        """
+        Get the servers in the order they should be tried. Servers which haven't failed
+        recently always come before servers recovering from an outage.
+
+        :returns: a list of Servers
+        """
+        if not self.balanced:
+            # sorting is stable, so this keeps the configured order
+            keys = {server: 0 for server in self.servers}
+        else:
+            with self._lock:
+                measured = [
+                    server.latency
+                    for server in self.servers
+                    if server.latency is not None
+                ]
+                # unmeasured servers are given the same chance as the fastest one
+                fastest = min(measured, default=1.0)
+                keys = {}
+                for server in self.servers:
+                    latency = fastest if server.latency is None else server.latency
+                    # weighted random sampling without replacement (Efraimidis and
+                    # Spirakis), the largest keys come first
+                    weight = 1 / max(latency, 0.0001)
+                    keys[server] = -(self._rng.random() ** (1 / weight))
+        return sorted(
+            self.servers,
+            key=lambda server: (
+                server.breaker.state != CircuitBreaker.CLOSED,
+                keys[server],
+            ),
+        )
+
+    def call(self, function, exclude=()):
+        """
+        Call the given function with each available server in turn (in the order given
+        by ordered) until it doesn't fail with a disconnection error (SERVER_DOWN and
+        friends). The time each call takes is added to the server's latency.
+
+        :param function: a callable taking a Server, which must talk to the server
+            (connecting lazily isn't enough to tell whether it is up)
+        :param exclude: Servers not to try (Default value = ())
+        :raises NoServerAvailableError: if every server's circuit breaker is open (or
+            the server is excluded)
+        :returns: the return value of function
+        """
+        error = None
+        for server in self.ordered():
+            if server in exclude:
+                continue
+            # claims the probe if the breaker is half open, so the outcome must be
+            # recorded
+            if not server.breaker.allow():
+                continue
+            start = time.perf_counter()
+            try:
+                result = function(server)
+            except DISCONNECT_ERRORS as e:
+                self.record_failure(server)
+                error = e
+                continue
+            except BaseException:
+                # the server answered, it just didn't like the request
+                self.record_latency(server, time.perf_counter() - start)
+                server.breaker.record_success()
+                raise
+            self.record_latency(server, time.perf_counter() - start)
+            server.breaker.record_success()
+            return result
+        if error is not None:
+            raise error
+        if not exclude:
+            metrics.count_error('no_server')
+        raise NoServerAvailableError(
+            {'desc': 'No LDAP server available, all circuit breakers are open'}
+        )
+
+    def connect(self, opener, exclude=()):
+        """
+        Open a connection to the first available server.
+
+        :param opener: a callable taking a URI and returning a connection to it, which
+            must have performed an operation (e.g. a bind)
+        :param exclude: connections opened by connect whose servers shouldn't be tried
+            (e.g. because they have just been found to be down) (Default value = ())
+        :raises NoServerAvailableError: if there is no other server to try
+        :returns: the connection
+        """
+
+        def attempt(server):
+            cnx = opener(server.uri)
+            with self._lock:
+                self._connections[cnx] = server
+            return cnx
+
+        excluded = {self.server_for(cnx) for cnx in exclude}
+        return self.call(attempt, exclude=excluded)
+
+    def server_for(self, cnx):
+        """
+        Get the server a connection opened by connect is connected to.
+
+        :param cnx: the connection
+        :returns: a Server or None
+        """
+        with self._lock:
+            return self._connections.get(cnx)
+
+    def record_disconnect(self, cnx):
+        """
+        Record that a connection opened by connect has found its server to be down.
+
+        :param cnx: the connection
+        """
+        server = self.server_for(cnx)
+        if server is not None:
+            self.record_failure(server)
+
+    def record_latency(self, server, seconds):
+        """
+        Record the time a request to the given server took.
+
+        :param server: the Server, or a connection opened by connect
+        :param seconds: the time the request took
+        """
+        if not isinstance(server, Server):
+            server = self.server_for(server)
+            if server is None:
+                return
+        with self._lock:
+            server.observe(seconds)
+        metrics.observe_server(self.role, server.uri, seconds)
+
+    def record_failure(self, server):
+        """
+        Record a failed request to the given server.
+
+        :param server: the Server
+        """
+        metrics.count_server_failure(self.role, server.uri)
+        if server.breaker.record_failure():
+            log.warning(
+                f'LDAP server {server.uri} is down, not using it for '
+                f'{server.breaker.cooldown} seconds'
+            )
+
+
+_servers = {}
+_servers_lock = threading.Lock()
+
+
+def get_uris(role):
+    """
+    Get the URIs of the LDAP servers for the given role, from the
+    ckanext.ldap.<role>.uri option if it is set, otherwise from ckanext.ldap.uri.
+
+    :param role: SEARCH or BIND
+    :returns: a list of URIs
+    """
+    return toolkit.aslist(
+        toolkit.config.get(f'ckanext.ldap.{role}.uri')
+        or toolkit.config.get('ckanext.ldap.uri')
+    )
+
+
+def roles_share_servers():
+    """
+    Check whether searches and user binds go to the same LDAP servers.
+
+    :returns: True if they do, False if not
+    """
+    return get_uris(SEARCH) == get_uris(BIND)
+
+
+def get_servers(role):
+    """
+    Get the process wide set of LDAP servers for the given role, creating it from the
+    config if needed. Search servers are balanced by latency, bind servers are used in
+    the configured order.
+
+    :param role: SEARCH or BIND
+    :returns: a ServerSet
+    """
+    with _servers_lock:
+        if role not in _servers:
+            _servers[role] = ServerSet(
+                get_uris(role),
+                failure_threshold=toolkit.config[
+                    'ckanext.ldap.breaker.failure_threshold'
+                ],
+                cooldown=toolkit.config['ckanext.ldap.breaker.cooldown'],
+                role=role,
+                balanced=role == SEARCH,
+            )
+        return _servers[role]
+
+
+def reset_servers():
+    """
+    Drop the process wide sets of LDAP servers (and their health) so that they are
+    recreated from the current config on next use.
+    """
+    with _servers_lock:
+        _servers.clear()
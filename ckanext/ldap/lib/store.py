@@ -0,0 +1,364 @@
+# !/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-ldap
+# Created by the Natural History Museum in London, UK
+
+import threading
+import time
+
+from ckan.lib.redis import connect_to_redis
+from ckan.plugins import toolkit
+from redis.exceptions import RedisError
+
+from ckanext.ldap.lib.cache import MISSING, TTLCache, redis_key
+from ckanext.ldap.lib.exceptions import StoreError
+
+# the stores that can be chosen with the ckanext.ldap.store option
+STORES = ('memory', 'redis')
+
+
+def refill(tokens, updated, now, capacity, rate):
+    """
+    Take a token from a token bucket, after adding the tokens that have accumulated
+    since it was last updated.
+
+    :param tokens: the number of tokens in the bucket when it was last updated, or None
+        for a new (full) bucket
+    :param updated: when the bucket was last updated
+    :param now: the current time
+    :param capacity: the maximum number of tokens the bucket holds
+    :param rate: the number of tokens added to the bucket per second
+    :returns: a 2-tuple of the number of tokens left in the bucket and the seconds until
+        a token is available (0 if one was taken)
+    """
+    if tokens is None:
+        tokens = capacity
+    else:
+        tokens = min(capacity, tokens + max(0, now - updated) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0
+    return tokens, (1 - tokens) / rate
+
+
+class MemoryStore:
+    """
+    Keeps state in this process.
+
+    Each CKAN process has its own state, so limits apply per process.
+    """
+
+    def __init__(self, max_size=10000):
+        """
+        :param max_size: the maximum number of keys to hold, the least recently used
+            keys are forgotten first (Default value = 10000)
+        """
+        self._buckets = TTLCache(max_size, ttl=0)
+        self._values = TTLCache(max_size, ttl=0)
+        # slot set name -> {token: expiry}
+        self._slots = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, rate):
+        """
+        Take a token from the given token bucket.
+
+        :param key: the name of the bucket
+        :param capacity: the maximum number of tokens the bucket holds
+        :param rate: the number of tokens added to the bucket per second
+        :returns: the seconds until a token is available, 0 if one was taken
+        """
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            tokens, updated = (None, None) if bucket is MISSING else bucket
+            tokens, wait = refill(tokens, updated, now, capacity, rate)
+            # once the bucket is full again it is the same as a new one
+            self._buckets.set(key, (tokens, now), ttl=(capacity - tokens) / rate)
+        return wait
+
+    def get(self, key):
+        """
+        Get the value stored for the given key.
+
+        :param key: the key
+        :returns: the value, or None if there isn't one (or it has expired)
+        """
+        value = self._values.get(key)
+        return None if value is MISSING else value
+
+    def set(self, key, value, ttl):
+        """
+        Store a value for the given key.
+
+        :param key: the key
+        :param value: the value, a string
+        :param ttl: seconds to keep the value for
+        """
+        self._values.set(key, value, ttl=ttl)
+
+    def delete(self, key):
+        """
+        Remove the value stored for the given key, if there is one.
+
+        :param key: the key
+        :returns: True if there was a value, False if not
+        """
+        existed = self.get(key) is not None
+        self._values.pop(key)
+        return existed
+
+    def _live_slots(self, name, now):
+        slots = self._slots.setdefault(name, {})
+        for token, expiry in list(slots.items()):
+            if expiry <= now:
+                del slots[token]
+        return slots
+
+    def acquire(self, name, token, limit, lease):
+        """
+        Take one of a limited number of slots, if there is one free.
+
+        :param name: the name of the set of slots
+        :param token: a unique token identifying the holder of the slot
+        :param limit: the number of slots
+        :param lease: seconds after which the slot is freed if it hasn't been released
+            (e.g. because the process holding it died)
+        :returns: a 2-tuple of whether the slot was taken and the number of slots in use
+        """
+        now = time.monotonic()
+        with self._lock:
+            slots = self._live_slots(name, now)
+            if len(slots) >= limit:
+                return False, len(slots)
+            slots[token] = now + lease
+            return True, len(slots)
+
+    def release(self, name, token):
+        """
+        Free a slot taken using acquire.
+
+        :param name: the name of the set of slots
+        :param token: the token used to take the slot
+        :returns: the number of slots still in use
+        """
+        with self._lock:
+            slots = self._live_slots(name, time.monotonic())
+            slots.pop(token, None)
+            return len(slots)
+
+    def count(self, name):
+        """
+        Count the slots in use.
+
+        :param name: the name of the set of slots
+        :returns: the number of slots in use
+        """
+        with self._lock:
+            return len(self._live_slots(name, time.monotonic()))
+
+
+class RedisStore:
+    """
+    Keeps state in redis, so that limits apply across all the CKAN processes sharing the
+    redis database.
+    """
+
+    # the same algorithm as refill, run atomically in redis
+    TAKE_SCRIPT = """
+    local capacity = tonumber(ARGV[1])
+    local rate = tonumber(ARGV[2])
+    local now = tonumber(ARGV[3])
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+    local tokens = tonumber(bucket[1])
+    if tokens == nil then
+        tokens = capacity
+    else
+        local elapsed = math.max(0, now - tonumber(bucket[2]))
+        tokens = math.min(capacity, tokens + elapsed * rate)
+    end
+    local wait = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+    else
+        wait = (1 - tokens) / rate
+    end
+    redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+    redis.call('PEXPIRE', KEYS[1], math.ceil((capacity - tokens) / rate * 1000) + 1)
+    return tostring(wait)
+    """
+
+    # slots are the members of a sorted set, scored by when their lease expires
+    ACQUIRE_SCRIPT = """
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+    local count = redis.call('ZCARD', KEYS[1])
+    if count >= tonumber(ARGV[2]) then
+        return {0, count}
+    end
+    redis.call('ZADD', KEYS[1], ARGV[1] + ARGV[3], ARGV[4])
+    redis.call('PEXPIRE', KEYS[1], math.ceil(ARGV[3] * 1000))
+    return {1, count + 1}
+    """
+
+    def __init__(self):
+        """
+        The scripts are registered with redis on first use.
+        """
+        self._take = None
+        self._acquire = None
+
+    def _slots_key(self, name):
+        return redis_key('slots', name)
+
+    def _live_count(self, pipeline, name):
+        pipeline.zremrangebyscore(self._slots_key(name), '-inf', time.time())
+        pipeline.zcard(self._slots_key(name))
+
+    def take(self, key, capacity, rate):
+        """
+        Take a token from the given token bucket.
+
+        :param key: the name of the bucket
+        :param capacity: the maximum number of tokens the bucket holds
+        :param rate: the number of tokens added to the bucket per second
+        :raises StoreError: if redis can't be reached
+        :returns: the seconds until a token is available, 0 if one was taken
+        """
+        try:
+            if self._take is None:
+                self._take = connect_to_redis().register_script(self.TAKE_SCRIPT)
+            # wall clock time as it has to be comparable between servers
+            wait = self._take(
+                keys=[redis_key('bucket', key)], args=[capacity, rate, time.time()]
+            )
+        except RedisError as e:
+            raise StoreError(f'Could not update {key} in redis: {e}') from e
+        return float(wait)
+
+    def get(self, key):
+        """
+        Get the value stored for the given key.
+
+        :param key: the key
+        :raises StoreError: if redis can't be reached
+        :returns: the value, or None if there isn't one (or it has expired)
+        """
+        try:
+            value = connect_to_redis().get(redis_key('value', key))
+        except RedisError as e:
+            raise StoreError(f'Could not get {key} from redis: {e}') from e
+        return value.decode('utf-8') if isinstance(value, bytes) else value
+
+    def set(self, key, value, ttl):
+        """
+        Store a value for the given key.
+
+        :param key: the key
+        :param value: the value, a string
+        :param ttl: seconds to keep the value for
+        :raises StoreError: if redis can't be reached
+        """
+        try:
+            connect_to_redis().set(redis_key('value', key), value, ex=ttl)
+        except RedisError as e:
+            raise StoreError(f'Could not set {key} in redis: {e}') from e
+
+    def delete(self, key):
+        """
+        Remove the value stored for the given key, if there is one.
+
+        :param key: the key
+        :raises StoreError: if redis can't be reached
+        :returns: True if there was a value, False if not
+        """
+        try:
+            return bool(connect_to_redis().delete(redis_key('value', key)))
+        except RedisError as e:
+            raise StoreError(f'Could not delete {key} from redis: {e}') from e
+
+    def acquire(self, name, token, limit, lease):
+        """
+        Take one of a limited number of slots, if there is one free.
+
+        :param name: the name of the set of slots
+        :param token: a unique token identifying the holder of the slot
+        :param limit: the number of slots
+        :param lease: seconds after which the slot is freed if it hasn't been released
+            (e.g. because the process holding it died)
+        :raises StoreError: if redis can't be reached
+        :returns: a 2-tuple of whether the slot was taken and the number of slots in use
+        """
+        try:
+            if self._acquire is None:
+                self._acquire = connect_to_redis().register_script(self.ACQUIRE_SCRIPT)
+            taken, count = self._acquire(
+                keys=[self._slots_key(name)], args=[time.time(), limit, lease, token]
+            )
+        except RedisError as e:
+            raise StoreError(f'Could not acquire a {name} slot in redis: {e}') from e
+        return bool(taken), int(count)
+
+    def release(self, name, token):
+        """
+        Free a slot taken using acquire.
+
+        :param name: the name of the set of slots
+        :param token: the token used to take the slot
+        :raises StoreError: if redis can't be reached
+        :returns: the number of slots still in use
+        """
+        try:
+            pipeline = connect_to_redis().pipeline()
+            pipeline.zrem(self._slots_key(name), token)
+            self._live_count(pipeline, name)
+            return int(pipeline.execute()[-1])
+        except RedisError as e:
+            raise StoreError(f'Could not release a {name} slot in redis: {e}') from e
+
+    def count(self, name):
+        """
+        Count the slots in use.
+
+        :param name: the name of the set of slots
+        :raises StoreError: if redis can't be reached
+        :returns: the number of slots in use
+        """
+        try:
+            pipeline = connect_to_redis().pipeline()
+            self._live_count(pipeline, name)
+            return int(pipeline.execute()[-1])
+        except RedisError as e:
+            raise StoreError(f'Could not count {name} slots in redis: {e}') from e
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """
+    Get the process wide store chosen by the ckanext.ldap.store option, creating it if
+    needed.
+
+    :returns: a MemoryStore or RedisStore
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            if toolkit.config['ckanext.ldap.store'] == 'redis':
+                _store = RedisStore()
+            else:
+                _store = MemoryStore(toolkit.config['ckanext.ldap.store.size'])
+        return _store
+
+
+def reset_store():
+    """
+    Drop the process wide store so that it is recreated (with the current config) on
+    next use.
+
+    The memory store's state is lost.
+    """
+    global _store
+    with _store_lock:
+        _store = None
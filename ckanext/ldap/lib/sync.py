@@ -0,0 +1,1045 @@
+# !/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-ldap
+# Created by the Natural History Museum in London, UK
+
+import logging
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
+from itertools import islice
+
+import ldap
+import ldap.syncrepl
+from ckan import model
+from ckan.model import Session, User
+from ckan.plugins import toolkit
+from ldap.controls import SimplePagedResultsControl
+from ldap.ldapobject import LDAPObject
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+from ckanext.ldap.lib import groups, helpers
+from ckanext.ldap.lib.pool import close_connection, connect
+from ckanext.ldap.lib.search import entry_to_user_dict, normalise_dn, user_attributes
+from ckanext.ldap.lib.servers import SEARCH, get_servers
+from ckanext.ldap.model.ldap_sync_state import LdapSyncState
+from ckanext.ldap.model.ldap_user import LdapUser
+from ckanext.ldap.routes._helpers import (
+    PROFILE_FIELDS,
+    add_to_organization,
+    create_user,
+    get_attributes_digest,
+    get_unique_user_name,
+)
+
+log = logging.getLogger(__name__)
+
+# matches the common kinds of group entry
+GROUP_FILTER = (
+    '(|(objectClass=groupOfNames)(objectClass=groupOfUniqueNames)(objectClass=group))'
+)
+
+# a change to a user's role in an organization, or to whether they are a sysadmin (when
+# organization_id is groups.SYSADMIN). old is None for additions and new is None for
+# removals
+MembershipChange = namedtuple(
+    'MembershipChange', ['organization_id', 'user_id', 'old', 'new']
+)
+
+
+def default_filter():
+    """
+    Get the filter which matches every user in the directory, which is the configured
+    search filter with the login replaced by a wildcard.
+
+    :returns: the filter string
+    """
+    return toolkit.config['ckanext.ldap.search.filter'].format(login='*')
+
+
+def iter_entries(cnx, filter_str, attributes, page_size=500, base_dn=None):
+    """
+    Search the directory using the RFC 2696 paged results control, yielding the entries
+    as the pages arrive so that the whole result set is never held in memory.
+
+    :param cnx: The LDAP connection object
+    :param filter_str: The LDAP filter string
+    :param attributes: The LDAP attributes to fetch
+    :param page_size: the number of entries to request per page (Default value = 500)
+    :param base_dn: the DN to search under (Default value = ckanext.ldap.base_dn)
+    :returns: a generator of (dn, attributes) tuples
+    """
+    control = SimplePagedResultsControl(True, size=page_size, cookie='')
+    while True:
+        msgid = cnx.search_ext(
+            base_dn or toolkit.config['ckanext.ldap.base_dn'],
+            ldap.SCOPE_SUBTREE,
+            filterstr=filter_str,
+            attrlist=attributes,
+            serverctrls=[control],
+        )
+        _, data, _, controls = cnx.result3(msgid)
+        for dn, attr in data:
+            # skip referrals
+            if dn is not None:
+                yield dn, attr
+        cookie = next(
+            (
+                c.cookie
+                for c in controls
+                if c.controlType == SimplePagedResultsControl.controlType
+            ),
+            None,
+        )
+        if not cookie:
+            break
+        control.cookie = cookie
+
+
+class HighWaterMark:
+    """
+    Tracks the highest modifyTimestamp seen on a set of entries, held back to the
+    earliest entry which couldn't be applied so that it is fetched again next time.
+    """
+
+    attribute = 'modifyTimestamp'
+    # the key the entry's modifyTimestamp is stored under in its user dictionary
+    key = 'modify_timestamp'
+
+    def __init__(self, value=None):
+        """
+        :param value: the high water mark of the last sync (Default value = None)
+        """
+        self.value = value
+        self.start = value
+        self._held = []
+        self._lock = threading.Lock()
+
+    def update(self, attr):
+        """
+        Update the high water mark from the attributes of an entry.
+
+        :param attr: the attributes of the entry, as returned by python-ldap
+        :returns: the entry's modifyTimestamp, or None if it doesn't have one
+        """
+        timestamp = None
+        for name, values in attr.items():
+            if name.lower() == self.attribute.lower():
+                for value in values:
+                    value = helpers.decode_str(value)
+                    # generalized times from one server sort lexically
+                    if timestamp is None or value > timestamp:
+                        timestamp = value
+        if timestamp is not None and (self.value is None or timestamp > self.value):
+            self.value = timestamp
+        return timestamp
+
+    def hold(self, ldap_user_dict):
+        """
+        Record that an entry couldn't be applied, so that the mark doesn't move past it.
+        This is safe to call from several threads.
+
+        :param ldap_user_dict: the entry's user dictionary, as yielded by
+            iter_user_dicts
+        """
+        with self._lock:
+            self._held.append(ldap_user_dict.get(self.key))
+
+    def safe_value(self):
+        """
+        Get the value to store for the next incremental sync. This is the highest
+        modifyTimestamp seen unless some entries couldn't be applied, in which case it
+        is the earliest of their timestamps (or the starting value if any of them had
+        none).
+
+        :returns: the generalized time string, or None
+        """
+        if not self._held:
+            return self.value
+        if None in self._held:
+            return self.start
+        return min(self._held)
+
+
+def iter_user_dicts(
+    cnx, filter_str=None, page_size=500, stats=None, high_water_mark=None
+):
+    """
+    Yield a user dictionary (see search.entry_to_user_dict) for every user in the
+    directory.
+
+    :param cnx: The LDAP connection object
+    :param filter_str: The LDAP filter string (Default value = default_filter())
+    :param page_size: the number of entries to request per page (Default value = 500)
+    :param stats: a Counter in which entries missing required attributes are counted as
+        'skipped' (Default value = None)
+    :param high_water_mark: a HighWaterMark to update with the modifyTimestamp of each
+        entry, which is also stored in the user dictionary under HighWaterMark.key
+        (Default value = None)
+    :returns: a generator of user dictionaries
+    """
+    attributes = user_attributes()
+    if high_water_mark is not None:
+        attributes.append(HighWaterMark.attribute)
+    for dn, attr in iter_entries(
+        cnx, filter_str or default_filter(), attributes, page_size
+    ):
+        timestamp = None
+        if high_water_mark is not None:
+            timestamp = high_water_mark.update(attr)
+        ldap_user_dict = entry_to_user_dict(dn, attr, log_missing=False)
+        if ldap_user_dict is None:
+            if stats is not None:
+                stats['skipped'] += 1
+            continue
+        if high_water_mark is not None:
+            ldap_user_dict[HighWaterMark.key] = timestamp
+        yield ldap_user_dict
+
+
+def sync_directory(
+    filter_str=None, page_size=500, batch_size=500, workers=1, incremental=False
+):
+    """
+    Create or update a CKAN user for every user in the directory.
+
+    The highest modifyTimestamp seen is recorded against the base DN so that later
+    incremental runs only need to fetch the entries that have changed since. If some
+    entries couldn't be applied (conflicts and errors) the mark stops at the earliest of
+    them so that they are fetched again.
+
+    :param filter_str: The LDAP filter string (Default value = default_filter())
+    :param page_size: the number of entries to request per page (Default value = 500)
+    :param batch_size: the number of users to write per transaction (Default value =
+        500)
+    :param workers: the number of threads writing batches (Default value = 1)
+    :param incremental: only fetch the entries modified since the last sync (Default
+        value = False)
+    :returns: a Counter of outcomes
+    """
+    filter_str = filter_str or default_filter()
+    state = LdapSyncState.get_for(toolkit.config['ckanext.ldap.base_dn'], filter_str)
+    search_filter = filter_str
+    if incremental and state.modify_timestamp:
+        # >= rather than > so that changes made in the same second as the last entry we
+        # saw aren't missed, applying an entry twice is harmless
+        search_filter = (
+            f'(&{_parenthesise(filter_str)}'
+            f'({HighWaterMark.attribute}>={state.modify_timestamp}))'
+        )
+    high_water_mark = HighWaterMark(state.modify_timestamp)
+
+    stats = Counter()
+    cnx = connect(role=SEARCH)
+    try:
+        stats.update(
+            sync_users(
+                iter_user_dicts(cnx, search_filter, page_size, stats, high_water_mark),
+                batch_size=batch_size,
+                workers=workers,
+                on_failure=high_water_mark.hold,
+            )
+        )
+    finally:
+        close_connection(cnx)
+
+    state.modify_timestamp = high_water_mark.safe_value()
+    Session.add(state)
+    Session.commit()
+    return stats
+
+
+class SyncreplConsumer(LDAPObject, ldap.syncrepl.SyncreplConsumer):
+    """
+    An LDAP connection which applies the changes sent by the server during an RFC 4533
+    content synchronisation to the CKAN users.
+
+    Changed entries are written in batches and the sync cookie is only stored once the
+    entries before it have been written.
+    """
+
+    def __init__(self, uri, state, batch_size=500, workers=1, **kwargs):
+        """
+        :param uri: the URI to connect to
+        :param state: the LdapSyncState holding the cookie
+        :param batch_size: the number of users to write per transaction (Default value =
+            500)
+        :param workers: the number of threads writing batches (Default value = 1)
+        :param kwargs: passed on to LDAPObject
+        """
+        super().__init__(uri, **kwargs)
+        self.state = state
+        self.batch_size = batch_size
+        self.workers = workers
+        self.stats = Counter()
+        self._pending = []
+        self._cookie = None
+
+    def syncrepl_get_cookie(self):
+        """
+        Get the cookie stored by the last sync, to resume from.
+
+        :returns: the cookie, or None to start from scratch
+        """
+        return self.state.cookie
+
+    def syncrepl_set_cookie(self, cookie):
+        """
+        Remember a new cookie from the server. It is stored by the next flush, once the
+        entries sent before it have been written.
+
+        :param cookie: the cookie
+        """
+        self._cookie = helpers.decode_str(cookie)
+
+    def syncrepl_entry(self, dn, attributes, uuid):
+        """
+        Queue an added or changed entry for writing, writing the queue if it is a full
+        batch.
+
+        :param dn: the entry's DN
+        :param attributes: the entry's attributes
+        :param uuid: the entry's entryUUID
+        """
+        ldap_user_dict = entry_to_user_dict(dn, attributes, log_missing=False)
+        if ldap_user_dict is None:
+            self.stats['skipped'] += 1
+            return
+        self._pending.append(ldap_user_dict)
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def syncrepl_delete(self, uuids):
+        """
+        Count deleted entries.
+
+        :param uuids: the entryUUIDs of the deleted entries
+        """
+        # CKAN users are never deleted by the sync, the entries just won't be found when
+        # the users try to log in
+        self.stats['deleted'] += len(uuids)
+
+    def syncrepl_present(self, uuids, refreshDeletes=False):
+        """
+        Ignore the entries the server reports as unchanged.
+
+        :param uuids: the entryUUIDs of the entries
+        :param refreshDeletes: whether the server is reporting deletions instead
+            (Default value = False)
+        """
+        pass
+
+    def syncrepl_refreshdone(self):
+        """
+        Write the pending changes once the refresh phase is over.
+        """
+        log.info('LDAP sync refresh phase complete')
+        self.flush()
+
+    def flush(self):
+        """
+        Write the pending changes and then store the latest cookie.
+        """
+        if self._pending:
+            pending, self._pending = self._pending, []
+            self.stats.update(
+                sync_users(pending, batch_size=self.batch_size, workers=self.workers)
+            )
+        if self._cookie is not None and self._cookie != self.state.cookie:
+            self.state.cookie = self._cookie
+            Session.add(self.state)
+            Session.commit()
+
+
+def sync_replication(
+    filter_str=None, persist=False, batch_size=500, workers=1, flush_interval=10
+):
+    """
+    Apply the changes made to the directory since the last run using RFC 4533 content
+    synchronisation (syncrepl). The first run fetches every entry.
+
+    :param filter_str: The LDAP filter string (Default value = default_filter())
+    :param persist: keep running and apply changes as the server sends them
+        (refreshAndPersist) rather than stopping once the changes so far have been
+        applied (refreshOnly) (Default value = False)
+    :param batch_size: the number of users to write per transaction (Default value =
+        500)
+    :param workers: the number of threads writing batches (Default value = 1)
+    :param flush_interval: when persisting, the maximum number of seconds to hold
+        changes before writing them (Default value = 10)
+    :returns: a Counter of outcomes
+    """
+    filter_str = filter_str or default_filter()
+    base_dn = toolkit.config['ckanext.ldap.base_dn']
+    state = LdapSyncState.get_for(base_dn, filter_str)
+    stats = Counter()
+    while True:
+        try:
+            consumer = connect(
+                factory=partial(
+                    SyncreplConsumer,
+                    state=state,
+                    batch_size=batch_size,
+                    workers=workers,
+                ),
+                role=SEARCH,
+            )
+        except ldap.SERVER_DOWN:
+            if not persist:
+                raise
+            log.warning('No LDAP server is available for sync, retrying')
+            time.sleep(flush_interval)
+            continue
+        try:
+            msgid = consumer.syncrepl_search(
+                base_dn,
+                ldap.SCOPE_SUBTREE,
+                mode='refreshAndPersist' if persist else 'refreshOnly',
+                filterstr=filter_str,
+                attrlist=user_attributes(),
+            )
+            while True:
+                try:
+                    if not consumer.syncrepl_poll(
+                        msgid=msgid,
+                        all=0 if persist else 1,
+                        timeout=flush_interval if persist else -1,
+                    ):
+                        break
+                except ldap.TIMEOUT:
+                    consumer.flush()
+            consumer.flush()
+            return stats + consumer.stats
+        except KeyboardInterrupt:
+            consumer.flush()
+            return stats + consumer.stats
+        except ldap.SERVER_DOWN:
+            if not persist:
+                raise
+            # carry on from the last stored cookie once the server is back
+            get_servers(SEARCH).record_disconnect(consumer)
+            consumer.flush()
+            stats += consumer.stats
+            log.warning('LDAP server went away during sync, reconnecting')
+            time.sleep(flush_interval)
+        finally:
+            close_connection(consumer)
+
+
+def _parenthesise(filter_str):
+    return filter_str if filter_str.startswith('(') else f'({filter_str})'
+
+
+def sync_users(ldap_user_dicts, batch_size=500, workers=1, on_failure=None):
+    """
+    Create or update the CKAN users for the given LDAP user dictionaries, updating them
+    in batches of batch_size with one transaction per batch. New users are created one
+    at a time with the user_create action, as at login. If workers is more than 1,
+    batches are written in parallel by that many threads (each with its own database
+    session).
+
+    :param ldap_user_dicts: an iterable of user dictionaries
+    :param batch_size: the number of users to write per transaction (Default value =
+        500)
+    :param workers: the number of threads writing batches (Default value = 1)
+    :param on_failure: a function called with each user dictionary which couldn't be
+        applied, from the thread writing it (Default value = None)
+    :returns: a Counter of outcomes ('created', 'updated', 'unchanged', 'migrated',
+        'conflicts' and 'errors')
+    """
+    stats = Counter()
+    organization_id = _get_organization_id()
+    batches = _batched(ldap_user_dicts, batch_size)
+
+    if workers <= 1:
+        for batch in batches:
+            stats.update(_sync_batch(batch, organization_id, on_failure))
+        return stats
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for batch in batches:
+            pending.add(
+                executor.submit(_sync_batch_thread, batch, organization_id, on_failure)
+            )
+            # don't read the directory faster than we can write the users
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stats.update(future.result())
+        for future in pending:
+            stats.update(future.result())
+    return stats
+
+
+def _batched(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _get_organization_id():
+    organization_id = toolkit.config.get('ckanext.ldap.organization.id')
+    if not organization_id:
+        return None
+    organization = model.Group.get(organization_id)
+    if organization is None:
+        raise toolkit.ObjectNotFound(f'Organization {organization_id} not found')
+    return organization.id
+
+
+def _sync_batch_thread(batch, organization_id, on_failure=None):
+    try:
+        return _sync_batch(batch, organization_id, on_failure)
+    finally:
+        # each thread has its own scoped session
+        Session.remove()
+
+
+def _sync_batch(batch, organization_id, on_failure=None):
+    """
+    Write a batch of existing users in one transaction, then create the new ones.
+
+    If the transaction fails because of an integrity error (e.g. a name taken by another
+    worker in the meantime) the users in the batch are retried one at a time.
+    """
+    try:
+        stats, new_users = _apply_batch(batch, on_failure)
+        Session.commit()
+    except IntegrityError as e:
+        Session.rollback()
+        if len(batch) == 1:
+            log.warning(f'Could not sync LDAP user {batch[0]["username"]}: {e}')
+            if on_failure is not None:
+                on_failure(batch[0])
+            return Counter(errors=1)
+        stats = Counter()
+        for ldap_user_dict in batch:
+            stats.update(_sync_batch([ldap_user_dict], organization_id, on_failure))
+        return stats
+    for ldap_user_dict, digest in new_users:
+        try:
+            _create_user(ldap_user_dict, digest, organization_id)
+            stats['created'] += 1
+        except (toolkit.ValidationError, SQLAlchemyError) as e:
+            Session.rollback()
+            log.warning(f'Could not create LDAP user {ldap_user_dict["username"]}: {e}')
+            stats['errors'] += 1
+            if on_failure is not None:
+                on_failure(ldap_user_dict)
+    return stats
+
+
+def _apply_batch(batch, on_failure=None):
+    stats = Counter()
+    # created one at a time with the actions once the batch is written
+    new_users = []
+    ldap_ids = [ldap_user_dict['username'] for ldap_user_dict in batch]
+    digests = [get_attributes_digest(ldap_user_dict) for ldap_user_dict in batch]
+    existing = {
+        ldap_user.ldap_id: ldap_user
+        for ldap_user in Session.query(LdapUser).filter(LdapUser.ldap_id.in_(ldap_ids))
+    }
+    # load the users whose attributes have changed with one query, the rest are never
+    # touched
+    changed_ids = [
+        existing[ldap_id].user_id
+        for ldap_id, digest in zip(ldap_ids, digests)
+        if ldap_id in existing and existing[ldap_id].attributes_digest != digest
+    ]
+    users = (
+        {user.id: user for user in Session.query(User).filter(User.id.in_(changed_ids))}
+        if changed_ids
+        else {}
+    )
+    # CKAN users which have the LDAP name of a user we are about to add
+    same_name = {
+        user.name: user
+        for user in Session.query(User).filter(
+            User.name.in_([i for i in ldap_ids if i not in existing])
+        )
+    }
+    ldap_backed = {
+        user_id
+        for (user_id,) in Session.query(LdapUser.user_id).filter(
+            LdapUser.user_id.in_([user.id for user in same_name.values()])
+        )
+    }
+
+    for ldap_user_dict, digest in zip(batch, digests):
+        ldap_id = ldap_user_dict['username']
+        ldap_user = existing.get(ldap_id)
+        location = {
+            'dn': ldap_user_dict['cn'],
+            'entry_uuid': ldap_user_dict.get('entry_uuid'),
+        }
+        if ldap_user is not None:
+            changed = False
+            if ldap_user.attributes_digest != digest:
+                changed = _update_user(users[ldap_user.user_id], ldap_user_dict)
+                ldap_user.attributes_digest = digest
+            ldap_user.dn = location['dn']
+            ldap_user.entry_uuid = location['entry_uuid']
+            stats['updated' if changed else 'unchanged'] += 1
+            continue
+
+        user = same_name.get(ldap_id)
+        if user is not None and user.id not in ldap_backed:
+            # same rules as get_or_create_ldap_user
+            if not toolkit.config['ckanext.ldap.migrate']:
+                log.warning(f'Username conflict for LDAP user {ldap_id}, skipping')
+                stats['conflicts'] += 1
+                if on_failure is not None:
+                    on_failure(ldap_user_dict)
+                continue
+            _update_user(user, ldap_user_dict)
+            Session.add(
+                LdapUser(
+                    user_id=user.id,
+                    ldap_id=ldap_id,
+                    attributes_digest=digest,
+                    **location,
+                )
+            )
+            stats['migrated'] += 1
+            continue
+
+        new_users.append((ldap_user_dict, digest))
+    return stats, new_users
+
+
+def _create_user(ldap_user_dict, digest, organization_id):
+    """
+    Create the CKAN user of a new LDAP user with the user_create and member_create
+    actions, as a login does, so that they get activities, are seen by IUser plugins and
+    are indexed.
+    """
+    ldap_id = ldap_user_dict['username']
+    user_dict = {
+        'name': get_unique_user_name(ldap_id),
+        'email': ldap_user_dict['email'],
+        'password': str(uuid.uuid4()),
+    }
+    for field in ('fullname', 'about'):
+        if field in ldap_user_dict:
+            user_dict[field] = ldap_user_dict[field]
+    user = create_user(user_dict, ldap_id)
+    Session.add(
+        LdapUser(
+            user_id=user['id'],
+            ldap_id=ldap_id,
+            attributes_digest=digest,
+            dn=ldap_user_dict['cn'],
+            entry_uuid=ldap_user_dict.get('entry_uuid'),
+        )
+    )
+    Session.commit()
+    if organization_id:
+        add_to_organization(
+            user['id'],
+            organization_id,
+            toolkit.config['ckanext.ldap.organization.role'],
+        )
+
+
+def _update_user(user, ldap_user_dict):
+    """
+    Copy the LDAP attributes onto the given User object.
+
+    :returns: True if anything changed, False if not
+    """
+    changed = False
+    for field in PROFILE_FIELDS:
+        if field in ldap_user_dict and getattr(user, field) != ldap_user_dict[field]:
+            setattr(user, field, ldap_user_dict[field])
+            changed = True
+    return changed
+
+
+def iter_groups(cnx, filter_str=GROUP_FILTER, member_attribute='member', page_size=500):
+    """
+    Yield every group under ckanext.ldap.groups.base_dn with its members, using paged
+    searches.
+
+    :param cnx: The LDAP connection object
+    :param filter_str: the filter matching the groups (Default value = GROUP_FILTER)
+    :param member_attribute: the attribute holding the DNs of a group's members (Default
+        value = 'member')
+    :param page_size: the number of entries to request per page (Default value = 500)
+    :returns: a generator of 2-tuples of the normalised DN of the group and a set of the
+        normalised DNs of its members
+    """
+    for dn, attr in iter_entries(
+        cnx,
+        filter_str,
+        [member_attribute],
+        page_size,
+        base_dn=toolkit.config.get('ckanext.ldap.groups.base_dn'),
+    ):
+        members = next(
+            (
+                values
+                for name, values in attr.items()
+                if name.lower() == member_attribute.lower()
+            ),
+            [],
+        )
+        yield (
+            normalise_dn(dn),
+            {normalise_dn(helpers.decode_str(member)) for member in members},
+        )
+
+
+class GroupResolver:
+    """
+    Resolves the members of groups, including (if nested is set) the members of the
+    groups which are members of them.
+
+    Each group is only resolved once.
+    """
+
+    def __init__(self, graph, nested=False):
+        """
+        :param graph: a dictionary of normalised group DNs to sets of the normalised DNs
+            of their members
+        :param nested: whether to include the members of member groups (Default value =
+            False)
+        """
+        self.graph = graph
+        self.nested = nested
+        self._resolved = {}
+
+    def members(self, group_dn):
+        """
+        Get the members of the given group.
+
+        :param group_dn: the normalised DN of the group
+        :returns: a frozenset of normalised member DNs
+        """
+        return self._resolve(group_dn, ())[0]
+
+    def _resolve(self, group_dn, path):
+        if group_dn in self._resolved:
+            return self._resolved[group_dn], True
+        members = set(self.graph.get(group_dn, ()))
+        # whether the result is the group's full membership, which it isn't if a cycle
+        # was cut short (the groups further up the path add the missing members)
+        complete = True
+        if self.nested:
+            path = path + (group_dn,)
+            for member in list(members):
+                if member not in self.graph:
+                    continue
+                if member in path:
+                    complete = False
+                    continue
+                member_members, member_complete = self._resolve(member, path)
+                members.update(member_members)
+                complete = complete and member_complete
+        members = frozenset(members)
+        if complete:
+            self._resolved[group_dn] = members
+        return members, complete
+
+
+def plan_group_sync(graph):
+    """
+    Work out the changes needed to make the organization memberships (and sysadmin
+    status) of LDAP users match the groups in the directory and
+    ckanext.ldap.groups.mapping.
+
+    Members are matched to CKAN users by the DN stored for them when they last logged in
+    or were synced. As at login, only the organizations in the mapping are changed,
+    users who aren't LDAP users (or whose DN isn't known) are left alone, and users are
+    never removed from ckanext.ldap.organization.id. If a mapped group isn't in the
+    directory, nobody is removed from the organizations it maps to. Sysadmin status is
+    only taken away if ckanext.ldap.groups.manage_sysadmin is set.
+
+    :param graph: a dictionary of normalised group DNs to sets of the normalised DNs of
+        their members, as yielded by iter_groups
+    :returns: a 2-tuple of a Counter of statistics and a list of MembershipChanges
+    """
+    mapping = groups.get_mapping()
+    resolver = GroupResolver(graph, toolkit.config['ckanext.ldap.groups.nested'])
+    stats = Counter(groups=len(graph))
+
+    located = {
+        normalise_dn(dn): user_id
+        for user_id, dn in Session.query(LdapUser.user_id, LdapUser.dn)
+        .join(User, User.id == LdapUser.user_id)
+        .filter(LdapUser.dn.isnot(None), User.state != 'deleted')
+    }
+    managed = set(located.values())
+    stats['unlocated_users'] = (
+        Session.query(LdapUser.id).filter(LdapUser.dn.is_(None)).count()
+    )
+    organization_ids, default_id = groups.resolve_organizations(mapping)
+
+    desired = defaultdict(dict)
+    sysadmins = set()
+    # the organizations (and groups.SYSADMIN) nobody can safely be removed from
+    incomplete = set()
+    unknown_members = set()
+    missing_organizations = set()
+    for group_dn, targets in mapping.items():
+        if group_dn not in graph:
+            log.warning(f'Mapped group {group_dn} not found in the directory')
+            stats['missing_groups'] += 1
+            incomplete.update(
+                target if target == groups.SYSADMIN else organization_ids.get(target[0])
+                for target in targets
+            )
+            continue
+        user_ids = set()
+        for member in resolver.members(group_dn):
+            if member in located:
+                user_ids.add(located[member])
+            elif member not in graph:
+                unknown_members.add(member)
+        for target in targets:
+            if target == groups.SYSADMIN:
+                sysadmins.update(user_ids)
+                continue
+            organization, capacity = target
+            if organization not in organization_ids:
+                missing_organizations.add(organization)
+                continue
+            roles = desired[organization_ids[organization]]
+            for user_id in user_ids:
+                roles[user_id] = groups.highest(capacity, roles.get(user_id))
+    for organization in sorted(missing_organizations):
+        log.warning(f'Organization {organization} in the group mapping not found')
+    stats['missing_organizations'] = len(missing_organizations)
+    stats['unknown_members'] = len(unknown_members)
+
+    changes = []
+    for organization_id in sorted(set(organization_ids.values())):
+        current = groups.get_organization_members(organization_id)
+        if organization_id == default_id or organization_id in incomplete:
+            keep = set(current)
+        else:
+            keep = {user_id for user_id in current if user_id not in managed}
+        to_set, to_remove = groups.diff_memberships(
+            current, desired.get(organization_id, {}), keep=keep
+        )
+        for user_id, capacity in sorted(to_set.items()):
+            changes.append(
+                MembershipChange(
+                    organization_id, user_id, current.get(user_id), capacity
+                )
+            )
+        for user_id in sorted(to_remove):
+            changes.append(
+                MembershipChange(organization_id, user_id, current[user_id], None)
+            )
+
+    if groups.manages_sysadmin(mapping):
+        current = {
+            user_id
+            for (user_id,) in Session.query(User.id)
+            .join(LdapUser, LdapUser.user_id == User.id)
+            .filter(User.sysadmin == True, User.state != 'deleted')  # noqa: E712
+        }
+        for user_id in sorted(sysadmins - current):
+            changes.append(
+                MembershipChange(groups.SYSADMIN, user_id, None, groups.SYSADMIN)
+            )
+        if groups.revokes_sysadmin(mapping) and groups.SYSADMIN not in incomplete:
+            for user_id in sorted((current & managed) - sysadmins):
+                changes.append(
+                    MembershipChange(groups.SYSADMIN, user_id, groups.SYSADMIN, None)
+                )
+
+    for change in changes:
+        stats[_change_kind(change)] += 1
+    return stats, changes
+
+
+def _change_kind(change):
+    if change.organization_id == groups.SYSADMIN:
+        return 'sysadmin_granted' if change.new else 'sysadmin_revoked'
+    if change.old is None:
+        return 'added'
+    if change.new is None:
+        return 'removed'
+    return 'changed'
+
+
+def apply_membership_changes(changes, batch_size=500):
+    """
+    Make the given changes, writing them in batches of batch_size with one transaction
+    per batch. The members table is written directly, so no activities are created.
+
+    :param changes: an iterable of MembershipChanges
+    :param batch_size: the number of changes to write per transaction (Default value =
+        500)
+    :returns: a Counter of the number of changes 'applied' and the number of 'errors'
+    """
+    stats = Counter()
+    for batch in _batched(changes, batch_size):
+        try:
+            _apply_membership_batch(batch)
+            Session.commit()
+            stats['applied'] += len(batch)
+        except SQLAlchemyError as e:
+            Session.rollback()
+            log.warning(f'Could not apply a batch of {len(batch)} changes: {e}')
+            stats['errors'] += len(batch)
+    return stats
+
+
+def _apply_membership_batch(batch):
+    """
+    Write a batch of changes with one statement per kind of change (and organization).
+
+    Like member_create, an addition reactivates the user's old (deleted) membership if
+    there is one rather than adding another.
+    """
+    additions = defaultdict(dict)
+    updates = defaultdict(list)
+    removals = defaultdict(list)
+    sysadmin = defaultdict(list)
+    for change in batch:
+        if change.organization_id == groups.SYSADMIN:
+            sysadmin[change.new is not None].append(change.user_id)
+        elif change.old is None:
+            additions[change.organization_id][change.user_id] = change.new
+        elif change.new is None:
+            removals[change.organization_id].append(change.user_id)
+        else:
+            updates[(change.organization_id, change.new)].append(change.user_id)
+
+    def active_members(organization_id, user_ids):
+        return Session.query(model.Member).filter(
+            model.Member.group_id == organization_id,
+            model.Member.table_name == 'user',
+            model.Member.state == 'active',
+            model.Member.table_id.in_(user_ids),
+        )
+
+    for organization_id, capacities in additions.items():
+        capacities = dict(capacities)
+        old_members = Session.query(model.Member).filter(
+            model.Member.group_id == organization_id,
+            model.Member.table_name == 'user',
+            model.Member.state != 'active',
+            model.Member.table_id.in_(list(capacities)),
+        )
+        for member in old_members:
+            if member.table_id in capacities:
+                member.capacity = capacities.pop(member.table_id)
+                member.state = 'active'
+        Session.add_all(
+            model.Member(
+                group_id=organization_id,
+                table_id=user_id,
+                table_name='user',
+                capacity=capacity,
+                state='active',
+            )
+            for user_id, capacity in capacities.items()
+        )
+    for (organization_id, capacity), user_ids in updates.items():
+        active_members(organization_id, user_ids).update(
+            {'capacity': capacity}, synchronize_session=False
+        )
+    for organization_id, user_ids in removals.items():
+        active_members(organization_id, user_ids).update(
+            {'state': 'deleted'}, synchronize_session=False
+        )
+    for value, user_ids in sysadmin.items():
+        Session.query(User).filter(User.id.in_(user_ids)).update(
+            {'sysadmin': value}, synchronize_session=False
+        )
+
+
+def sync_group_memberships(
+    filter_str=GROUP_FILTER,
+    member_attribute='member',
+    page_size=500,
+    batch_size=500,
+    dry_run=False,
+):
+    """
+    Make the organization memberships (and sysadmin status) of every LDAP user match
+    their directory groups (see plan_group_sync).
+
+    The groups are read with paged searches, one pass over the groups rather than one
+    search per user, and the members of each organization are read with one query, so
+    the cost depends on the number of groups, organizations and changes rather than the
+    number of users.
+
+    :param filter_str: the filter matching the groups (Default value = GROUP_FILTER)
+    :param member_attribute: the attribute holding the DNs of a group's members (Default
+        value = 'member')
+    :param page_size: the number of entries to request per page (Default value = 500)
+    :param batch_size: the number of changes to write per transaction (Default value =
+        500)
+    :param dry_run: work out the changes without making them (Default value = False)
+    :returns: a 2-tuple of a Counter of statistics and the list of MembershipChanges
+    """
+    graph = {}
+    cnx = connect(role=SEARCH)
+    try:
+        for group_dn, members in iter_groups(
+            cnx, filter_str, member_attribute, page_size
+        ):
+            graph[group_dn] = members
+    finally:
+        close_connection(cnx)
+
+    stats, changes = plan_group_sync(graph)
+    if not dry_run:
+        stats.update(apply_membership_changes(changes, batch_size))
+    return stats, changes
+
+
+def describe_membership_changes(changes):
+    """
+    Describe the given changes for people, with the names of the users and
+    organizations.
+
+    :param changes: a list of MembershipChanges
+    :returns: a generator of strings
+    """
+    user_ids = {change.user_id for change in changes}
+    organization_ids = {change.organization_id for change in changes} - {
+        groups.SYSADMIN
+    }
+    user_names = dict(
+        Session.query(User.id, User.name).filter(User.id.in_(user_ids))
+        if user_ids
+        else []
+    )
+    organization_names = dict(
+        Session.query(model.Group.id, model.Group.name).filter(
+            model.Group.id.in_(organization_ids)
+        )
+        if organization_ids
+        else []
+    )
+    for change in changes:
+        user_name = user_names.get(change.user_id, change.user_id)
+        if change.organization_id == groups.SYSADMIN:
+            action = 'grant' if change.new else 'revoke'
+            yield f'{action} sysadmin: {user_name}'
+            continue
+        organization = organization_names.get(
+            change.organization_id, change.organization_id
+        )
+        kind = _change_kind(change)
+        if kind == 'added':
+            yield f'{organization}: add {user_name} as {change.new}'
+        elif kind == 'removed':
+            yield f'{organization}: remove {user_name} ({change.old})'
+        else:
+            yield (
+                f'{organization}: change {user_name} from {change.old} to {change.new}'
+            )
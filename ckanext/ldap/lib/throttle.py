@@ -0,0 +1,68 @@
+# !/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-ldap
+# Created by the Natural History Museum in London, UK
+
+import logging
+
+from ckan.plugins import toolkit
+
+from ckanext.ldap.lib import metrics
+from ckanext.ldap.lib.exceptions import StoreError
+from ckanext.ldap.lib.store import get_store
+
+log = logging.getLogger(__name__)
+
+# what login attempts are limited by, each has its own token buckets and options
+LIMITS = ('ip', 'login')
+
+
+def _bucket(limit):
+    """
+    Get the size and refill rate of the token buckets for the given limit.
+
+    :param limit: one of LIMITS
+    :returns: a 2-tuple of the capacity and the tokens added per second, or None if the
+        limit is disabled
+    """
+    burst = toolkit.config[f'ckanext.ldap.throttle.{limit}.burst']
+    per_minute = toolkit.config[f'ckanext.ldap.throttle.{limit}.per_minute']
+    if burst <= 0 or per_minute <= 0:
+        return None
+    return burst, per_minute / 60
+
+
+def check_login_attempt(client_ip, login):
+    """
+    Check whether a login attempt is within the configured rate limits, using up one of
+    the attempts allowed for the client's IP address and then one of those allowed for
+    the login name. If the IP address is over its limit the login name's attempts aren't
+    used up.
+
+    If the store can't be reached the attempt is allowed, so that an outage of the store
+    doesn't stop everyone from logging in.
+
+    :param client_ip: the IP address the attempt came from
+    :param login: the login name used
+    :returns: None if the attempt is allowed, otherwise a 2-tuple of the limit it is
+        over ('ip' or 'login') and the number of seconds until another attempt will be
+        allowed
+    """
+    if not toolkit.config['ckanext.ldap.throttle.enabled']:
+        return None
+    keys = {'ip': client_ip or '', 'login': login.strip().lower()}
+    store = get_store()
+    for limit in LIMITS:
+        bucket = _bucket(limit)
+        if bucket is None:
+            continue
+        try:
+            wait = store.take(f'throttle:{limit}:{keys[limit]}', *bucket)
+        except StoreError as e:
+            log.warning(f'Not throttling login attempts: {e}')
+            metrics.count_error('store_error')
+            return None
+        if wait > 0:
+            return limit, wait
+    return None
@@ -1,10 +1,85 @@
+from ckan import model
 from ckan.common import asbool
 from ckan.logic import auth
 from ckan.plugins import toolkit
+from sqlalchemy import event
 
+from ckanext.ldap.lib.cache import clear_request_cache, request_cache
+from ckanext.ldap.lib.exceptions import OverloadedError
 from ckanext.ldap.lib.search import find_ldap_user
 from ckanext.ldap.model.ldap_user import LdapUser
 
+# the names of the request caches holding the decisions made below, as templates call
+# check_access for the same users many times while rendering a page
+_USER_CREATE = 'auth_user_create'
+_USER_UPDATE = 'auth_user_update'
+
+
+def _overloaded():
+    # the name can't be checked against LDAP, so don't allow it
+    return {
+        'success': False,
+        'msg': toolkit._('Cannot check LDAP users at the moment, please try again'),
+    }
+
+
+def _name_taken():
+    return {
+        'success': False,
+        'msg': toolkit._('An LDAP user by that name already exists'),
+    }
+
+
+def _decide(cache_name, key, decide):
+    """
+    Get this extension's decision for the given key from the current request's cache,
+    making (and remembering) it if it hasn't been made yet.
+
+    :param cache_name: the name of the request cache
+    :param key: the key of the decision
+    :param decide: a function returning the decision
+    :returns: a failed auth result dict, or None if the next auth function decides
+    """
+    decisions = request_cache(cache_name)
+    if key not in decisions:
+        decisions[key] = decide()
+    return decisions[key]
+
+
+def _check_create(name):
+    try:
+        ldap_user_dict = find_ldap_user(name)
+    except OverloadedError:
+        return _overloaded()
+    if ldap_user_dict:
+        return _name_taken()
+    return None
+
+
+def _check_update(context, data_dict):
+    user_obj = None
+    try:
+        user_obj = auth.get_user_object(context, data_dict)
+    except toolkit.ObjectNotFound:
+        pass
+    if not user_obj:
+        return None
+    ldap_user = LdapUser.by_user_id(user_obj.id)
+    # Prevent edition of LDAP users (if so configured)
+    if toolkit.config['ckanext.ldap.prevent_edits'] and ldap_user:
+        return {'success': False, 'msg': toolkit._('Cannot edit LDAP users')}
+    # Prevent name clashes!
+    if 'name' in data_dict and user_obj.name != data_dict['name']:
+        try:
+            ldap_user_dict = find_ldap_user(data_dict['name'])
+        except OverloadedError:
+            return _overloaded()
+        if ldap_user_dict and (
+            ldap_user is None or ldap_user.ldap_id != ldap_user_dict['username']
+        ):
+            return _name_taken()
+    return None
+
 
 @toolkit.chained_auth_function
 @toolkit.auth_allow_anonymous_access
@@ -15,12 +90,12 @@ def user_create(next_auth, context, data_dict=None):
     :param data_dict:  (Default value = None)
     """
     if data_dict and 'name' in data_dict:
-        ldap_user_dict = find_ldap_user(data_dict['name'])
-        if ldap_user_dict:
-            return {
-                'success': False,
-                'msg': toolkit._('An LDAP user by that name already exists'),
-            }
+        name = data_dict['name']
+        failed = _decide(
+            _USER_CREATE, (context.get('user'), name), lambda: _check_create(name)
+        )
+        if failed:
+            return failed
 
     return next_auth(context, data_dict)
 
@@ -29,36 +104,23 @@ def user_create(next_auth, context, data_dict=None):
 @toolkit.auth_allow_anonymous_access
 def user_update(next_auth, context, data_dict):
     """
-    Ensure LDAP users cannot be edited, and name clash with ldap users.
+    Ensure LDAP users cannot be edited, and name clash with ldap users. Our part of the
+    decision is remembered for the rest of the request, keyed on the context user and
+    the target user (and new name), so only the next auth function is rerun when
+    templates check the same user again.
 
     :param next_auth: the next auth function in the chain
     :param context:
     :param data_dict:
     """
-    user_obj = None
-    try:
-        user_obj = auth.get_user_object(context, data_dict)
-    except toolkit.ObjectNotFound:
-        pass
-    # Prevent edition of LDAP users (if so configured)
-    if (
-        toolkit.config['ckanext.ldap.prevent_edits']
-        and user_obj
-        and LdapUser.by_user_id(user_obj.id)
-    ):
-        return {'success': False, 'msg': toolkit._('Cannot edit LDAP users')}
-    # Prevent name clashes!
-    if 'name' in data_dict and user_obj and user_obj.name != data_dict['name']:
-        ldap_user_dict = find_ldap_user(data_dict['name'])
-        if ldap_user_dict:
-            if (
-                len(user_obj.ldap_user) == 0
-                or user_obj.ldap_user[0].ldap_id != ldap_user_dict['ldap_id']
-            ):
-                return {
-                    'success': False,
-                    'msg': toolkit._('An LDAP user by that name already exists'),
-                }
+    if context.get('user_obj') or data_dict.get('id') is None:
+        # the target isn't identified by an id, so don't remember anything
+        failed = _check_update(context, data_dict)
+    else:
+        key = (context.get('user'), data_dict['id'], data_dict.get('name'))
+        failed = _decide(_USER_UPDATE, key, lambda: _check_update(context, data_dict))
+    if failed:
+        return failed
 
     return next_auth(context, data_dict)
 
@@ -73,3 +135,21 @@ def user_reset(next_auth, context, data_dict):
                 'msg': toolkit._('Cannot reset password for LDAP user'),
             }
     return next_auth(context, data_dict)
+
+
+def _forget_decisions(*args):
+    clear_request_cache(_USER_CREATE, _USER_UPDATE)
+
+
+def _forget_attached_decisions(session, instance):
+    if isinstance(instance, (model.User, LdapUser)):
+        _forget_decisions()
+
+
+# the decisions depend on the users' names and LDAP mappings, so forget them if either
+# change during the request
+event.listen(model.meta.Session, 'after_attach', _forget_attached_decisions)
+event.listen(model.User, 'after_update', _forget_decisions)
+event.listen(model.User, 'after_delete', _forget_decisions)
+event.listen(LdapUser, 'after_update', _forget_decisions)
+event.listen(LdapUser, 'after_delete', _forget_decisions)
@@ -0,0 +1,33 @@
+"""
+Add attributes digest.
+
+Revision ID: 3b7e0f4a2d61
+Revises: 8d41b7e6c2a9
+Create Date: 2026-10-18 14:22:09.512947
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '3b7e0f4a2d61'
+down_revision = '8d41b7e6c2a9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """
+    Add the attributes_digest column to ldap_user.
+    """
+    # existing rows have no digest, so their users are updated on their next login
+    op.add_column(
+        'ldap_user', sa.Column('attributes_digest', sa.UnicodeText, nullable=True)
+    )
+
+
+def downgrade():
+    """
+    Drop the attributes_digest column.
+    """
+    op.drop_column('ldap_user', 'attributes_digest')
@@ -0,0 +1,39 @@
+"""
+Add sync state.
+
+Revision ID: 5f3c2e1d9b47
+Revises: a9d372ce374d
+Create Date: 2026-10-18 10:12:31.408215
+"""
+
+from datetime import datetime as dt
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '5f3c2e1d9b47'
+down_revision = 'a9d372ce374d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """
+    Create the ldap_sync_state table, which holds the progress of incremental syncs.
+    """
+    op.create_table(
+        'ldap_sync_state',
+        sa.Column('base_dn', sa.UnicodeText, primary_key=True),
+        sa.Column('filter', sa.UnicodeText, nullable=False),
+        sa.Column('modify_timestamp', sa.UnicodeText),
+        sa.Column('cookie', sa.UnicodeText),
+        sa.Column('updated', sa.DateTime, default=dt.now, onupdate=dt.now),
+    )
+
+
+def downgrade():
+    """
+    Drop the ldap_sync_state table.
+    """
+    op.drop_table('ldap_sync_state')
@@ -0,0 +1,33 @@
+"""
+Add dn and entry_uuid.
+
+Revision ID: 6c2d9a41f8e3
+Revises: 3b7e0f4a2d61
+Create Date: 2026-10-18 16:05:41.208315
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '6c2d9a41f8e3'
+down_revision = '3b7e0f4a2d61'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """
+    Add the dn and entry_uuid columns to ldap_user.
+    """
+    # existing rows are filled in on their user's next login (or sync)
+    op.add_column('ldap_user', sa.Column('dn', sa.UnicodeText, nullable=True))
+    op.add_column('ldap_user', sa.Column('entry_uuid', sa.UnicodeText, nullable=True))
+
+
+def downgrade():
+    """
+    Drop the dn and entry_uuid columns.
+    """
+    op.drop_column('ldap_user', 'entry_uuid')
+    op.drop_column('ldap_user', 'dn')
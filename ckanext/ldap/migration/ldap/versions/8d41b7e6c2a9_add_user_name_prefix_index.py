@@ -0,0 +1,42 @@
+"""
+Add user name prefix index.
+
+Unlike the other revisions this one touches CKAN core's user table. New user names
+have to be unique across every CKAN user, local ones included, so the prefix query
+which allocates them reads user.name and an index on this extension's tables couldn't
+serve it. The index is prefixed idx_ldap_ so its owner is clear, and downgrading this
+revision (ckan db downgrade -p ldap) drops it. It is dropped along with the table by
+ckan db clean.
+
+Revision ID: 8d41b7e6c2a9
+Revises: 5f3c2e1d9b47
+Create Date: 2026-10-18 11:03:54.120733
+"""
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '8d41b7e6c2a9'
+down_revision = '5f3c2e1d9b47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """
+    Index user.name with text_pattern_ops so that the LIKE 'prefix%' query used to
+    allocate unique user names can use an index whatever the database's collation is.
+    """
+    op.create_index(
+        'idx_ldap_user_name_prefix',
+        'user',
+        ['name'],
+        postgresql_ops={'name': 'text_pattern_ops'},
+    )
+
+
+def downgrade():
+    """
+    Drop the index from CKAN's user table.
+    """
+    op.drop_index('idx_ldap_user_name_prefix', table_name='user')
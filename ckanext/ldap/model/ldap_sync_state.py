@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-ldap
+# Created by the Natural History Museum in London, UK
+
+import datetime
+
+from ckan import model
+from sqlalchemy import Column, Table, types
+
+ldap_sync_state_table = Table(
+    'ldap_sync_state',
+    model.meta.metadata,
+    Column('base_dn', types.UnicodeText, primary_key=True),
+    Column('filter', types.UnicodeText, nullable=False),
+    Column('modify_timestamp', types.UnicodeText),
+    Column('cookie', types.UnicodeText),
+    Column(
+        'updated',
+        types.DateTime,
+        default=datetime.datetime.now,
+        onupdate=datetime.datetime.now,
+    ),
+)
+
+
+class LdapSyncState(model.domain_object.DomainObject):
+    """
+    Represents how far the directory under a base DN has been synced, either as the
+    highest modifyTimestamp seen or as an RFC 4533 sync cookie.
+    """
+
+    @classmethod
+    def get_for(cls, base_dn, filter_str):
+        """
+        Return the sync state for the given base DN, provided it was recorded with the
+        given filter. A new (empty) state is returned if there isn't one or if the
+        filter has changed, as the recorded progress doesn't apply to the new filter.
+
+        :param base_dn: the DN the sync searches under
+        :param filter_str: the filter the sync uses
+        :returns: LdapSyncState object (not necessarily added to the session)
+        """
+        obj = model.meta.Session.query(cls).filter_by(base_dn=base_dn).first()
+        if obj is None:
+            obj = cls(base_dn=base_dn, filter=filter_str)
+        elif obj.filter != filter_str:
+            obj.filter = filter_str
+            obj.modify_timestamp = None
+            obj.cookie = None
+        return obj
+
+
+model.meta.mapper(LdapSyncState, ldap_sync_state_table)
@@ -7,7 +7,9 @@
 import datetime
 
 from ckan import model
-from sqlalchemy import Column, ForeignKey, Table, orm, types
+from sqlalchemy import Column, ForeignKey, Table, event, orm, types
+
+from ckanext.ldap.lib.cache import clear_request_cache, request_cache
 
 ldap_user_table = Table(
     'ldap_user',
@@ -18,14 +20,25 @@ ldap_user_table = Table(
     ),
     Column('ldap_id', types.UnicodeText, index=True, unique=True, nullable=False),
     Column('created', types.DateTime, default=datetime.datetime.now),
+    # digest of the LDAP attributes last copied onto the CKAN user
+    Column('attributes_digest', types.UnicodeText, nullable=True),
+    # where the user's entry was last seen, so that logins can bind to it directly
+    Column('dn', types.UnicodeText, nullable=True),
+    Column('entry_uuid', types.UnicodeText, nullable=True),
 )
 
 
 class LdapUser(model.domain_object.DomainObject):
     """
     Represents an entry mapping a ldap id to a CKAN user.
+
+    Lookups are remembered for the rest of the request (including lookups that don't
+    find anything), so repeated lookups for the same users only query the database once.
     """
 
+    _by_ldap_id = 'ldap_user_by_ldap_id'
+    _by_user_id = 'ldap_user_by_user_id'
+
     @classmethod
     def by_ldap_id(cls, ldap_id, autoflush=True):
         """
@@ -35,13 +48,7 @@ class LdapUser(model.domain_object.DomainObject):
         :param autoflush: (Default value = True)
         :returns: LdapUser object or None
         """
-        obj = (
-            model.meta.Session.query(cls)
-            .autoflush(autoflush)
-            .filter_by(ldap_id=ldap_id)
-            .first()
-        )
-        return obj
+        return cls.by_ldap_ids([ldap_id], autoflush)[ldap_id]
 
     @classmethod
     def by_user_id(cls, user_id, autoflush=True):
@@ -52,13 +59,61 @@ class LdapUser(model.domain_object.DomainObject):
         :param autoflush: (Default value = True)
         :returns: LdapUser object or None
         """
-        obj = (
-            model.meta.Session.query(cls)
-            .autoflush(autoflush)
-            .filter_by(user_id=user_id)
-            .first()
-        )
-        return obj
+        return cls.by_user_ids([user_id], autoflush)[user_id]
+
+    @classmethod
+    def by_ldap_ids(cls, ldap_ids, autoflush=True):
+        """
+        Return the LdapUser objects mapping the given ldap ids, using one query.
+
+        :param ldap_ids: ldap ids, as returned by the LDAP server
+        :param autoflush: (Default value = True)
+        :returns: dictionary mapping each ldap id to an LdapUser object or None
+        """
+        return cls._lookup('ldap_id', ldap_ids, autoflush)
+
+    @classmethod
+    def by_user_ids(cls, user_ids, autoflush=True):
+        """
+        Return the LdapUser objects mapping the given user ids, using one query.
+
+        :param user_ids: CKAN user ids (actual ids, not names)
+        :param autoflush: (Default value = True)
+        :returns: dictionary mapping each user id to an LdapUser object or None
+        """
+        return cls._lookup('user_id', user_ids, autoflush)
+
+    @classmethod
+    def _lookup(cls, field, values, autoflush):
+        caches = {
+            'ldap_id': request_cache(cls._by_ldap_id),
+            'user_id': request_cache(cls._by_user_id),
+        }
+        cache = caches[field]
+        result = {value: cache[value] for value in values if value in cache}
+        missing = [value for value in values if value not in result]
+        if missing:
+            query = (
+                model.meta.Session.query(cls)
+                .autoflush(autoflush)
+                .filter(getattr(cls, field).in_(missing))
+            )
+            found = {}
+            for obj in query:
+                found[getattr(obj, field)] = obj
+                # remember it for lookups by the other field too
+                caches['ldap_id'][obj.ldap_id] = obj
+                caches['user_id'][obj.user_id] = obj
+            for value in missing:
+                result[value] = cache[value] = found.get(value)
+        return result
+
+    @classmethod
+    def forget(cls):
+        """
+        Clear the lookups remembered for the current request.
+        """
+        clear_request_cache(cls._by_ldap_id, cls._by_user_id)
 
 
 model.meta.mapper(
@@ -71,3 +126,19 @@ model.meta.mapper(
         )
     },
 )
+
+
+def _forget_ldap_users(*args):
+    LdapUser.forget()
+
+
+def _forget_attached_ldap_users(session, instance):
+    if isinstance(instance, LdapUser):
+        LdapUser.forget()
+
+
+# make sure no lookups that have been remembered as "not found" (or found) are returned
+# once mappings are added, changed or removed
+event.listen(model.meta.Session, 'after_attach', _forget_attached_ldap_users)
+event.listen(LdapUser, 'after_update', _forget_ldap_users)
+event.listen(LdapUser, 'after_delete', _forget_ldap_users)
@@ -9,9 +9,20 @@ import logging
 import ldap
 from ckan.common import session
 from ckan.plugins import SingletonPlugin, implements, interfaces, toolkit
+from flask import after_this_request
 
 from ckanext.ldap import cli, routes
-from ckanext.ldap.lib.helpers import get_login_action, is_ldap_user
+from ckanext.ldap.lib import basic_auth, groups, identity, metrics
+from ckanext.ldap.lib.admission import reset_admission
+from ckanext.ldap.lib.helpers import (
+    get_ldap_user_ids,
+    get_login_action,
+    is_ldap_user,
+)
+from ckanext.ldap.lib.pool import reset_pool
+from ckanext.ldap.lib.search import reset_lookup_cache
+from ckanext.ldap.lib.servers import reset_servers
+from ckanext.ldap.lib.store import STORES, reset_store
 from ckanext.ldap.logic.auth import user_create, user_reset, user_update
 
 log = logging.getLogger(__name__)
@@ -88,6 +99,103 @@ class LdapPlugin(SingletonPlugin):
                 'default': False,
                 'parse': toolkit.asbool,
             },
+            'ckanext.ldap.network_timeout': {'default': 10, 'parse': toolkit.asint},
+            'ckanext.ldap.operation_timeout': {'default': 0, 'parse': toolkit.asint},
+            'ckanext.ldap.breaker.failure_threshold': {
+                'default': 3,
+                'parse': toolkit.asint,
+            },
+            'ckanext.ldap.breaker.cooldown': {'default': 30, 'parse': toolkit.asint},
+            'ckanext.ldap.search.uri': {},
+            'ckanext.ldap.bind.uri': {},
+            'ckanext.ldap.pool.min_size': {'default': 0, 'parse': toolkit.asint},
+            'ckanext.ldap.pool.max_size': {'default': 10, 'parse': toolkit.asint},
+            'ckanext.ldap.pool.idle_timeout': {'default': 300, 'parse': toolkit.asint},
+            'ckanext.ldap.pool.checkout_timeout': {
+                'default': 10,
+                'parse': toolkit.asint,
+            },
+            'ckanext.ldap.pool.check_interval': {'default': 30, 'parse': toolkit.asint},
+            'ckanext.ldap.login.same_connection': {
+                'default': False,
+                'parse': toolkit.asbool,
+            },
+            'ckanext.ldap.cache.size': {'default': 1000, 'parse': toolkit.asint},
+            'ckanext.ldap.cache.ttl': {'default': 300, 'parse': toolkit.asint},
+            'ckanext.ldap.cache.negative_ttl': {'default': 60, 'parse': toolkit.asint},
+            'ckanext.ldap.metrics.enabled': {
+                'default': False,
+                'parse': toolkit.asbool,
+                'validate': _metrics_available,
+            },
+            'ckanext.ldap.metrics.token': {},
+            'ckanext.ldap.store': {'default': 'memory', 'validate': _allowed_stores},
+            'ckanext.ldap.store.size': {'default': 10000, 'parse': toolkit.asint},
+            'ckanext.ldap.throttle.enabled': {
+                'default': False,
+                'parse': toolkit.asbool,
+            },
+            'ckanext.ldap.throttle.ip.burst': {'default': 20, 'parse': toolkit.asint},
+            'ckanext.ldap.throttle.ip.per_minute': {
+                'default': 20,
+                'parse': toolkit.asint,
+            },
+            'ckanext.ldap.throttle.login.burst': {'default': 5, 'parse': toolkit.asint},
+            'ckanext.ldap.throttle.login.per_minute': {
+                'default': 5,
+                'parse': toolkit.asint,
+            },
+            'ckanext.ldap.admission.limit': {'default': 0, 'parse': toolkit.asint},
+            'ckanext.ldap.admission.queue_size': {
+                'default': 10,
+                'parse': toolkit.asint,
+            },
+            'ckanext.ldap.admission.timeout': {'default': 2, 'parse': toolkit.asint},
+            'ckanext.ldap.admission.lease': {'default': 60, 'parse': toolkit.asint},
+            'ckanext.ldap.credential_cache.ttl': {
+                'default': 0,
+                'parse': toolkit.asint,
+            },
+            'ckanext.ldap.basic_auth.enabled': {
+                'default': False,
+                'parse': toolkit.asbool,
+            },
+            'ckanext.ldap.basic_auth.cache_ttl': {
+                'default': 300,
+                'parse': toolkit.asint,
+            },
+            'ckanext.ldap.basic_auth.negative_ttl': {
+                'default': 30,
+                'parse': toolkit.asint,
+            },
+            'ckanext.ldap.jobs.enabled': {'default': False, 'parse': toolkit.asbool},
+            'ckanext.ldap.jobs.retries': {'default': 3, 'parse': toolkit.asint},
+            'ckanext.ldap.identity_cookie.enabled': {
+                'default': False,
+                'parse': toolkit.asbool,
+            },
+            'ckanext.ldap.identity_cookie.secret': {},
+            'ckanext.ldap.identity_cookie.max_age': {
+                'default': 86400,
+                'parse': toolkit.asint,
+            },
+            'ckanext.ldap.identity_cookie.secure': {
+                'default': False,
+                'parse': toolkit.asbool,
+            },
+            'ckanext.ldap.groups.mapping': {'validate': _valid_group_mapping},
+            'ckanext.ldap.groups.base_dn': {},
+            'ckanext.ldap.groups.filter': {'default': '(member={dn})'},
+            'ckanext.ldap.groups.member_of': {
+                'default': True,
+                'parse': toolkit.asbool,
+            },
+            'ckanext.ldap.groups.nested': {'default': False, 'parse': toolkit.asbool},
+            'ckanext.ldap.groups.cache_ttl': {'default': 300, 'parse': toolkit.asint},
+            'ckanext.ldap.groups.manage_sysadmin': {
+                'default': False,
+                'parse': toolkit.asbool,
+            },
         }
         errors = []
         for key, options in schema.items():
@@ -112,6 +220,15 @@ class LdapPlugin(SingletonPlugin):
             elif 'default' in options:
                 config[key] = options['default']
 
+        if config['ckanext.ldap.identity_cookie.enabled'] and not identity.get_secret(
+            config
+        ):
+            errors.append(
+                'Configuration parameter ckanext.ldap.identity_cookie.secret (or '
+                'SECRET_KEY) is required when ckanext.ldap.identity_cookie.enabled is '
+                'true'
+            )
+
         if len(errors):
             raise ConfigError('\n'.join(errors))
 
@@ -138,6 +255,15 @@ class LdapPlugin(SingletonPlugin):
         :param config:
         """
         ldap.set_option(ldap.OPT_DEBUG_LEVEL, config['ckanext.ldap.debug_level'])
+        # make sure pooled connections and cached lookups pick up the current config
+        reset_pool()
+        reset_servers()
+        reset_store()
+        reset_admission()
+        reset_lookup_cache()
+        basic_auth.reset_cache()
+        identity.reset_names()
+        groups.reset_membership_cache()
 
     # IAuthenticator
     def login(self):
@@ -150,20 +276,39 @@ class LdapPlugin(SingletonPlugin):
     # IAuthenticator
     def identify(self):
         """
-        Identify which user (if any) is logged in via this plugin.
+        Identify which user (if any) is logged in via this plugin, either through the
+        login form or (if enabled) with HTTP Basic credentials.
         """
-        # FIXME: This breaks if the current user changes their own user name.
-        user = session.get('ckanext-ldap-user')
+        if identity.enabled():
+            user = identity.identify_request()
+            if user and toolkit.check_ckan_version(min_version='2.10.0'):
+                identity.log_in_request(user)
+        else:
+            # FIXME: This breaks if the current user changes their own user name (the
+            # identity cookie doesn't have this problem).
+            user = session.get('ckanext-ldap-user')
         if user:
             toolkit.c.user = user
-        else:
-            # add the 'user' attribute to the context to avoid issue #4247
-            toolkit.c.user = None
+            return
+        if basic_auth.enabled():
+            user, response = basic_auth.identify_request()
+            if response is not None:
+                return response
+            if user:
+                basic_auth.log_in(user)
+                return
+        # add the 'user' attribute to the context to avoid issue #4247
+        toolkit.c.user = None
 
     # IAuthenticator
     def logout(self):
         # Delete session items managed by ckanext-ldap
         self._delete_session_items()
+        if identity.enabled():
+            token = toolkit.request.cookies.get(identity.COOKIE_NAME)
+            if token:
+                identity.revoke(token)
+            after_this_request(identity.clear_cookie)
 
         # In CKAN 2.10.0+, we also need to invoke the toolkit's
         # logout_user() command to clean up anything remaining
@@ -184,7 +329,31 @@ class LdapPlugin(SingletonPlugin):
             session.save()
 
     def get_helpers(self):
-        return {'is_ldap_user': is_ldap_user, 'get_login_action': get_login_action}
+        return {
+            'is_ldap_user': is_ldap_user,
+            'get_login_action': get_login_action,
+            'get_ldap_user_ids': get_ldap_user_ids,
+        }
+
+
+def _metrics_available(v):
+    if v and not metrics.available():
+        raise ConfigError(
+            'ckanext.ldap.metrics.enabled requires prometheus_client, install it with '
+            'pip install ckanext-ldap[metrics]'
+        )
+
+
+def _allowed_stores(v):
+    if v not in STORES:
+        raise ConfigError(f'store must be one of {", ".join(STORES)}')
+
+
+def _valid_group_mapping(v):
+    try:
+        groups.parse_mapping(v)
+    except ValueError as e:
+        raise ConfigError(f'ckanext.ldap.groups.mapping is invalid: {e}')
 
 
 def _allowed_roles(v):
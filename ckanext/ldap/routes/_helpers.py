@@ -4,21 +4,31 @@
 # This file is part of ckanext-ldap
 # Created by the Natural History Museum in London, UK
 
+import hashlib
+import json
 import logging
+import math
 import re
 import uuid
 
-import ldap
-import ldap.filter
 from ckan.common import session
 from ckan.model import Session, User
 from ckan.plugins import toolkit
+from flask import Response
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
 
-from ckanext.ldap.lib.exceptions import UserConflictError
+from ckanext.ldap.lib import groups, identity, jobs
+from ckanext.ldap.lib.exceptions import OverloadedError, UserConflictError
 from ckanext.ldap.model.ldap_user import LdapUser
 
 log = logging.getLogger(__name__)
 
+# the number of times to try creating a user when concurrent logins take the same name
+NAME_ATTEMPTS = 3
+# the LDAP attributes which are copied onto the CKAN user
+PROFILE_FIELDS = ('email', 'fullname', 'about')
+
 
 def login_failed(notice=None, error=None):
     """
@@ -34,6 +44,57 @@ def login_failed(notice=None, error=None):
     return toolkit.redirect_to('user.login')
 
 
+def login_throttled(wait):
+    """
+    Handle login attempts that are over the rate limits. Rather than going back to the
+    login form, respond with a 429 (Too Many Requests) status and a Retry-After header.
+
+    :param wait: seconds until another attempt will be allowed
+    """
+    seconds = max(1, math.ceil(wait))
+    return Response(
+        toolkit._(
+            'Too many login attempts. Please try again in {seconds} seconds.'
+        ).format(seconds=seconds),
+        status=429,
+        headers={'Retry-After': str(seconds)},
+        content_type='text/plain',
+    )
+
+
+def login_overloaded(retry_after):
+    """
+    Handle login attempts refused by admission control because the LDAP server is
+    struggling. Respond quickly with a 503 (Service Unavailable) status and a Retry-
+    After header.
+
+    :param retry_after: seconds after which the attempt is worth retrying
+    """
+    return Response(
+        toolkit._(
+            'Logging in is busy at the moment. Please try again in {seconds} seconds.'
+        ).format(seconds=retry_after),
+        status=503,
+        headers={'Retry-After': str(retry_after)},
+        content_type='text/plain',
+    )
+
+
+def basic_auth_failed():
+    """
+    Handle requests whose HTTP Basic credentials were rejected.
+
+    Respond with a 401 (Unauthorized) status and a WWW-Authenticate header, rather than
+    handling the request anonymously.
+    """
+    return Response(
+        toolkit._('Bad username or password.'),
+        status=401,
+        headers={'WWW-Authenticate': 'Basic realm="CKAN", charset="UTF-8"'},
+        content_type='text/plain',
+    )
+
+
 def login_success(user_name, came_from):
     """
     Handle login success. Behavior depends on CKAN version.
@@ -48,6 +109,11 @@ def login_success(user_name, came_from):
     succeeds, then this saves user_name in the session under     the 'ckanext-ldap-user'
     key before redirecting to /home/index.
 
+    If ckanext.ldap.identity_cookie.enabled is set, a signed cookie carrying the user's
+    id is set instead of saving user_name in the session, and login_user() isn't called
+    (so nothing is written to the session) because identify() tells flask-login who the
+    user is on each request.
+
     :param user_name: The user name
     :param came_from: The value of the 'came_from' parameter sent with the original
         login request
@@ -84,13 +150,21 @@ def login_success(user_name, came_from):
             toolkit.h.flash_error(err_msg)
             return toolkit.redirect_to(user_login_path)
 
-        # Register the login with flask-login via the toolkit's helper function
-        ok = toolkit.login_user(user_obj)
+        # Register the login with flask-login via the toolkit's helper function, unless
+        # the identity cookie will identify the user instead
+        ok = identity.enabled() or toolkit.login_user(user_obj)
         if not ok:
             log.error(f"toolkit.login_user() returned False for user '{user_name}'")
             toolkit.h.flash_error(err_msg)
             return toolkit.redirect_to(user_login_path)
 
+    if identity.enabled():
+        # remember the user with a signed cookie rather than in the session
+        user_obj = User.by_name(user_name)
+        response = toolkit.redirect_to(redirect_path, came_from=came_from)
+        identity.set_cookie(response, user_obj.id)
+        return response
+
     # Update the session & redirect
     session['ckanext-ldap-user'] = user_name
     session.save()
@@ -112,35 +186,71 @@ def ckan_user_exists(user_name):
     """
     Check if a CKAN user name exists, and if that user is an LDAP user.
 
-    :param user_name: User name to check
-    :returns: Dictionary defining 'exists' and 'ldap'.
+    :param user_name: User name (or id) to check
+    :returns: Dictionary defining 'exists' and 'is_ldap'.
     """
-    try:
-        user = get_user_dict(user_name)
-    except toolkit.ObjectNotFound:
-        return {'exists': False, 'is_ldap': False}
+    return ckan_users_exist([user_name])[user_name]
 
-    ldap_user = LdapUser.by_user_id(user['id'])
-    if ldap_user:
-        return {'exists': True, 'is_ldap': True}
-    else:
-        return {'exists': True, 'is_ldap': False}
 
+def ckan_users_exist(user_names):
+    """
+    Check if each of the given CKAN user names exists, and if that user is an LDAP user,
+    using a single query.
 
-def get_unique_user_name(base_name):
+    :param user_names: User names (or ids) to check
+    :returns: Dictionary mapping each name to a dictionary defining 'exists' and
+        'is_ldap'.
+    """
+    result = {name: {'exists': False, 'is_ldap': False} for name in user_names}
+    if not result:
+        return result
+    names = list(result)
+    query = (
+        Session.query(User.id, User.name, LdapUser.id)
+        .outerjoin(LdapUser, LdapUser.user_id == User.id)
+        .filter(or_(User.name.in_(names), User.id.in_(names)))
+    )
+    for user_id, name, ldap_user_id in query:
+        exists = {'exists': True, 'is_ldap': ldap_user_id is not None}
+        for key in (name, user_id):
+            if key in result:
+                result[key] = exists
+    return result
+
+
+def get_user_names_with_prefix(prefix):
+    """
+    Get the names of all the CKAN users whose name starts with the given prefix.
+
+    :param prefix: the prefix
+    :returns: a set of user names
+    """
+    # escape the LIKE wildcards, "_" is common in user names
+    pattern = re.sub(r'([\\%_])', r'\\\1', prefix) + '%'
+    query = Session.query(User.name).filter(User.name.like(pattern, escape='\\'))
+    return {name for (name,) in query}
+
+
+def get_unique_user_name(base_name, reserved=None):
     """
     Create a unique, valid, non existent user name from the given base name.
 
     :param base_name: Base name
+    :param reserved: a set of names which should be treated as being in use, even though
+        they don't exist yet (Default value = None)
     :returns: A valid user name not currently in use based on base_name
     """
     base_name = re.sub('[^-a-z0-9_]', '_', base_name.lower())
     base_name = base_name[0:100]
     if len(base_name) < 2:
         base_name = (base_name + '__')[0:2]
+    # every candidate starts with this prefix (as long as the suffix is less than 11
+    # digits) so the names in use can be fetched in one query
+    taken = get_user_names_with_prefix(base_name[0:90])
+    taken.update(reserved or set())
     count = 0
     user_name = base_name
-    while (ckan_user_exists(user_name))['exists']:
+    while user_name in taken:
         count += 1
         user_name = '{base}{count}'.format(
             base=base_name[0 : 100 - len(str(count))], count=str(count)
@@ -148,17 +258,136 @@ def get_unique_user_name(base_name):
     return user_name
 
 
+def create_user(user_dict, base_name):
+    """
+    Create a CKAN user, allocating a new name if the one in user_dict is taken by a
+    concurrent login in the meantime.
+
+    :param user_dict: the data for user_create, including the name to try first
+    :param base_name: the base name to allocate a new name from
+    :returns: the user dictionary returned by user_create
+    """
+    for attempt in range(NAME_ATTEMPTS):
+        try:
+            return toolkit.get_action('user_create')(
+                context={'ignore_auth': True}, data_dict=dict(user_dict)
+            )
+        except (toolkit.ValidationError, IntegrityError) as e:
+            # the validator catches names taken before user_create started, the unique
+            # constraint catches names taken since
+            name_taken = isinstance(e, IntegrityError) or 'name' in e.error_dict
+            if not name_taken or attempt == NAME_ATTEMPTS - 1:
+                raise
+            Session.rollback()
+            log.info(f'User name {user_dict["name"]} was taken, allocating another')
+            user_dict['name'] = get_unique_user_name(base_name)
+
+
+def get_attributes_digest(ldap_user_dict):
+    """
+    Create a digest of the LDAP attributes which are copied onto the CKAN user, so that
+    changes in the directory can be detected without comparing against the user.
+
+    :param ldap_user_dict: Dictionary as returned by find_ldap_user
+    :returns: a hex digest
+    """
+    values = [ldap_user_dict.get(field) for field in PROFILE_FIELDS]
+    return hashlib.sha256(json.dumps(values).encode('utf-8')).hexdigest()
+
+
+def update_ldap_user(ldap_user, ldap_user_dict):
+    """
+    Copy the LDAP attributes onto the CKAN user if they have changed in the directory
+    since they were last copied. When nothing has changed this costs nothing more than
+    computing the digest.
+
+    :param ldap_user: the LdapUser object
+    :param ldap_user_dict: Dictionary as returned by find_ldap_user
+    :returns: True if the user was updated, False if not
+    """
+    digest = get_attributes_digest(ldap_user_dict)
+    if ldap_user.attributes_digest == digest:
+        return False
+    user_dict = get_user_dict(ldap_user.user_id)
+    user_dict.update(
+        {
+            field: ldap_user_dict[field]
+            for field in PROFILE_FIELDS
+            if field in ldap_user_dict
+        }
+    )
+    try:
+        toolkit.get_action('user_update')(
+            context={'ignore_auth': True}, data_dict=user_dict
+        )
+    except toolkit.ValidationError as e:
+        # don't store the digest so that the update is tried again on the next login
+        Session.rollback()
+        log.warning(f'Could not update user {user_dict["name"]} from LDAP: {e}')
+        return False
+    ldap_user.attributes_digest = digest
+    Session.commit()
+    return True
+
+
+def get_known_location(login):
+    """
+    Get the DN and entryUUID stored for the LDAP user with the given login, so that they
+    can log in by binding straight to their DN (see search.authenticate_ldap_user).
+
+    :param login: the login the user entered
+    :returns: a 2-tuple of the DN and entryUUID (or None), or None if the login isn't
+        the LDAP username of a user who has logged in since their DN was stored
+    """
+    ldap_user = LdapUser.by_ldap_id(login.strip())
+    if ldap_user is None or not ldap_user.dn:
+        return None
+    return ldap_user.dn, ldap_user.entry_uuid
+
+
+def update_location(ldap_user, ldap_user_dict):
+    """
+    Store the DN and entryUUID of the user's entry, if they have changed.
+
+    :param ldap_user: the LdapUser object
+    :param ldap_user_dict: Dictionary as returned by find_ldap_user
+    :returns: True if they were updated, False if not
+    """
+    dn = ldap_user_dict['cn']
+    entry_uuid = ldap_user_dict.get('entry_uuid')
+    if ldap_user.dn == dn and ldap_user.entry_uuid == entry_uuid:
+        return False
+    ldap_user.dn = dn
+    ldap_user.entry_uuid = entry_uuid
+    Session.commit()
+    return True
+
+
 def get_or_create_ldap_user(ldap_user_dict):
     """
     Get or create a CKAN user from the data returned by the LDAP server.
 
+    Existing users are updated if their details have changed in the directory.
+
+    If ckanext.ldap.groups.mapping is set, the user's organization memberships are
+    updated from their directory groups (see check_memberships).
+
+    If ckanext.ldap.jobs.enabled is set, adding a new user to the
+    ckanext.ldap.organization.id organization and updating an existing user's details
+    and memberships are queued as background jobs, so the login doesn't wait for them.
+
     :param ldap_user_dict: Dictionary as returned by _find_ldap_user
     :returns: The CKAN username of an existing user
     """
     # Look for existing user, and if found return it.
     ldap_user = LdapUser.by_ldap_id(ldap_user_dict['username'])
     if ldap_user:
-        # TODO: Update the user detail.
+        update_location(ldap_user, ldap_user_dict)
+        if not jobs.enabled():
+            update_ldap_user(ldap_user, ldap_user_dict)
+        elif ldap_user.attributes_digest != get_attributes_digest(ldap_user_dict):
+            jobs.enqueue(update_profile, ldap_user.user_id, ldap_user_dict)
+        check_memberships(ldap_user.user_id, ldap_user_dict)
         return ldap_user.user.name
     user_dict = {}
     update = False
@@ -206,50 +435,177 @@ def get_or_create_ldap_user(ldap_user_dict):
             context={'ignore_auth': True}, data_dict=user_dict
         )
     else:
-        ckan_user = toolkit.get_action('user_create')(
-            context={'ignore_auth': True}, data_dict=user_dict
-        )
-    ldap_user = LdapUser(user_id=ckan_user['id'], ldap_id=ldap_user_dict['username'])
+        ckan_user = create_user(user_dict, ldap_user_dict['username'])
+        user_name = ckan_user['name']
+    ldap_user = LdapUser(
+        user_id=ckan_user['id'],
+        ldap_id=ldap_user_dict['username'],
+        attributes_digest=get_attributes_digest(ldap_user_dict),
+        dn=ldap_user_dict['cn'],
+        entry_uuid=ldap_user_dict.get('entry_uuid'),
+    )
     Session.add(ldap_user)
     Session.commit()
     # Add the user to it's group if needed
     if 'ckanext.ldap.organization.id' in toolkit.config:
-        toolkit.get_action('member_create')(
-            context={'ignore_auth': True},
-            data_dict={
-                'id': toolkit.config['ckanext.ldap.organization.id'],
-                'object': user_name,
-                'object_type': 'user',
-                'capacity': toolkit.config['ckanext.ldap.organization.role'],
-            },
+        organization_args = (
+            ckan_user['id'],
+            toolkit.config['ckanext.ldap.organization.id'],
+            toolkit.config['ckanext.ldap.organization.role'],
         )
+        if jobs.enabled():
+            jobs.enqueue(add_to_organization, *organization_args)
+        else:
+            add_to_organization(*organization_args)
+    check_memberships(ckan_user['id'], ldap_user_dict)
     return user_name
 
 
-def check_ldap_password(cn, password):
+def add_to_organization(user_id, organization_id, capacity):
     """
-    Checks that the given cn/password credentials work on the given CN.
+    Make the given user a member of the given organization. If they are already a
+    member, their role is set to the given capacity, so this can safely be run more than
+    once (e.g. as a retried background job).
 
-    :param cn: Common name to log on
-    :param password: Password for cn
-    :returns: True on success, False on failure
+    :param user_id: the CKAN user's id (or name)
+    :param organization_id: the organization's id (or name)
+    :param capacity: the role to give the user
     """
-    cnx = ldap.initialize(
-        toolkit.config['ckanext.ldap.uri'],
-        bytes_mode=False,
-        trace_level=toolkit.config['ckanext.ldap.trace_level'],
+    toolkit.get_action('member_create')(
+        context={'ignore_auth': True},
+        data_dict={
+            'id': organization_id,
+            'object': user_id,
+            'object_type': 'user',
+            'capacity': capacity,
+        },
     )
+
+
+def remove_from_organization(user_id, organization_id):
+    """
+    Remove the given user from the given organization.
+
+    :param user_id: the CKAN user's id (or name)
+    :param organization_id: the organization's id (or name)
+    """
+    toolkit.get_action('member_delete')(
+        context={'ignore_auth': True},
+        data_dict={'id': organization_id, 'object': user_id, 'object_type': 'user'},
+    )
+
+
+def get_membership_changes(user_id, ldap_user_dict):
+    """
+    Work out how the given user's organization memberships (and sysadmin status) need to
+    change to match their directory groups and ckanext.ldap.groups.mapping.
+
+    Only the organizations in the mapping are considered, and users are never removed
+    from ckanext.ldap.organization.id. Sysadmin status is only given if a group maps to
+    "sysadmin", and only taken away if ckanext.ldap.groups.manage_sysadmin is set too
+    (see groups.revokes_sysadmin).
+
+    :param user_id: the CKAN user's id
+    :param ldap_user_dict: Dictionary as returned by find_ldap_user
+    :returns: a 3-tuple of a dictionary of the ids of the organizations whose role needs
+        setting to the role, a set of the ids of the organizations to remove the user
+        from and the sysadmin status to set (or None to leave it); or None if the user
+        or their groups couldn't be found
+    """
+    user = User.get(user_id)
+    if user is None:
+        return None
     try:
-        cnx.bind_s(cn, password)
-    except ldap.SERVER_DOWN:
-        log.error('LDAP server is not reachable')
-        return False
-    except ldap.INVALID_CREDENTIALS:
-        log.debug('Invalid LDAP credentials')
-        return False
-    # Fail on empty password
-    if password == '':
-        log.debug('Invalid LDAP credentials')
+        group_dns = groups.get_user_groups(ldap_user_dict)
+    except OverloadedError:
+        group_dns = None
+    if group_dns is None:
+        # without the groups every membership would look unwanted
+        log.warning(
+            f'Could not find the LDAP groups of {ldap_user_dict["username"]}, leaving '
+            f'their memberships alone'
+        )
+        return None
+    roles, sysadmin = groups.resolve_roles(group_dns)
+    organization_ids, default_id = groups.resolve_organizations()
+    desired = {}
+    for organization, capacity in roles.items():
+        if organization not in organization_ids:
+            log.warning(f'Organization {organization} in the group mapping not found')
+            continue
+        organization_id = organization_ids[organization]
+        desired[organization_id] = groups.highest(
+            capacity, desired.get(organization_id)
+        )
+    current = groups.get_user_memberships(user_id, set(organization_ids.values()))
+    to_set, to_remove = groups.diff_memberships(current, desired, keep={default_id})
+    if user.sysadmin == sysadmin or not (sysadmin or groups.revokes_sysadmin()):
+        sysadmin = None
+    return to_set, to_remove, sysadmin
+
+
+def update_memberships(user_id, ldap_user_dict):
+    """
+    Make the given user's organization memberships (and sysadmin status) match their
+    directory groups (see get_membership_changes). Only the memberships which actually
+    change are written, so this can safely be run more than once (e.g. as a retried
+    background job).
+
+    :param user_id: the CKAN user's id
+    :param ldap_user_dict: Dictionary as returned by find_ldap_user
+    :returns: the number of changes made, or None if the user or their groups couldn't
+        be found
+    """
+    changes = get_membership_changes(user_id, ldap_user_dict)
+    if changes is None:
+        return None
+    to_set, to_remove, sysadmin = changes
+    for organization_id, capacity in to_set.items():
+        add_to_organization(user_id, organization_id, capacity)
+    for organization_id in to_remove:
+        remove_from_organization(user_id, organization_id)
+    if sysadmin is not None:
+        user = User.get(user_id)
+        user.sysadmin = sysadmin
+        Session.commit()
+        log.info(f'Set sysadmin to {sysadmin} for {user.name} from their LDAP groups')
+    return len(to_set) + len(to_remove) + (sysadmin is not None)
+
+
+def check_memberships(user_id, ldap_user_dict):
+    """
+    Update the given user's memberships from their directory groups (see
+    update_memberships), if ckanext.ldap.groups.mapping is set.
+
+    If ckanext.ldap.jobs.enabled is set, the changes are worked out straight away but a
+    background job is only queued to make them if there are any.
+
+    :param user_id: the CKAN user's id
+    :param ldap_user_dict: Dictionary as returned by find_ldap_user
+    """
+    if not groups.enabled():
+        return
+    if not jobs.enabled():
+        update_memberships(user_id, ldap_user_dict)
+        return
+    changes = get_membership_changes(user_id, ldap_user_dict)
+    if changes is not None:
+        to_set, to_remove, sysadmin = changes
+        if to_set or to_remove or sysadmin is not None:
+            jobs.enqueue(update_memberships, user_id, ldap_user_dict)
+
+
+def update_profile(user_id, ldap_user_dict):
+    """
+    Copy the LDAP attributes onto the given CKAN user if they have changed (see
+    update_ldap_user). Run as a background job, so this does nothing if the user has
+    been deleted since it was queued, and nothing more if it is run twice.
+
+    :param user_id: the CKAN user's id
+    :param ldap_user_dict: Dictionary as returned by find_ldap_user
+    :returns: True if the user was updated, False if not
+    """
+    ldap_user = LdapUser.by_user_id(user_id)
+    if ldap_user is None:
         return False
-    cnx.unbind_s()
-    return True
+    return update_ldap_user(ldap_user, ldap_user_dict)
@@ -6,10 +6,17 @@
 
 from ckan.model import User
 from ckan.plugins import toolkit
-from flask import Blueprint
+from flask import Blueprint, Response, request
 
-from ckanext.ldap.lib.exceptions import MultipleMatchError, UserConflictError
-from ckanext.ldap.lib.search import find_ldap_user
+from ckanext.ldap.lib import metrics
+from ckanext.ldap.lib.admission import admitted, get_admission
+from ckanext.ldap.lib.exceptions import (
+    MultipleMatchError,
+    OverloadedError,
+    UserConflictError,
+)
+from ckanext.ldap.lib.search import authenticate_ldap_user
+from ckanext.ldap.lib.throttle import check_login_attempt
 
 from . import _helpers
 
@@ -26,18 +33,33 @@ def login_handler():
     if 'login' in params and 'password' in params:
         login = params['login']
         password = params['password']
+        # before any LDAP work so that throttled attempts cost the directory nothing
+        throttled = check_login_attempt(toolkit.request.remote_addr, login)
+        if throttled:
+            limit, wait = throttled
+            metrics.count_login(f'throttled_{limit}')
+            return _helpers.login_throttled(wait)
         try:
-            ldap_user_dict = find_ldap_user(login)
+            # the search and the bind share one admission slot
+            with admitted():
+                ldap_user_dict, authenticated = authenticate_ldap_user(
+                    login, password, known=_helpers.get_known_location(login)
+                )
         except MultipleMatchError as e:
             # Multiple users match. Inform the user and try again.
+            metrics.count_login('multiple_match')
             return _helpers.login_failed(notice=str(e))
-        if ldap_user_dict and _helpers.check_ldap_password(
-            ldap_user_dict['cn'], password
-        ):
+        except OverloadedError as e:
+            metrics.count_login('overloaded')
+            return _helpers.login_overloaded(e.retry_after)
+        if ldap_user_dict and authenticated:
             try:
-                user_name = _helpers.get_or_create_ldap_user(ldap_user_dict)
+                with metrics.timed('get_or_create_user'):
+                    user_name = _helpers.get_or_create_ldap_user(ldap_user_dict)
             except UserConflictError as e:
+                metrics.count_login('user_conflict')
                 return _helpers.login_failed(error=str(e))
+            metrics.count_login('success')
             return _helpers.login_success(user_name, came_from=came_from)
         elif ldap_user_dict:
             # There is an LDAP user, but the auth is wrong. There could be a
@@ -46,11 +68,13 @@ def login_handler():
             if toolkit.config['ckanext.ldap.ckan_fallback']:
                 exists = _helpers.ckan_user_exists(login)
                 if exists['exists'] and not exists['is_ldap']:
+                    metrics.count_login('username_conflict')
                     return _helpers.login_failed(
                         error=toolkit._(
                             'Username conflict. Please contact the site administrator.'
                         )
                     )
+            metrics.count_login('LDAP1')
             return _helpers.login_failed(
                 error=toolkit._('Bad username or password.') + ' [LDAP1]'
             )
@@ -63,15 +87,36 @@ def login_handler():
             except toolkit.ObjectNotFound:
                 user = None
             if user and user.validate_password(password):
+                metrics.count_login('ckan_success')
                 return _helpers.login_success(user.name, came_from=came_from)
             else:
+                metrics.count_login('LDAP2')
                 return _helpers.login_failed(
                     error=toolkit._('Bad username or password.') + ' [LDAP2]'
                 )
         else:
+            metrics.count_login('LDAP3')
             return _helpers.login_failed(
                 error=toolkit._('Bad username or password.') + ' [LDAP3]'
             )
+    metrics.count_login('missing_credentials')
     return _helpers.login_failed(
         error=toolkit._('Please enter a username and password')
     )
+
+
+@blueprint.route('/ldap/metrics')
+def metrics_handler():
+    """
+    Expose the LDAP metrics in the Prometheus text format, if enabled, to sysadmins and
+    to requests with the ckanext.ldap.metrics.token bearer token.
+    """
+    if not toolkit.config['ckanext.ldap.metrics.enabled']:
+        return toolkit.abort(404)
+    if not metrics.authorised(
+        request.headers.get('Authorization'), getattr(toolkit.g, 'userobj', None)
+    ):
+        return toolkit.abort(403)
+    get_admission().report_saturation()
+    body, content_type = metrics.generate()
+    return Response(body, content_type=content_type)
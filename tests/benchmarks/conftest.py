@@ -0,0 +1,29 @@
+import pytest
+
+from ckanext.ldap.lib.fake_ldap import generate_users, make_directory
+from ckanext.ldap.lib.pool import reset_pool
+from ckanext.ldap.lib.search import reset_lookup_cache
+from ckanext.ldap.lib.servers import reset_servers
+from tests.helpers.benchmark import injected_latency
+
+# the number of users in the fake directory
+DIRECTORY_SIZE = 2000
+
+
+@pytest.fixture
+def fake_directory():
+    """
+    Route every LDAP connection to a fake directory of generated users.
+
+    :returns: a 2-tuple of the list of users and the FakeDirectory
+    """
+    users = generate_users(DIRECTORY_SIZE, seed=0)
+    directory = make_directory(users, latency=injected_latency())
+    with directory.installed():
+        reset_pool()
+        reset_servers()
+        reset_lookup_cache()
+        yield users, directory
+    reset_pool()
+    reset_servers()
+    reset_lookup_cache()
@@ -0,0 +1,146 @@
+import pytest
+from ckan.logic import NotAuthorized, check_access
+from ckan.model import User
+
+from ckanext.ldap.lib.search import find_ldap_user, reset_lookup_cache
+from ckanext.ldap.model.ldap_user import LdapUser
+from ckanext.ldap.routes._helpers import get_or_create_ldap_user
+from tests.helpers.benchmark import (
+    benchmark,
+    measure,
+    per_call,
+    report,
+    with_fake_ldap_config,
+)
+
+ITERATIONS = 200
+
+
+def login(app, user, password=None):
+    return app.post(
+        '/ldap_login_handler',
+        data={
+            'login': user['login'],
+            'password': user['password'] if password is None else password,
+        },
+        follow_redirects=False,
+    )
+
+
+def log_in_all(app, users):
+    for user in users:
+        login(app, user)
+
+
+@benchmark
+@with_fake_ldap_config
+@pytest.mark.ckan_config('ckan.plugins', 'ldap')
+@pytest.mark.ckan_config('ckanext.ldap.prevent_edits', 'true')
+@pytest.mark.usefixtures('clean_db', 'ensure_db_init', 'with_plugins')
+@pytest.mark.filterwarnings('ignore::sqlalchemy.exc.SADeprecationWarning')
+class TestLoginBenchmarks:
+    def test_first_logins(self, app, fake_directory):
+        users, directory = fake_directory
+        # warm up with a user we don't measure
+        login(app, users[-1])
+        directory.reset_counts()
+
+        stats = measure(lambda i: login(app, users[i]), ITERATIONS)
+
+        report('first login', stats, ldap=per_call(directory, ITERATIONS))
+        ldap_users = LdapUser.by_ldap_ids([user['uid'] for user in users[:ITERATIONS]])
+        assert None not in ldap_users.values()
+
+    def test_repeat_logins(self, app, fake_directory):
+        users, directory = fake_directory
+        log_in_all(app, users[:ITERATIONS])
+        directory.reset_counts()
+
+        stats = measure(lambda i: login(app, users[i]), ITERATIONS)
+
+        report('repeat login', stats, ldap=per_call(directory, ITERATIONS))
+
+    def test_failed_logins(self, app, fake_directory):
+        users, directory = fake_directory
+        directory.reset_counts()
+
+        stats = measure(lambda i: login(app, users[i], password='nope'), ITERATIONS)
+
+        report(
+            'failed login (bad password)', stats, ldap=per_call(directory, ITERATIONS)
+        )
+
+    def test_unknown_user_logins(self, app, fake_directory):
+        _, directory = fake_directory
+        unknown = {'login': 'nobody', 'password': 'nope'}
+        directory.reset_counts()
+
+        stats = measure(lambda i: login(app, unknown), ITERATIONS)
+
+        report(
+            'failed login (unknown user)', stats, ldap=per_call(directory, ITERATIONS)
+        )
+
+
+@benchmark
+@with_fake_ldap_config
+@pytest.mark.ckan_config('ckan.plugins', 'ldap')
+@pytest.mark.ckan_config('ckanext.ldap.prevent_edits', 'true')
+@pytest.mark.usefixtures(
+    'clean_db', 'ensure_db_init', 'with_plugins', 'with_request_context'
+)
+@pytest.mark.filterwarnings('ignore::sqlalchemy.exc.SADeprecationWarning')
+class TestLookupBenchmarks:
+    def test_find_ldap_user(self, fake_directory):
+        users, directory = fake_directory
+        find_ldap_user(users[-1]['login'])
+        directory.reset_counts()
+
+        def uncached(i):
+            reset_lookup_cache()
+            assert find_ldap_user(users[i]['login']) is not None
+
+        stats = measure(uncached, ITERATIONS)
+        report('find_ldap_user (uncached)', stats, ldap=per_call(directory, ITERATIONS))
+
+        stats = measure(lambda i: find_ldap_user(users[i]['login']), ITERATIONS)
+        report('find_ldap_user (cached)', stats, ldap=per_call(directory, ITERATIONS))
+
+    def test_get_or_create_existing(self, fake_directory):
+        users, _ = fake_directory
+        ldap_user_dicts = [find_ldap_user(user['login']) for user in users[:ITERATIONS]]
+        for ldap_user_dict in ldap_user_dicts:
+            get_or_create_ldap_user(ldap_user_dict)
+
+        def get_or_create(i):
+            # each login is a new request
+            LdapUser.forget()
+            get_or_create_ldap_user(ldap_user_dicts[i])
+
+        stats = measure(get_or_create, ITERATIONS)
+
+        report('get_or_create_ldap_user (existing)', stats)
+
+    def test_auth_checks(self, fake_directory):
+        users, _ = fake_directory
+        for user in users[:ITERATIONS]:
+            get_or_create_ldap_user(find_ldap_user(user['login']))
+        ldap_users = LdapUser.by_ldap_ids([user['uid'] for user in users[:ITERATIONS]])
+        names = [User.get(ldap_user.user_id).name for ldap_user in ldap_users.values()]
+        ids = [ldap_user.user_id for ldap_user in ldap_users.values()]
+
+        def user_update_check(i):
+            LdapUser.forget()
+            # LDAP users can't be edited when prevent_edits is set
+            with pytest.raises(NotAuthorized):
+                check_access('user_update', {'user': names[i]}, {'id': ids[i]})
+
+        def user_create_check(i):
+            # the new name clashes with an LDAP user
+            with pytest.raises(NotAuthorized):
+                check_access('user_create', {}, {'name': users[i]['login']})
+
+        stats = measure(user_update_check, ITERATIONS)
+        report('user_update auth check', stats)
+        stats = measure(user_create_check, ITERATIONS)
+        report('user_create auth check', stats)
@@ -0,0 +1,59 @@
+import uuid
+
+import pytest
+from ckan import model
+from ckan.tests import factories
+
+from ckanext.ldap.routes._helpers import get_or_create_ldap_user
+from tests.helpers.benchmark import benchmark, measure, report
+
+
+@benchmark
+@pytest.mark.ckan_config('ckan.plugins', 'ldap')
+@pytest.mark.ckan_config('ckanext.ldap.uri', 'n/a')
+@pytest.mark.ckan_config('ckanext.ldap.base_dn', 'n/a')
+@pytest.mark.ckan_config('ckanext.ldap.search.filter', 'n/a')
+@pytest.mark.ckan_config('ckanext.ldap.username', 'n/a')
+@pytest.mark.ckan_config('ckanext.ldap.email', 'n/a')
+@pytest.mark.usefixtures(
+    'clean_db', 'ensure_db_init', 'with_plugins', 'with_request_context'
+)
+@pytest.mark.filterwarnings('ignore::sqlalchemy.exc.SADeprecationWarning')
+def test_first_login_latency_with_name_collisions():
+    """
+    First logins for a common name should cost the same however many users already
+    have that name (plus a suffix).
+    """
+    # make sure everything is warmed up
+    factories.User(name='warmup')
+
+    logins = iter(range(100000))
+
+    def first_login(_):
+        # a distinct LDAP id every time which still maps to the base name "smith_"
+        ldap_id = f'smith{chr(0x4E00 + next(logins))}'
+        get_or_create_ldap_user(
+            {
+                'cn': f'cn={ldap_id}',
+                'username': ldap_id,
+                'email': f'{uuid.uuid4().hex}@example.com',
+            }
+        )
+
+    def add_collisions(count):
+        existing = model.Session.query(model.User).filter(
+            model.User.name.like('smith\\_%', escape='\\')
+        )
+        for i in range(existing.count(), count):
+            model.Session.add(
+                model.User(name=f'smith_{i or ""}', email=f'smith{i}@example.com')
+            )
+        model.Session.commit()
+
+    results = {}
+    for collisions in [0, 10, 100, 1000]:
+        add_collisions(collisions)
+        results[collisions] = measure(first_login, 10)
+        report(f'first login with {collisions} collisions', results[collisions])
+
+    assert results[1000]['p50'] < results[0]['p50'] * 3
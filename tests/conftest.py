@@ -1,5 +1,6 @@
 import pytest
 
+from ckanext.ldap.model.ldap_sync_state import ldap_sync_state_table
 from ckanext.ldap.model.ldap_user import ldap_user_table
 
 try:
@@ -21,3 +22,4 @@ def ensure_db_init():
     """
     engine = ensure_engine()
     ldap_user_table.create(engine, checkfirst=True)
+    ldap_sync_state_table.create(engine, checkfirst=True)
@@ -0,0 +1,97 @@
+import os
+import statistics
+import time
+
+import pytest
+
+from ckanext.ldap.lib.fake_ldap import CONFIG
+
+# benchmarks are slow, so they only run when asked for
+benchmark = pytest.mark.skipif(
+    not os.environ.get('CKANEXT_LDAP_BENCHMARKS'),
+    reason='set CKANEXT_LDAP_BENCHMARKS=1 to run the benchmarks',
+)
+
+
+def percentile(timings, percent):
+    """
+    Get the given percentile of a list of timings (nearest rank).
+
+    :param timings: a list of timings
+    :param percent: the percentile, 0-100
+    :returns: the timing at that percentile
+    """
+    ordered = sorted(timings)
+    index = max(0, min(len(ordered) - 1, round(percent / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def measure(function, iterations):
+    """
+    Call the given function repeatedly and time each call.
+
+    :param function: the function to time, called with the iteration number
+    :param iterations: the number of times to call it
+    :returns: a dictionary of ops/sec, p50, p99 and mean (in seconds)
+    """
+    timings = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        function(i)
+        timings.append(time.perf_counter() - start)
+    return {
+        'ops': len(timings) / sum(timings),
+        'p50': percentile(timings, 50),
+        'p99': percentile(timings, 99),
+        'mean': statistics.mean(timings),
+    }
+
+
+def report(name, stats, **extra):
+    """
+    Print the results of a benchmark (run pytest with -s to see them).
+
+    :param name: the name of the benchmark
+    :param stats: the dictionary returned by measure
+    :param extra: other figures to print, e.g. LDAP operations per call
+    """
+    extras = ' '.join(f'{key}={value}' for key, value in extra.items())
+    print(
+        f'{name:<40} {stats["ops"]:>10.1f} ops/s '
+        f'p50 {stats["p50"] * 1000:>8.2f}ms p99 {stats["p99"] * 1000:>8.2f}ms {extras}'
+    )
+
+
+def with_fake_ldap_config(target):
+    """
+    Decorator which applies the config needed to use a fake LDAP directory to a test.
+    """
+    for key, value in CONFIG.items():
+        target = pytest.mark.ckan_config(key, value)(target)
+    return target
+
+
+def injected_latency():
+    """
+    Get the latency to inject into each fake LDAP operation from the
+    CKANEXT_LDAP_BENCHMARK_LATENCY environment variable (in milliseconds).
+
+    :returns: the latency in seconds
+    """
+    return float(os.environ.get('CKANEXT_LDAP_BENCHMARK_LATENCY', 0)) / 1000
+
+
+def per_call(directory, iterations):
+    """
+    Get the number of fake LDAP operations performed per call, and reset the counts.
+
+    :param directory: the FakeDirectory
+    :param iterations: the number of calls
+    :returns: a string like "bind=1.00,search=2.00"
+    """
+    counts = directory.counts
+    directory.reset_counts()
+    return ','.join(
+        f'{operation}={count / iterations:.2f}'
+        for operation, count in sorted(counts.items())
+    )
@@ -1,11 +1,28 @@
+import json
 from unittest.mock import MagicMock, patch
 
 import pytest
 from ckan.lib.helpers import url_for
+from ckan.model import Session, User
 from ckan.plugins import toolkit
 from ckan.tests import factories
 
-from ckanext.ldap.routes._helpers import login_failed, login_success
+from ckanext.ldap.lib.identity import COOKIE_NAME
+from ckanext.ldap.model.ldap_user import LdapUser
+from ckanext.ldap.routes._helpers import (
+    ckan_user_exists,
+    ckan_users_exist,
+    get_attributes_digest,
+    get_known_location,
+    get_or_create_ldap_user,
+    login_failed,
+    login_overloaded,
+    login_success,
+    login_throttled,
+    update_ldap_user,
+    update_memberships,
+    update_profile,
+)
 
 
 @pytest.mark.filterwarnings('ignore::sqlalchemy.exc.SADeprecationWarning')
@@ -23,10 +40,44 @@ def test_login_failed(flash_notice_mock: MagicMock, flash_error_mock: MagicMock)
     assert response.location.endswith(url_for('user.login'))
 
 
+@pytest.mark.usefixtures('with_request_context')
+def test_login_throttled():
+    response = login_throttled(1.2)
+
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '2'
+    assert '2 seconds' in response.get_data(as_text=True)
+
+
+@pytest.mark.usefixtures('with_request_context')
+def test_login_overloaded():
+    response = login_overloaded(3)
+
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '3'
+
+
 IS_CKAN_210_OR_HIGHER = toolkit.check_ckan_version(min_version='2.10.0')
 IS_CKAN_29_OR_LOWER = not IS_CKAN_210_OR_HIGHER
 
 
+@pytest.mark.filterwarnings('ignore::sqlalchemy.exc.SADeprecationWarning')
+@pytest.mark.usefixtures('clean_db', 'ensure_db_init', 'with_request_context')
+@pytest.mark.ckan_config('ckanext.ldap.identity_cookie.enabled', True)
+@pytest.mark.ckan_config('ckanext.ldap.identity_cookie.secret', 'beans')
+@patch('ckan.plugins.toolkit.login_user', return_value=True, create=True)
+@patch('ckanext.ldap.routes._helpers.session')
+def test_login_success_identity_cookie(mock_session: MagicMock, login_user: MagicMock):
+    user = factories.User()
+
+    response = login_success(user['name'], 'somewhere_else')
+
+    # the user is remembered by the cookie, not the session
+    mock_session.__setitem__.assert_not_called()
+    assert response.status_code == 302
+    assert response.headers['Set-Cookie'].startswith(f'{COOKIE_NAME}={user["id"]}.')
+
+
 @pytest.mark.skipif(IS_CKAN_210_OR_HIGHER, reason='requires CKAN 2.9 or lower')
 @pytest.mark.filterwarnings('ignore::sqlalchemy.exc.SADeprecationWarning')
 @pytest.mark.usefixtures('clean_db', 'ensure_db_init')
@@ -165,3 +216,199 @@ class TestLoginSuccess210:
         assert not login_user.called
         assert response.status_code == 302
         assert response.location.endswith(url_for('user.login'))
+
+
+@pytest.mark.filterwarnings('ignore::sqlalchemy.exc.SADeprecationWarning')
+@pytest.mark.usefixtures('clean_db', 'ensure_db_init')
+class TestCkanUsersExist:
+    def test_batch(self):
+        ckan_user = factories.User()
+        ldap_user = factories.User()
+        Session.add(LdapUser(user_id=ldap_user['id'], ldap_id='beans'))
+        Session.commit()
+
+        result = ckan_users_exist([ckan_user['name'], ldap_user['id'], 'nope'])
+
+        assert result == {
+            ckan_user['name']: {'exists': True, 'is_ldap': False},
+            ldap_user['id']: {'exists': True, 'is_ldap': True},
+            'nope': {'exists': False, 'is_ldap': False},
+        }
+
+    def test_single(self):
+        user = factories.User()
+        assert ckan_user_exists(user['name']) == {'exists': True, 'is_ldap': False}
+        assert ckan_user_exists('nope') == {'exists': False, 'is_ldap': False}
+
+
+@pytest.mark.filterwarnings('ignore::sqlalchemy.exc.SADeprecationWarning')
+@pytest.mark.usefixtures('clean_db', 'ensure_db_init')
+class TestUpdateLdapUser:
+    def make_ldap_user(self, ldap_user_dict):
+        user = factories.User(email=ldap_user_dict['email'])
+        ldap_user = LdapUser(
+            user_id=user['id'],
+            ldap_id='beans',
+            attributes_digest=get_attributes_digest(ldap_user_dict),
+        )
+        Session.add(ldap_user)
+        Session.commit()
+        return ldap_user
+
+    def test_unchanged(self):
+        ldap_user_dict = {'username': 'beans', 'email': 'beans@example.com'}
+        ldap_user = self.make_ldap_user(ldap_user_dict)
+
+        with patch('ckan.plugins.toolkit.get_action') as get_action:
+            assert not update_ldap_user(ldap_user, dict(ldap_user_dict))
+        assert not get_action.called
+
+    def test_changed(self):
+        ldap_user_dict = {'username': 'beans', 'email': 'beans@example.com'}
+        ldap_user = self.make_ldap_user(ldap_user_dict)
+        ldap_user_dict['fullname'] = 'Mr Beans'
+
+        assert update_ldap_user(ldap_user, ldap_user_dict)
+        assert ldap_user.user.fullname == 'Mr Beans'
+        assert ldap_user.attributes_digest == get_attributes_digest(ldap_user_dict)
+
+    def test_update_profile_deleted_user(self):
+        assert not update_profile('nope', {'username': 'beans'})
+
+
+@pytest.mark.filterwarnings('ignore::sqlalchemy.exc.SADeprecationWarning')
+@pytest.mark.usefixtures('clean_db', 'ensure_db_init')
+@pytest.mark.ckan_config('ckanext.ldap.jobs.enabled', True)
+class TestGetOrCreateWithJobs:
+    @pytest.mark.ckan_config('ckanext.ldap.organization.id', 'org')
+    def test_first_login_queues_membership(self):
+        ldap_user_dict = {'username': 'beans', 'email': 'beans@example.com'}
+        with patch('ckanext.ldap.routes._helpers.jobs.enqueue') as enqueue:
+            user_name = get_or_create_ldap_user(ldap_user_dict)
+
+        assert LdapUser.by_ldap_id('beans').user.name == user_name
+        enqueue.assert_called_once()
+        assert enqueue.call_args.args[0].__name__ == 'add_to_organization'
+
+    def test_changed_details_are_queued(self):
+        ldap_user_dict = {'username': 'beans', 'email': 'beans@example.com'}
+        get_or_create_ldap_user(dict(ldap_user_dict))
+        ldap_user_dict['fullname'] = 'Mr Beans'
+
+        with patch('ckanext.ldap.routes._helpers.jobs.enqueue') as enqueue:
+            get_or_create_ldap_user(dict(ldap_user_dict))
+            get_or_create_ldap_user(dict(ldap_user_dict))
+
+        assert enqueue.call_count == 2
+        function, user_id, queued_dict = enqueue.call_args.args
+        # nothing has changed yet
+        assert LdapUser.by_ldap_id('beans').user.fullname != 'Mr Beans'
+        assert function(user_id, queued_dict)
+        assert LdapUser.by_ldap_id('beans').user.fullname == 'Mr Beans'
+
+
+@pytest.mark.filterwarnings('ignore::sqlalchemy.exc.SADeprecationWarning')
+@pytest.mark.usefixtures('clean_db', 'ensure_db_init')
+class TestKnownLocation:
+    def test_stored_and_updated(self):
+        ldap_user_dict = {
+            'cn': 'uid=beans,ou=people,dc=example,dc=com',
+            'username': 'beans',
+            'email': 'beans@example.com',
+            'entry_uuid': 'f81d4fae-7dec-11d0-a765-00a0c91e6bf6',
+        }
+        assert get_known_location('beans') is None
+        get_or_create_ldap_user(dict(ldap_user_dict))
+        LdapUser.forget()
+        assert get_known_location(' beans ') == (
+            ldap_user_dict['cn'],
+            ldap_user_dict['entry_uuid'],
+        )
+
+        ldap_user_dict['cn'] = 'uid=beans,ou=moved,dc=example,dc=com'
+        get_or_create_ldap_user(dict(ldap_user_dict))
+        LdapUser.forget()
+        assert get_known_location('beans')[0] == ldap_user_dict['cn']
+
+
+CURATORS = 'cn=curators,ou=groups,dc=example,dc=com'
+ADMINS = 'cn=admins,ou=groups,dc=example,dc=com'
+
+
+@pytest.mark.filterwarnings('ignore::sqlalchemy.exc.SADeprecationWarning')
+@pytest.mark.usefixtures('clean_db', 'ensure_db_init')
+@pytest.mark.ckan_config(
+    'ckanext.ldap.groups.mapping',
+    json.dumps(
+        {
+            CURATORS: ['collections:editor', 'library:member'],
+            ADMINS: ['collections:admin', 'sysadmin'],
+        }
+    ),
+)
+class TestUpdateMemberships:
+    ldap_user_dict = {'cn': 'uid=beans,ou=people,dc=example,dc=com', 'username': 'b'}
+
+    def memberships(self, user):
+        return {
+            organization['name']: organization['capacity']
+            for organization in toolkit.get_action('organization_list_for_user')(
+                {'ignore_auth': True}, {'id': user['id'], 'permission': 'read'}
+            )
+        }
+
+    def update(self, user, group_dns):
+        with patch(
+            'ckanext.ldap.routes._helpers.groups.get_user_groups',
+            return_value=frozenset(group_dns),
+        ):
+            return update_memberships(user['id'], dict(self.ldap_user_dict))
+
+    @pytest.mark.ckan_config('ckanext.ldap.groups.manage_sysadmin', True)
+    def test_reconcile(self):
+        factories.Organization(name='collections')
+        factories.Organization(name='library')
+        other = factories.Organization(name='other')
+        user = factories.User()
+        toolkit.get_action('member_create')(
+            {'ignore_auth': True},
+            {
+                'id': other['id'],
+                'object': user['id'],
+                'object_type': 'user',
+                'capacity': 'member',
+            },
+        )
+
+        assert self.update(user, [CURATORS]) == 2
+        assert self.memberships(user) == {
+            'collections': 'editor',
+            'library': 'member',
+            'other': 'member',
+        }
+
+        assert self.update(user, [CURATORS, ADMINS]) == 2
+        assert self.memberships(user)['collections'] == 'admin'
+        assert User.get(user['id']).sysadmin
+
+        # nothing changes, so nothing is written
+        with patch('ckanext.ldap.routes._helpers.add_to_organization') as add:
+            assert self.update(user, [CURATORS, ADMINS]) == 0
+        add.assert_not_called()
+
+        # organizations which aren't mapped are left alone
+        assert self.update(user, []) == 3
+        assert not User.get(user['id']).sysadmin
+
+    def test_sysadmin_is_kept_by_default(self):
+        user = factories.User(sysadmin=True)
+        assert self.update(user, []) == 0
+        assert User.get(user['id']).sysadmin
+
+    def test_groups_not_found(self):
+        user = factories.User()
+        with patch(
+            'ckanext.ldap.routes._helpers.groups.get_user_groups', return_value=None
+        ), patch('ckanext.ldap.routes._helpers.remove_from_organization') as remove:
+            assert update_memberships(user['id'], dict(self.ldap_user_dict)) is None
+        remove.assert_not_called()
@@ -0,0 +1,90 @@
+import threading
+
+import pytest
+from mock import MagicMock
+
+from ckanext.ldap.lib.admission import AdmissionController
+from ckanext.ldap.lib.exceptions import OverloadedError, StoreError
+from ckanext.ldap.lib.store import MemoryStore
+
+
+def make_controller(**kwargs):
+    kwargs.setdefault('queue_size', 0)
+    kwargs.setdefault('timeout', 0)
+    kwargs.setdefault('poll_interval', 0.001)
+    return AdmissionController(MemoryStore(), 1, **kwargs)
+
+
+def hold(controller, entered, leave):
+    def run():
+        with controller.admitted():
+            entered.set()
+            leave.wait(5)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    assert entered.wait(5)
+    return thread
+
+
+class TestAdmissionController:
+    def test_admits_up_to_limit(self):
+        controller = make_controller()
+        entered, leave = threading.Event(), threading.Event()
+        thread = hold(controller, entered, leave)
+
+        with pytest.raises(OverloadedError) as e:
+            with controller.admitted():
+                pass
+        assert e.value.reason == 'queue_full'
+
+        leave.set()
+        thread.join()
+        with controller.admitted():
+            pass
+
+    def test_reentrant(self):
+        controller = make_controller()
+        with controller.admitted():
+            with controller.admitted():
+                pass
+            assert controller.store.count('admission') == 1
+        assert controller.store.count('admission') == 0
+
+    def test_released_on_error(self):
+        controller = make_controller()
+        with pytest.raises(ValueError):
+            with controller.admitted():
+                raise ValueError()
+        assert controller.store.count('admission') == 0
+
+    def test_waits_for_a_slot(self):
+        controller = make_controller(queue_size=1, timeout=5)
+        entered, leave = threading.Event(), threading.Event()
+        thread = hold(controller, entered, leave)
+        threading.Timer(0.05, leave.set).start()
+
+        with controller.admitted():
+            assert controller.waiting == 0
+        thread.join()
+
+    def test_times_out(self):
+        controller = make_controller(queue_size=1, timeout=0.05)
+        entered, leave = threading.Event(), threading.Event()
+        thread = hold(controller, entered, leave)
+
+        with pytest.raises(OverloadedError) as e:
+            with controller.admitted():
+                pass
+        assert e.value.reason == 'timeout'
+        assert e.value.retry_after == 1
+        assert controller.waiting == 0
+
+        leave.set()
+        thread.join()
+
+    def test_store_errors_admit(self):
+        store = MagicMock(acquire=MagicMock(side_effect=StoreError('down')))
+        controller = AdmissionController(store, 1)
+        with controller.admitted():
+            pass
@@ -1,9 +1,12 @@
 import pytest
+from ckan import model
 from ckan.logic import NotAuthorized, check_access
 from ckan.plugins import toolkit
 from ckan.tests import factories
 from mock import MagicMock, patch
 
+from ckanext.ldap.lib.exceptions import OverloadedError
+
 
 @pytest.mark.ckan_config('ckan.plugins', 'ldap')
 @pytest.mark.ckan_config('ckanext.ldap.uri', 'n/a')
@@ -35,3 +38,82 @@ class TestAuthPasswordReset:
                 NotAuthorized, match='Cannot reset password for LDAP user'
             ):
                 check_access('user_reset', {'user': user['name']})
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'ldap')
+@pytest.mark.ckan_config('ckanext.ldap.uri', 'n/a')
+@pytest.mark.ckan_config('ckanext.ldap.base_dn', 'n/a')
+@pytest.mark.ckan_config('ckanext.ldap.search.filter', 'n/a')
+@pytest.mark.ckan_config('ckanext.ldap.username', 'n/a')
+@pytest.mark.ckan_config('ckanext.ldap.email', 'n/a')
+@pytest.mark.usefixtures(
+    'clean_db', 'ensure_db_init', 'with_plugins', 'with_request_context'
+)
+@pytest.mark.filterwarnings('ignore::sqlalchemy.exc.SADeprecationWarning')
+class TestAuthOverloaded:
+    def test_user_create_is_refused(self):
+        find_ldap_user = MagicMock(side_effect=OverloadedError('timeout', 2))
+        with patch('ckanext.ldap.logic.auth.find_ldap_user', find_ldap_user):
+            with pytest.raises(NotAuthorized, match='Cannot check LDAP users'):
+                check_access('user_create', {}, {'name': 'beans'})
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'ldap')
+@pytest.mark.ckan_config('ckanext.ldap.uri', 'n/a')
+@pytest.mark.ckan_config('ckanext.ldap.base_dn', 'n/a')
+@pytest.mark.ckan_config('ckanext.ldap.search.filter', 'n/a')
+@pytest.mark.ckan_config('ckanext.ldap.username', 'n/a')
+@pytest.mark.ckan_config('ckanext.ldap.email', 'n/a')
+@pytest.mark.usefixtures(
+    'clean_db', 'ensure_db_init', 'with_plugins', 'with_request_context'
+)
+@pytest.mark.filterwarnings('ignore::sqlalchemy.exc.SADeprecationWarning')
+class TestAuthUserUpdate:
+    def test_name_clash(self):
+        user = factories.User()
+        find_ldap_user = MagicMock(return_value={'username': 'beans'})
+        with patch('ckanext.ldap.logic.auth.find_ldap_user', find_ldap_user):
+            with pytest.raises(NotAuthorized, match='An LDAP user by that name'):
+                check_access(
+                    'user_update',
+                    {'user': user['name']},
+                    {'id': user['id'], 'name': 'beans'},
+                )
+
+    def test_own_ldap_name_is_allowed(self):
+        user = factories.User()
+        ldap_user = MagicMock(ldap_id='beans')
+        find_ldap_user = MagicMock(return_value={'username': 'beans'})
+        with patch('ckanext.ldap.logic.auth.find_ldap_user', find_ldap_user), patch(
+            'ckanext.ldap.logic.auth.LdapUser.by_user_id', return_value=ldap_user
+        ):
+            assert check_access(
+                'user_update',
+                {'user': user['name']},
+                {'id': user['id'], 'name': 'beans'},
+            )
+
+    def test_decision_is_remembered(self):
+        user = factories.User()
+        find_ldap_user = MagicMock(return_value=None)
+        with patch('ckanext.ldap.logic.auth.find_ldap_user', find_ldap_user):
+            for _ in range(3):
+                assert check_access(
+                    'user_update',
+                    {'user': user['name']},
+                    {'id': user['id'], 'name': 'beans'},
+                )
+        find_ldap_user.assert_called_once_with('beans')
+
+    def test_decision_is_forgotten_when_the_user_changes(self):
+        user = factories.User()
+        find_ldap_user = MagicMock(return_value=None)
+        context = {'user': user['name']}
+        data_dict = {'id': user['id'], 'name': 'beans'}
+        with patch('ckanext.ldap.logic.auth.find_ldap_user', find_ldap_user):
+            check_access('user_update', dict(context), data_dict)
+            user_obj = model.User.get(user['id'])
+            user_obj.fullname = 'Beans'
+            model.Session.commit()
+            check_access('user_update', dict(context), data_dict)
+        assert find_ldap_user.call_count == 2
@@ -0,0 +1,134 @@
+import pytest
+from mock import MagicMock, patch
+
+from ckanext.ldap.lib import basic_auth
+from ckanext.ldap.lib.exceptions import OverloadedError
+
+LDAP_USER = {'cn': 'uid=beans,ou=people,dc=example,dc=com', 'username': 'beans'}
+
+
+def make_request(scheme='basic', username='beans', password='password'):
+    authorization = MagicMock(type=scheme, username=username, password=password)
+    return MagicMock(authorization=authorization, remote_addr='10.0.0.1')
+
+
+@pytest.fixture
+def request_with_credentials():
+    with patch.object(basic_auth.toolkit, 'request', make_request(), create=True):
+        yield
+
+
+@pytest.fixture
+def ldap_mocks():
+    authenticate = MagicMock(return_value=(dict(LDAP_USER), True))
+    get_or_create = MagicMock(return_value='beans')
+    with patch(
+        'ckanext.ldap.lib.basic_auth.authenticate_ldap_user', authenticate
+    ), patch(
+        'ckanext.ldap.lib.basic_auth._helpers.get_or_create_ldap_user', get_or_create
+    ), patch(
+        'ckanext.ldap.lib.basic_auth._helpers.get_known_location', return_value=None
+    ), patch(
+        'ckanext.ldap.lib.basic_auth.check_login_attempt', return_value=None
+    ) as check:
+        basic_auth.reset_cache()
+        yield authenticate, get_or_create, check
+        basic_auth.reset_cache()
+
+
+class TestGetCredentials:
+    def test_basic(self):
+        with patch.object(basic_auth.toolkit, 'request', make_request(), create=True):
+            assert basic_auth.get_credentials() == ('beans', 'password')
+
+    @pytest.mark.parametrize(
+        'request_',
+        [
+            MagicMock(authorization=None),
+            make_request(scheme='bearer'),
+            make_request(username=''),
+            make_request(password=None),
+        ],
+    )
+    def test_no_credentials(self, request_):
+        with patch.object(basic_auth.toolkit, 'request', request_, create=True):
+            assert basic_auth.get_credentials() is None
+
+
+@pytest.mark.ckan_config('ckanext.ldap.cache.size', 100)
+@pytest.mark.ckan_config('ckanext.ldap.basic_auth.cache_ttl', 60)
+@pytest.mark.ckan_config('ckanext.ldap.basic_auth.negative_ttl', 60)
+@pytest.mark.ckan_config('ckanext.ldap.admission.limit', 0)
+@pytest.mark.usefixtures('request_with_credentials')
+class TestIdentifyRequest:
+    def test_success_is_cached(self, ldap_mocks):
+        authenticate, get_or_create, _ = ldap_mocks
+        assert basic_auth.identify_request() == ('beans', None)
+        assert basic_auth.identify_request() == ('beans', None)
+        authenticate.assert_called_once_with('beans', 'password', known=None)
+        get_or_create.assert_called_once()
+
+    def test_rejection_is_cached(self, ldap_mocks):
+        authenticate, get_or_create, _ = ldap_mocks
+        authenticate.return_value = (dict(LDAP_USER), False)
+        for _ in range(2):
+            user_name, response = basic_auth.identify_request()
+            assert user_name is None
+            assert response.status_code == 401
+            assert 'WWW-Authenticate' in response.headers
+        authenticate.assert_called_once()
+        get_or_create.assert_not_called()
+
+    def test_unknown_user_falls_back(self, ldap_mocks):
+        # e.g. a local CKAN user, or a proxy's own credentials
+        authenticate, get_or_create, _ = ldap_mocks
+        authenticate.return_value = (None, False)
+        assert basic_auth.identify_request() == (None, None)
+        assert basic_auth.identify_request() == (None, None)
+        authenticate.assert_called_once()
+        get_or_create.assert_not_called()
+
+    @pytest.mark.ckan_config('ckanext.ldap.basic_auth.negative_ttl', 0)
+    def test_unknown_user_is_checked_again(self, ldap_mocks):
+        # the user may not be found because the server is down
+        authenticate, _, _ = ldap_mocks
+        authenticate.return_value = (None, False)
+        basic_auth.identify_request()
+        basic_auth.identify_request()
+        assert authenticate.call_count == 2
+
+    def test_different_password_is_checked(self, ldap_mocks):
+        authenticate, _, _ = ldap_mocks
+        basic_auth.identify_request()
+        with patch.object(
+            basic_auth.toolkit, 'request', make_request(password='other'), create=True
+        ):
+            basic_auth.identify_request()
+        assert authenticate.call_count == 2
+
+    def test_throttled(self, ldap_mocks):
+        authenticate, _, check = ldap_mocks
+        check.return_value = ('login', 30)
+        user_name, response = basic_auth.identify_request()
+        assert user_name is None
+        assert response.status_code == 429
+        authenticate.assert_not_called()
+
+    def test_overloaded(self, ldap_mocks):
+        authenticate, _, _ = ldap_mocks
+        authenticate.side_effect = OverloadedError('timeout', 2)
+        user_name, response = basic_auth.identify_request()
+        assert user_name is None
+        assert response.status_code == 503
+
+
+class TestLogIn:
+    def test_no_session(self):
+        toolkit = MagicMock(check_ckan_version=MagicMock(return_value=True))
+        with patch('ckanext.ldap.lib.basic_auth.toolkit', toolkit), patch(
+            'ckanext.ldap.lib.basic_auth.identity.log_in_request'
+        ) as log_in_request:
+            basic_auth.log_in('beans')
+        assert toolkit.c.user == 'beans'
+        log_in_request.assert_called_once_with('beans')
+        toolkit.login_user.assert_not_called()
@@ -0,0 +1,120 @@
+import threading
+
+import pytest
+from mock import MagicMock, patch
+
+from ckanext.ldap.lib.cache import MISSING, SingleFlight, TTLCache
+
+
+class TestTTLCache:
+    def test_get_and_set(self):
+        cache = TTLCache(10, 60)
+        assert cache.get('beans') is MISSING
+        cache.set('beans', {'username': 'beans'})
+        assert cache.get('beans') == {'username': 'beans'}
+        assert cache.stats() == {'size': 1, 'hits': 1, 'misses': 1}
+
+    def test_negative_entries(self):
+        cache = TTLCache(10, 60, negative_ttl=0)
+        cache.set('beans', None)
+        assert cache.get('beans') is MISSING
+
+        cache = TTLCache(10, 60, negative_ttl=30)
+        cache.set('beans', None)
+        assert cache.get('beans') is None
+
+    def test_expiry(self):
+        cache = TTLCache(10, 60)
+        with patch('ckanext.ldap.lib.cache.time.monotonic', return_value=0):
+            cache.set('beans', 'lemons')
+        with patch('ckanext.ldap.lib.cache.time.monotonic', return_value=61):
+            assert cache.get('beans') is MISSING
+        assert len(cache) == 0
+
+    def test_lru_eviction(self):
+        cache = TTLCache(2, 60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        assert cache.get('b') is MISSING
+        assert cache.get('a') == 1
+        assert cache.get('c') == 3
+
+    def test_invalidate(self):
+        cache = TTLCache(10, 60)
+        cache.set(('beans', 'x'), 1)
+        cache.set(('beans', 'y'), 2)
+        cache.set(('lemons', 'x'), 3)
+        assert cache.invalidate(lambda key, value: key[0] == 'beans') == 2
+        assert len(cache) == 1
+
+
+class TestSingleFlight:
+    def run_concurrently(self, flight, function, callers=5):
+        """
+        Start a call which blocks until the other callers are waiting for it.
+        """
+        release = threading.Event()
+        results = []
+
+        def blocked():
+            release.wait(5)
+            return function()
+
+        def call():
+            try:
+                results.append(flight.do('beans', blocked))
+            except Exception as e:
+                results.append(e)
+
+        threads = [threading.Thread(target=call) for _ in range(callers)]
+        for thread in threads:
+            thread.start()
+        # wait until everyone but the leader is waiting
+        for _ in range(500):
+            if flight.coalesced == callers - 1:
+                break
+            threading.Event().wait(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_calls_share_one_call(self):
+        on_coalesce = MagicMock()
+        flight = SingleFlight(on_coalesce=on_coalesce)
+        function = MagicMock(return_value='result')
+
+        results = self.run_concurrently(flight, function)
+
+        assert results == ['result'] * 5
+        function.assert_called_once()
+        assert on_coalesce.call_count == 4
+
+    def test_exceptions_are_shared(self):
+        flight = SingleFlight()
+        error = ValueError('nope')
+        function = MagicMock(side_effect=error)
+
+        results = self.run_concurrently(flight, function)
+
+        assert results == [error] * 5
+        function.assert_called_once()
+
+    def test_sequential_calls_are_not_coalesced(self):
+        flight = SingleFlight()
+        function = MagicMock(return_value='result')
+        flight.do('beans', function)
+        flight.do('beans', function)
+        assert function.call_count == 2
+        assert flight.coalesced == 0
+
+    def test_different_keys(self):
+        flight = SingleFlight()
+        assert flight.do('beans', lambda: 1) == 1
+        assert flight.do('lemons', lambda: 2) == 2
+        with pytest.raises(ValueError):
+            flight.do('beans', MagicMock(side_effect=ValueError()))
+        # the failed call isn't left in progress
+        assert flight.do('beans', lambda: 3) == 3
@@ -0,0 +1,67 @@
+import pytest
+from mock import MagicMock, patch
+
+from ckanext.ldap.lib import credentials
+from ckanext.ldap.lib.exceptions import StoreError
+from ckanext.ldap.lib.store import MemoryStore
+
+DN = 'uid=beans,ou=people,dc=example,dc=com'
+
+
+class TestHashing:
+    def test_round_trip(self):
+        verifier = credentials.hash_password('password')
+        assert verifier.startswith('scrypt$')
+        assert credentials.check_password('password', verifier)
+        assert not credentials.check_password('Password', verifier)
+
+    def test_salted(self):
+        assert credentials.hash_password('password') != credentials.hash_password(
+            'password'
+        )
+
+    def test_bad_verifier(self):
+        assert not credentials.check_password('password', 'nope')
+        assert not credentials.check_password('password', 'md5$1$1$1$zz$zz')
+
+
+@pytest.fixture
+def store():
+    store = MemoryStore()
+    with patch('ckanext.ldap.lib.credentials.get_store', return_value=store):
+        yield store
+
+
+@pytest.mark.ckan_config('ckanext.ldap.credential_cache.ttl', 60)
+class TestCredentialCache:
+    def test_remember_and_verify(self, store):
+        assert not credentials.verify(DN, 'password')
+        credentials.remember(DN, 'password')
+        assert credentials.verify(DN, 'password')
+        assert credentials.verify(DN.upper(), 'password')
+        assert not credentials.verify(DN, 'wrong')
+
+    def test_empty_passwords(self, store):
+        credentials.remember(DN, '')
+        assert not credentials.verify(DN, '')
+
+    def test_forget(self, store):
+        credentials.remember(DN, 'password')
+        assert credentials.forget(DN)
+        assert not credentials.verify(DN, 'password')
+        assert not credentials.forget(DN)
+
+    def test_store_errors(self):
+        store = MagicMock(
+            get=MagicMock(side_effect=StoreError('down')),
+            set=MagicMock(side_effect=StoreError('down')),
+        )
+        with patch('ckanext.ldap.lib.credentials.get_store', return_value=store):
+            credentials.remember(DN, 'password')
+            assert not credentials.verify(DN, 'password')
+
+    @pytest.mark.ckan_config('ckanext.ldap.credential_cache.ttl', 0)
+    def test_disabled(self, store):
+        credentials.remember(DN, 'password')
+        assert not credentials.verify(DN, 'password')
+        assert len(store._values) == 0
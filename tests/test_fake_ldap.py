@@ -0,0 +1,100 @@
+import io
+
+import ldap
+import pytest
+
+from ckanext.ldap.lib.fake_ldap import (
+    BASE_DN,
+    CONFIG,
+    FakeDirectory,
+    generate_users,
+    make_directory,
+    parse_filter,
+    write_ldif,
+)
+from ckanext.ldap.lib.sync import iter_entries
+
+
+def entry(**attributes):
+    return {name: [v.encode() for v in values] for name, values in attributes.items()}
+
+
+class TestParseFilter:
+    @pytest.mark.parametrize(
+        'filter_str,expected',
+        [
+            ('(uid=bob)', True),
+            ('uid=BOB', True),
+            ('(uid=alice)', False),
+            ('(&(objectClass=person)(uid=bob))', True),
+            ('(&(objectClass=person)(uid=alice))', False),
+            ('(|(uid=alice)(mail=bob@example.com))', True),
+            ('(!(uid=bob))', False),
+            ('(cn=*ob*)', True),
+            ('(cn=b*)', True),
+            ('(cn=*x*)', False),
+            ('(mail=*)', True),
+            ('(description=*)', False),
+            ('(modifyTimestamp>=20200101000000Z)', True),
+            ('(modifyTimestamp>=20300101000000Z)', False),
+            ('(uid=b\\2aob)', False),
+        ],
+    )
+    def test_matches(self, filter_str, expected):
+        attributes = entry(
+            objectClass=['top', 'person'],
+            uid=['bob'],
+            cn=['bob'],
+            mail=['bob@example.com'],
+            modifyTimestamp=['20240101000000Z'],
+        )
+        assert parse_filter(filter_str).matches(attributes) == expected
+
+    def test_bad_filter(self):
+        with pytest.raises(ldap.FILTER_ERROR):
+            parse_filter('(&(uid=bob)')
+
+
+class TestFakeDirectory:
+    def test_search_and_bind(self):
+        users = generate_users(20, seed=1)
+        directory = make_directory(users)
+        cnx = directory.initialize(CONFIG['ckanext.ldap.uri'])
+        user = users[3]
+
+        results = cnx.search_s(
+            BASE_DN, ldap.SCOPE_SUBTREE, f'(uid={user["uid"]})', ['uid', 'mail']
+        )
+        assert results == [(user['dn'], entry(uid=[user['uid']], mail=[user['mail']]))]
+
+        cnx.simple_bind_s(user['dn'], user['password'])
+        assert cnx.whoami_s() == f'dn:{user["dn"]}'
+        with pytest.raises(ldap.INVALID_CREDENTIALS):
+            cnx.simple_bind_s(user['dn'], 'nope')
+        assert directory.counts['bind'] == 2
+        assert directory.counts['search'] == 1
+
+    def test_paged_search(self):
+        directory = make_directory(generate_users(25, seed=1))
+        cnx = directory.initialize(CONFIG['ckanext.ldap.uri'])
+        entries = list(
+            iter_entries(cnx, '(uid=*)', ['uid'], page_size=10, base_dn=BASE_DN)
+        )
+        assert len(entries) == 25
+        assert directory.counts['search'] == 3
+
+    def test_collisions(self):
+        users = generate_users(100, collision_rate=0.5, seed=1)
+        uids = [user['uid'] for user in users]
+        assert len(set(uid.lower() for uid in uids)) == len(uids)
+        mapped = [''.join(c if c.isalnum() else '_' for c in uid) for uid in uids]
+        assert len(set(mapped)) < len(uids)
+
+    def test_ldif_round_trip(self):
+        users = generate_users(5, alt_only_rate=0.5, seed=1)
+        output = io.StringIO()
+        write_ldif(users, output)
+        directory = FakeDirectory()
+        assert directory.load_ldif(io.StringIO(output.getvalue())) == 5
+        cnx = directory.initialize(CONFIG['ckanext.ldap.uri'])
+        cnx.simple_bind_s(users[0]['dn'], users[0]['password'])
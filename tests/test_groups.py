@@ -0,0 +1,148 @@
+import json
+
+import pytest
+from mock import patch
+
+from ckanext.ldap.lib import fake_ldap, groups
+from ckanext.ldap.lib.search import find_ldap_groups, normalise_dn
+
+CURATORS = 'cn=curators,ou=groups,dc=example,dc=com'
+ADMINS = 'cn=admins,ou=groups,dc=example,dc=com'
+MAPPING = json.dumps(
+    {
+        CURATORS: 'collections:editor',
+        'CN=Admins, OU=groups,DC=example,DC=com': ['collections:admin', 'sysadmin'],
+        'cn=everyone,ou=groups,dc=example,dc=com': ['library:member'],
+    }
+)
+
+
+class TestParseMapping:
+    def test_parse(self):
+        mapping = groups.parse_mapping(MAPPING)
+        assert mapping[CURATORS] == [('collections', 'editor')]
+        # the DNs are normalised
+        assert mapping[ADMINS] == [('collections', 'admin'), groups.SYSADMIN]
+        assert groups.mapped_organizations(mapping) == {'collections', 'library'}
+        assert groups.manages_sysadmin(mapping)
+
+    @pytest.mark.parametrize(
+        'value',
+        [
+            'nope',
+            '["collections:editor"]',
+            json.dumps({CURATORS: 'collections'}),
+            json.dumps({CURATORS: 'collections:owner'}),
+            json.dumps({CURATORS: {'collections': 'editor'}}),
+        ],
+    )
+    def test_invalid(self, value):
+        with pytest.raises(ValueError):
+            groups.parse_mapping(value)
+
+
+class TestRevokesSysadmin:
+    @pytest.mark.ckan_config('ckanext.ldap.groups.manage_sysadmin', True)
+    def test_enabled(self):
+        assert groups.revokes_sysadmin(groups.parse_mapping(MAPPING))
+        assert not groups.revokes_sysadmin(groups.parse_mapping('{}'))
+
+    @pytest.mark.ckan_config('ckanext.ldap.groups.manage_sysadmin', False)
+    def test_disabled(self):
+        assert not groups.revokes_sysadmin(groups.parse_mapping(MAPPING))
+
+
+class TestResolveRoles:
+    def test_most_privileged_role_wins(self):
+        mapping = groups.parse_mapping(MAPPING)
+        assert groups.resolve_roles([CURATORS], mapping) == (
+            {'collections': 'editor'},
+            False,
+        )
+        assert groups.resolve_roles([CURATORS, ADMINS], mapping) == (
+            {'collections': 'admin'},
+            True,
+        )
+        assert groups.resolve_roles(['cn=other'], mapping) == ({}, False)
+
+
+class TestDiffMemberships:
+    def test_only_changes(self):
+        current = {'a': 'member', 'b': 'editor', 'c': 'member', 'd': 'admin'}
+        desired = {'a': 'member', 'b': 'admin', 'e': 'editor'}
+        to_set, to_remove = groups.diff_memberships(current, desired, keep={'d'})
+        assert to_set == {'b': 'admin', 'e': 'editor'}
+        assert to_remove == {'c'}
+
+    def test_nothing_to_do(self):
+        current = {'a': 'member'}
+        assert groups.diff_memberships(current, dict(current)) == ({}, set())
+
+
+@pytest.mark.ckan_config('ckanext.ldap.base_dn', 'dc=example,dc=com')
+@pytest.mark.ckan_config('ckanext.ldap.groups.filter', '(member={dn})')
+class TestFindLdapGroups:
+    @pytest.fixture
+    def directory(self):
+        directory = fake_ldap.FakeDirectory()
+        user_dn = 'uid=beans,ou=people,dc=example,dc=com'
+        directory.add_entry(CURATORS, {'member': [user_dn]})
+        directory.add_entry(ADMINS, {'member': [CURATORS]})
+        cnx = directory.initialize('ldap://fake')
+        with patch(
+            'ckanext.ldap.lib.search._run', side_effect=lambda function: function(cnx)
+        ):
+            directory.reset_counts()
+            yield directory, user_dn
+
+    @pytest.mark.ckan_config('ckanext.ldap.groups.nested', False)
+    def test_one_search(self, directory):
+        directory, user_dn = directory
+        assert find_ldap_groups(user_dn) == {CURATORS}
+        assert directory.counts == {'search': 1}
+
+    @pytest.mark.ckan_config('ckanext.ldap.groups.nested', True)
+    def test_nested(self, directory):
+        directory, user_dn = directory
+        assert find_ldap_groups(user_dn) == {CURATORS, ADMINS}
+        # one search per level, the last finding nothing new
+        assert directory.counts == {'search': 3}
+
+    @pytest.mark.ckan_config('ckanext.ldap.groups.nested', False)
+    def test_member_of_is_used(self, directory):
+        directory, user_dn = directory
+        direct = ['CN=Curators,ou=Groups,dc=example,dc=com']
+        assert find_ldap_groups(user_dn, direct=direct) == {CURATORS}
+        assert directory.counts == {}
+
+
+@pytest.mark.ckan_config('ckanext.ldap.cache.size', 10)
+@pytest.mark.ckan_config('ckanext.ldap.groups.cache_ttl', 60)
+class TestGetUserGroups:
+    @pytest.fixture(autouse=True)
+    def reset(self):
+        groups.reset_membership_cache()
+        yield
+        groups.reset_membership_cache()
+
+    def test_cached(self):
+        ldap_user_dict = {'cn': 'uid=beans,ou=people,dc=example,dc=com'}
+        with patch(
+            'ckanext.ldap.lib.groups.find_ldap_groups', return_value={CURATORS}
+        ) as find:
+            assert groups.get_user_groups(ldap_user_dict) == {CURATORS}
+            assert groups.get_user_groups(ldap_user_dict) == {CURATORS}
+        find.assert_called_once_with(ldap_user_dict['cn'], direct=None)
+
+    def test_failures_are_not_cached(self):
+        ldap_user_dict = {'cn': 'uid=beans,ou=people,dc=example,dc=com'}
+        with patch(
+            'ckanext.ldap.lib.groups.find_ldap_groups', return_value=None
+        ) as find:
+            assert groups.get_user_groups(ldap_user_dict) is None
+            assert groups.get_user_groups(ldap_user_dict) is None
+        assert find.call_count == 2
+
+
+def test_normalise_dn():
+    assert normalise_dn('CN=Admins, OU=groups,DC=example,DC=com') == ADMINS
@@ -1,8 +1,16 @@
 import pytest
+from ckan.model import Session
 from ckan.plugins import toolkit
+from ckan.tests import factories
 from mock import MagicMock, patch
 
-from ckanext.ldap.lib.helpers import decode_str, get_login_action, is_ldap_user
+from ckanext.ldap.lib.helpers import (
+    decode_str,
+    get_ldap_user_ids,
+    get_login_action,
+    is_ldap_user,
+)
+from ckanext.ldap.model.ldap_user import LdapUser
 
 
 def test_is_ldap_user():
@@ -38,3 +46,36 @@ def test_decode_str():
     assert decode_str(b'beans') == 'beans'
     assert decode_str(b'\xf0\x9f\x92\xa9') == '💩'
     assert decode_str('beans') == 'beans'
+
+
+@pytest.mark.filterwarnings('ignore::sqlalchemy.exc.SADeprecationWarning')
+@pytest.mark.usefixtures('clean_db', 'ensure_db_init', 'with_request_context')
+class TestGetLdapUserIds:
+    def test_mixed(self):
+        ckan_user = factories.User()
+        ldap_user = factories.User()
+        Session.add(LdapUser(user_id=ldap_user['id'], ldap_id='beans'))
+        Session.commit()
+
+        assert get_ldap_user_ids([ckan_user, ldap_user['id'], 'nope']) == {
+            ldap_user['id']
+        }
+
+    def test_lookups_are_remembered(self):
+        user = factories.User()
+        Session.add(LdapUser(user_id=user['id'], ldap_id='beans'))
+        Session.commit()
+
+        first = LdapUser.by_user_id(user['id'])
+        with patch.object(Session, 'query') as query:
+            assert LdapUser.by_ldap_id('beans') is first
+            assert LdapUser.by_user_ids([user['id']]) == {user['id']: first}
+        assert not query.called
+
+    def test_new_mappings_are_seen(self):
+        user = factories.User()
+        assert LdapUser.by_user_id(user['id']) is None
+
+        Session.add(LdapUser(user_id=user['id'], ldap_id='beans'))
+
+        assert LdapUser.by_user_id(user['id']) is not None
@@ -0,0 +1,128 @@
+import pytest
+from mock import MagicMock, patch
+
+from ckanext.ldap.lib import identity
+from ckanext.ldap.lib.exceptions import StoreError
+from ckanext.ldap.lib.store import MemoryStore
+
+USER_ID = '5bd3e8e4-29a8-4e6e-8a3b-8c1f0d4b2a6f'
+
+
+@pytest.mark.ckan_config('ckanext.ldap.identity_cookie.secret', 'beans')
+@pytest.mark.ckan_config('ckanext.ldap.identity_cookie.max_age', 60)
+class TestTokens:
+    def test_round_trip(self):
+        token = identity.make_token(USER_ID, now=1000)
+        assert identity.read_token(token, now=1059) == USER_ID
+
+    def test_expired(self):
+        token = identity.make_token(USER_ID, now=1000)
+        assert identity.read_token(token, now=1060) is None
+
+    def test_tampered(self):
+        token = identity.make_token(USER_ID, now=1000)
+        user_id, expires, signature = token.split('.')
+        assert identity.read_token(f'someone-else.{expires}.{signature}', 0) is None
+        assert identity.read_token(f'{user_id}.9999999999.{signature}', 0) is None
+
+    def test_garbage(self):
+        for token in ('', 'beans', 'a.b.c', None):
+            assert identity.read_token(token, now=0) is None
+
+    def test_other_secret(self):
+        token = identity.make_token(USER_ID, now=1000)
+        with patch.object(identity, 'get_secret', return_value=b'lemons'):
+            assert identity.read_token(token, now=1000) is None
+
+
+class TestGetSecret:
+    def test_fallback(self):
+        assert identity.get_secret({'SECRET_KEY': 'beans'}) == b'beans'
+        assert identity.get_secret({'beaker.session.secret': 'beans'}) == b'beans'
+        assert identity.get_secret({}) is None
+
+    def test_own_secret_first(self):
+        config = {'ckanext.ldap.identity_cookie.secret': 'own', 'SECRET_KEY': 'ckan'}
+        assert identity.get_secret(config) == b'own'
+
+
+@pytest.mark.ckan_config('ckanext.ldap.cache.size', 10)
+class TestGetUserName:
+    @pytest.fixture
+    def query(self):
+        identity.reset_names()
+        session = MagicMock()
+        query = session.query.return_value.filter.return_value
+        with patch('ckanext.ldap.lib.identity.Session', session):
+            yield query
+        identity.reset_names()
+
+    def test_cached(self, query):
+        query.scalar.return_value = 'beans'
+        assert identity.get_user_name(USER_ID) == 'beans'
+        assert identity.get_user_name(USER_ID) == 'beans'
+        query.scalar.assert_called_once()
+
+    def test_unknown_users_are_cached(self, query):
+        query.scalar.return_value = None
+        assert identity.get_user_name(USER_ID) is None
+        assert identity.get_user_name(USER_ID) is None
+        query.scalar.assert_called_once()
+
+
+@pytest.mark.ckan_config('ckanext.ldap.cache.size', 10)
+@pytest.mark.ckan_config('ckanext.ldap.identity_cookie.secret', 'beans')
+@pytest.mark.ckan_config('ckanext.ldap.identity_cookie.max_age', 60)
+class TestRevoke:
+    @pytest.fixture
+    def store(self):
+        identity.reset_names()
+        store = MemoryStore()
+        with patch('ckanext.ldap.lib.identity.get_store', return_value=store):
+            yield store
+        identity.reset_names()
+
+    def test_revoked_until_expiry(self, store):
+        token = identity.make_token(USER_ID)
+        other = identity.make_token('someone-else')
+        assert not identity.is_revoked(token)
+        identity.revoke(token)
+        assert identity.is_revoked(token)
+        assert not identity.is_revoked(other)
+
+    def test_kept_until_the_token_expires(self, store):
+        token = identity.make_token(USER_ID, now=1000)
+        with patch.object(store, 'set') as set_value:
+            identity.revoke(token, now=1015)
+        set_value.assert_called_once_with(identity._revocation_key(token), '1', 45)
+
+    def test_other_processes_see_the_revocation(self, store):
+        token = identity.make_token(USER_ID)
+        identity.revoke(token)
+        # a fresh local cache, as another process would have
+        identity.reset_names()
+        assert identity.is_revoked(token)
+
+    def test_invalid_tokens_are_ignored(self, store):
+        with patch.object(store, 'set') as set_value:
+            identity.revoke('beans')
+        set_value.assert_not_called()
+
+    def test_store_errors(self, store):
+        token = identity.make_token(USER_ID)
+        with patch.object(store, 'get', side_effect=StoreError('down')):
+            assert not identity.is_revoked(token)
+        with patch.object(store, 'set', side_effect=StoreError('down')):
+            identity.revoke(token)
+        # still revoked in this process
+        assert identity.is_revoked(token)
+
+    def test_revoked_tokens_are_not_identified(self, store):
+        token = identity.make_token(USER_ID)
+        request = MagicMock(cookies={identity.COOKIE_NAME: token})
+        with patch('ckanext.ldap.lib.identity.toolkit.request', request), patch.object(
+            identity, 'get_user_name', return_value='beans'
+        ):
+            assert identity.identify_request() == 'beans'
+            identity.revoke(token)
+            assert identity.identify_request() is None
@@ -0,0 +1,53 @@
+import pytest
+from mock import MagicMock, patch
+
+from ckanext.ldap.lib import jobs
+
+
+def add(a, b):
+    return a + b
+
+
+class TestRun:
+    def test_success(self):
+        assert jobs.run(add, 1, 2) == 3
+
+    def test_fails_fast(self):
+        function = MagicMock(side_effect=ValueError())
+        function.__name__ = 'function'
+        with patch('ckanext.ldap.lib.jobs.Session') as session:
+            with pytest.raises(ValueError):
+                jobs.run(function)
+        function.assert_called_once()
+        session.rollback.assert_called_once()
+
+
+@pytest.fixture
+def enqueue_job():
+    with patch('ckanext.ldap.lib.jobs.toolkit.enqueue_job', create=True) as enqueue:
+        yield enqueue
+
+
+@pytest.mark.ckan_config('ckanext.ldap.jobs.retries', 2)
+class TestEnqueue:
+    def test_retried_by_the_queue(self, enqueue_job):
+        retry = MagicMock()
+        with patch('ckanext.ldap.lib.jobs.Retry', retry):
+            jobs.enqueue(add, 1, 2)
+        retry.assert_called_once_with(max=2)
+        enqueue_job.assert_called_once_with(
+            jobs.run,
+            args=[add, 1, 2],
+            title='ckanext-ldap: add',
+            rq_kwargs={'retry': retry.return_value},
+        )
+
+    @pytest.mark.ckan_config('ckanext.ldap.jobs.retries', 0)
+    def test_no_retries(self, enqueue_job):
+        jobs.enqueue(add, 1, 2)
+        assert enqueue_job.call_args.kwargs['rq_kwargs'] == {}
+
+    def test_old_rq(self, enqueue_job):
+        with patch('ckanext.ldap.lib.jobs.Retry', None):
+            jobs.enqueue(add, 1, 2)
+        assert enqueue_job.call_args.kwargs['rq_kwargs'] == {}
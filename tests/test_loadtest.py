@@ -0,0 +1,140 @@
+from collections import Counter
+
+import pytest
+from ckan.model import Session, User
+from ckan.plugins import toolkit
+from ckan.tests import factories
+
+from ckanext.ldap.lib.fake_ldap import CONFIG, FakeDirectory, generate_users
+from ckanext.ldap.lib.loadtest import (
+    build_report,
+    fake_directory_config,
+    find_users,
+    plan_logins,
+    remove_users,
+    run_load_test,
+    summarise,
+)
+from ckanext.ldap.model.ldap_user import LdapUser
+
+
+def test_plan_logins():
+    users = generate_users(10, alt_only_rate=0, seed=1)
+    plan = plan_logins(users, 30, failure_rate=0, seed=1)
+    kinds = Counter(kind for kind, _, _ in plan)
+    assert kinds == {'first': 10, 'repeat': 20}
+    assert [login for _, login, _ in plan[:10]] == [user['login'] for user in users]
+
+
+def test_plan_logins_with_failures():
+    users = generate_users(10, seed=1)
+    plan = plan_logins(users, 100, failure_rate=0.5, seed=1)
+    bad = [password for kind, _, password in plan if kind == 'bad_password']
+    assert 20 < len(bad) < 80
+    assert 'password' not in bad
+
+
+def test_summarise():
+    summary = summarise([0.001 * i for i in range(1, 101)])
+    assert summary['count'] == 100
+    assert round(summary['p50']) == 50
+    assert round(summary['p99']) == 99
+    assert summarise([]) == {'count': 0}
+
+
+def test_build_report():
+    results = [
+        {
+            'kind': 'first',
+            'latency': 0.1,
+            'service_time': 0.05,
+            'queries': 10,
+            'status': 302,
+            'unexpected': False,
+        },
+        {
+            'kind': 'bad_password',
+            'latency': 0.2,
+            'service_time': 0.1,
+            'queries': 2,
+            'status': None,
+            'unexpected': True,
+        },
+    ]
+    report = build_report(results, 2, Counter(search=4, bind=2), parameters={})
+    assert report['throughput'] == 1
+    assert report['unexpected'] == 1
+    assert report['errors'] == 1
+    assert report['db_queries_per_login'] == 6
+    assert report['ldap_operations_per_login'] == {'bind': 1, 'search': 2}
+    assert report['by_kind']['first']['db_queries_per_login'] == 10
+
+
+@pytest.mark.ckan_config('ckanext.ldap.throttle.enabled', True)
+@pytest.mark.ckan_config('ckanext.ldap.admission.limit', 10)
+def test_throttling_and_admission_are_off():
+    with fake_directory_config(FakeDirectory()):
+        assert not toolkit.config['ckanext.ldap.throttle.enabled']
+        assert toolkit.config['ckanext.ldap.admission.limit'] == 0
+    assert toolkit.config['ckanext.ldap.throttle.enabled']
+    assert toolkit.config['ckanext.ldap.admission.limit'] == 10
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'ldap')
+@pytest.mark.ckan_config('ckanext.ldap.uri', CONFIG['ckanext.ldap.uri'])
+@pytest.mark.ckan_config('ckanext.ldap.base_dn', CONFIG['ckanext.ldap.base_dn'])
+@pytest.mark.ckan_config(
+    'ckanext.ldap.search.filter', CONFIG['ckanext.ldap.search.filter']
+)
+@pytest.mark.ckan_config('ckanext.ldap.username', CONFIG['ckanext.ldap.username'])
+@pytest.mark.ckan_config('ckanext.ldap.email', CONFIG['ckanext.ldap.email'])
+@pytest.mark.usefixtures('clean_db', 'ensure_db_init', 'with_plugins')
+@pytest.mark.filterwarnings('ignore::sqlalchemy.exc.SADeprecationWarning')
+class TestRunLoadTest:
+    options = dict(
+        users=5,
+        logins=10,
+        rate=0,
+        threads=2,
+        collision_rate=0,
+        alt_only_rate=0,
+        failure_rate=0,
+        seed=1,
+        prefix='lt',
+    )
+    ldap_ids = [f'lt{i}' for i in range(5)]
+
+    def test_logins(self, app):
+        report = run_load_test(app.flask_app, cleanup=False, **self.options)
+
+        assert report['logins'] == 10
+        assert report['statuses'] == {'302': 10}
+        assert report['unexpected'] == 0
+        assert report['errors'] == 0
+        assert set(report['by_kind']) == {'first', 'repeat'}
+        assert report['users'] == {'created': 5, 'removed': 0}
+        user_ids = find_users(self.ldap_ids)
+        assert len(user_ids) == 5
+        assert all(User.get(user_id).state == 'active' for user_id in user_ids)
+
+        # these users would make the first logins repeat logins
+        with pytest.raises(ValueError):
+            run_load_test(app.flask_app, **self.options)
+
+        assert remove_users(user_ids) == 5
+        assert find_users(self.ldap_ids) == []
+        assert all(User.get(user_id).state == 'deleted' for user_id in user_ids)
+
+    def test_cleanup(self, app):
+        # a real user whose id starts with the prefix
+        user = factories.User()
+        Session.add(LdapUser(user_id=user['id'], ldap_id='lt-real'))
+        Session.commit()
+
+        report = run_load_test(app.flask_app, **self.options)
+
+        assert report['unexpected'] == 0
+        assert report['users'] == {'created': 5, 'removed': 5}
+        assert find_users(self.ldap_ids) == []
+        assert find_users(['lt-real']) == [user['id']]
+        assert User.get(user['id']).state == 'active'
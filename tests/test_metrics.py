@@ -0,0 +1,67 @@
+import pytest
+from mock import MagicMock, patch
+
+from ckanext.ldap.lib import metrics
+
+
+def test_disabled_without_prometheus_client():
+    with patch.object(metrics, 'prometheus_client', None):
+        assert not metrics.available()
+        with metrics.timed('search'):
+            pass
+        metrics.count_login('success')
+        metrics.count_error('server_down')
+
+
+class TestMetrics:
+    @pytest.fixture(autouse=True)
+    def prometheus_client(self):
+        return pytest.importorskip('prometheus_client')
+
+    def sample(self, name, **labels):
+        return metrics.prometheus_client.REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_timed(self):
+        before = self.sample('ckanext_ldap_operation_seconds_count', operation='search')
+        with metrics.timed('search'):
+            pass
+        after = self.sample('ckanext_ldap_operation_seconds_count', operation='search')
+        assert after == before + 1
+
+    def test_timed_records_failures(self):
+        before = self.sample(
+            'ckanext_ldap_operation_seconds_count', operation='connect'
+        )
+        with pytest.raises(ValueError):
+            with metrics.timed('connect'):
+                raise ValueError()
+        after = self.sample('ckanext_ldap_operation_seconds_count', operation='connect')
+        assert after == before + 1
+
+    def test_count_login(self):
+        before = self.sample('ckanext_ldap_logins_total', outcome='LDAP1')
+        metrics.count_login('LDAP1')
+        assert self.sample('ckanext_ldap_logins_total', outcome='LDAP1') == before + 1
+
+    def test_generate(self):
+        metrics.count_error('server_down')
+        body, content_type = metrics.generate()
+        assert b'ckanext_ldap_errors_total{error="server_down"}' in body
+        assert content_type.startswith('text/plain')
+
+
+class TestAuthorised:
+    def test_sysadmin(self):
+        assert metrics.authorised(None, MagicMock(sysadmin=True))
+        assert not metrics.authorised(None, MagicMock(sysadmin=False))
+        assert not metrics.authorised(None)
+
+    @pytest.mark.ckan_config('ckanext.ldap.metrics.token', 's3cret')
+    def test_token(self):
+        assert metrics.authorised('Bearer s3cret')
+        assert metrics.authorised('bearer s3cret', MagicMock(sysadmin=False))
+        assert not metrics.authorised('Bearer nope')
+        assert not metrics.authorised('Basic s3cret')
+
+    def test_no_token_configured(self):
+        assert not metrics.authorised('Bearer ')
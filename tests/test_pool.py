@@ -0,0 +1,136 @@
+import ldap
+import pytest
+from mock import MagicMock, patch
+
+from ckanext.ldap.lib import pool as pool_module
+from ckanext.ldap.lib.exceptions import NoServerAvailableError, PoolTimeoutError
+from ckanext.ldap.lib.pool import ConnectionPool, get_pool, reset_pool
+from ckanext.ldap.lib.servers import ServerSet
+
+
+def make_pool(**kwargs):
+    connect = MagicMock(side_effect=lambda: MagicMock())
+    rebind = MagicMock()
+    return ConnectionPool(connect, rebind, **kwargs), connect, rebind
+
+
+class TestConnectionPool:
+    def test_connections_are_reused(self):
+        pool, connect, _ = make_pool()
+        with pool.connection() as first:
+            pass
+        with pool.connection() as second:
+            pass
+        assert first is second
+        assert connect.call_count == 1
+
+    def test_fill(self):
+        pool, connect, _ = make_pool(min_size=3)
+        pool.fill()
+        assert connect.call_count == 3
+        assert pool.idle == 3
+
+    def test_exhausted(self):
+        pool, _, _ = make_pool(max_size=1, checkout_timeout=0)
+        pool.acquire()
+        with pytest.raises(PoolTimeoutError):
+            pool.acquire()
+
+    def test_broken_connections_are_discarded(self):
+        pool, connect, _ = make_pool()
+        with pytest.raises(ldap.SERVER_DOWN):
+            with pool.connection():
+                raise ldap.SERVER_DOWN()
+        assert pool.size == 0
+        with pool.connection():
+            pass
+        assert connect.call_count == 2
+
+    def test_run_reconnects_stale_connections(self):
+        pool, connect, _ = make_pool()
+        with pool.connection() as stale:
+            pass
+        stale.search_s.side_effect = ldap.SERVER_DOWN()
+
+        result = pool.run(lambda cnx: cnx.search_s())
+
+        assert result is not None
+        assert connect.call_count == 2
+        assert pool.size == 1
+
+    def test_run_fails_over_fresh_connections(self):
+        servers = ServerSet(['ldap://a', 'ldap://b'])
+        pool = ConnectionPool(
+            lambda exclude=(): servers.connect(
+                lambda uri: MagicMock(uri=uri), exclude=exclude
+            ),
+            MagicMock(),
+        )
+
+        def function(cnx):
+            if cnx.uri == 'ldap://a':
+                raise ldap.TIMEOUT()
+            return cnx.uri
+
+        assert pool.run(function) == 'ldap://b'
+
+    def test_run_gives_up_when_no_server_is_left(self):
+        servers = ServerSet(['ldap://a', 'ldap://b'])
+        pool = ConnectionPool(
+            lambda exclude=(): servers.connect(
+                lambda uri: MagicMock(), exclude=exclude
+            ),
+            MagicMock(),
+        )
+        function = MagicMock(side_effect=ldap.SERVER_DOWN())
+        with pytest.raises(ldap.SERVER_DOWN) as error:
+            pool.run(function)
+        assert not isinstance(error.value, NoServerAvailableError)
+        assert function.call_count == 2
+
+    def test_rebind(self):
+        pool, _, rebind = make_pool()
+        with pool.connection() as cnx:
+            pool.mark_rebind(cnx)
+        rebind.assert_not_called()
+        with pool.connection():
+            pass
+        rebind.assert_called_once_with(cnx)
+
+    def test_idle_connections_are_reaped(self):
+        pool, _, _ = make_pool(idle_timeout=-1)
+        with pool.connection() as cnx:
+            pass
+        assert pool.size == 0
+        cnx.unbind_s.assert_called_once()
+
+    def test_on_latency(self):
+        on_latency = MagicMock()
+        pool, _, _ = make_pool(on_latency=on_latency)
+
+        pool.run(lambda cnx: None)
+
+        cnx, seconds = on_latency.call_args[0]
+        assert seconds >= 0
+        assert pool.idle == 1
+
+
+@pytest.mark.ckan_config('ckanext.ldap.pool.min_size', 2)
+@pytest.mark.ckan_config('ckanext.ldap.pool.max_size', 10)
+@pytest.mark.ckan_config('ckanext.ldap.pool.idle_timeout', 300)
+@pytest.mark.ckan_config('ckanext.ldap.pool.checkout_timeout', 10)
+@pytest.mark.ckan_config('ckanext.ldap.pool.check_interval', 30)
+def test_get_pool_fills_outside_the_lock():
+    locked = []
+
+    def fill(self):
+        locked.append(pool_module._pool_lock.locked())
+
+    reset_pool()
+    try:
+        with patch.object(ConnectionPool, 'fill', fill):
+            assert get_pool() is get_pool()
+    finally:
+        reset_pool()
+    # filled once, without holding up other threads
+    assert locked == [False]
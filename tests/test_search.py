@@ -0,0 +1,307 @@
+import threading
+
+import ldap
+import pytest
+from mock import MagicMock, patch
+
+from ckanext.ldap.lib import fake_ldap
+from ckanext.ldap.lib.admission import reset_admission
+from ckanext.ldap.lib.cache import TTLCache
+from ckanext.ldap.lib.pool import ConnectionPool
+from ckanext.ldap.lib.search import (
+    _lookups,
+    authenticate_ldap_user,
+    check_ldap_password,
+    find_ldap_user,
+    user_bind,
+)
+from ckanext.ldap.lib.servers import ServerSet, reset_servers
+from ckanext.ldap.lib.store import MemoryStore
+
+
+class TestUserBind:
+    def test_ok(self):
+        cnx = MagicMock()
+        assert user_bind(cnx, 'cn=beans', 'password')
+        cnx.bind_s.assert_called_once_with('cn=beans', 'password')
+
+    def test_invalid_credentials(self):
+        cnx = MagicMock(bind_s=MagicMock(side_effect=ldap.INVALID_CREDENTIALS()))
+        assert not user_bind(cnx, 'cn=beans', 'password')
+
+    def test_empty_password(self):
+        cnx = MagicMock()
+        assert not user_bind(cnx, 'cn=beans', '')
+        cnx.bind_s.assert_not_called()
+
+
+@pytest.mark.ckan_config('ckanext.ldap.search.filter', 'uid={login}')
+@pytest.mark.ckan_config('ckanext.ldap.admission.limit', 0)
+@pytest.mark.ckan_config('ckanext.ldap.credential_cache.ttl', 0)
+@pytest.mark.ckan_config('ckanext.ldap.login.same_connection', True)
+class TestAuthenticateSameConnection:
+    def test_search_and_bind_use_one_connection(self):
+        cnx = MagicMock()
+        rebind = MagicMock()
+        pool = ConnectionPool(MagicMock(return_value=cnx), rebind)
+        ldap_user_dict = {'cn': 'cn=beans', 'username': 'beans', 'email': 'b@e.ans'}
+        search_login = MagicMock(return_value=ldap_user_dict)
+
+        with patch('ckanext.ldap.lib.search.get_pool', return_value=pool), patch(
+            'ckanext.ldap.lib.search.get_lookup_cache', return_value=TTLCache(10, 60)
+        ), patch('ckanext.ldap.lib.search._search_login', search_login):
+            result = authenticate_ldap_user('beans', 'password')
+            assert result == (ldap_user_dict, True)
+            cnx.bind_s.assert_called_once_with('cn=beans', 'password')
+            assert pool.idle == 1
+
+            # the service identity is restored before the connection is reused and the
+            # cached lookup is used instead of searching again
+            authenticate_ldap_user('Beans', 'password')
+            rebind.assert_called_once_with(cnx)
+            search_login.assert_called_once()
+
+
+@pytest.mark.ckan_config('ckanext.ldap.uri', 'ldap://primary')
+@pytest.mark.ckan_config('ckanext.ldap.search.uri', 'ldap://replica')
+@pytest.mark.ckan_config('ckanext.ldap.bind.uri', 'ldap://primary ldap://secondary')
+@pytest.mark.ckan_config('ckanext.ldap.breaker.failure_threshold', 3)
+@pytest.mark.ckan_config('ckanext.ldap.breaker.cooldown', 30)
+@pytest.mark.ckan_config('ckanext.ldap.admission.limit', 0)
+@pytest.mark.ckan_config('ckanext.ldap.credential_cache.ttl', 0)
+class TestBindServers:
+    def setup_method(self):
+        reset_servers()
+        reset_admission()
+
+    def teardown_method(self):
+        reset_servers()
+        reset_admission()
+
+    def test_password_checks_go_to_bind_servers(self):
+        open_connection = MagicMock()
+        with patch('ckanext.ldap.lib.search.open_connection', open_connection):
+            assert check_ldap_password('cn=beans', 'password')
+        open_connection.assert_called_once_with('ldap://primary')
+
+    def test_password_checks_fail_over(self):
+        def connect(uri):
+            cnx = MagicMock()
+            if uri == 'ldap://primary':
+                cnx.bind_s.side_effect = ldap.SERVER_DOWN()
+            return cnx
+
+        with patch('ckanext.ldap.lib.search.open_connection', side_effect=connect):
+            assert check_ldap_password('cn=beans', 'password')
+
+    def test_password_checks_fail_when_every_server_times_out(self):
+        cnx = MagicMock()
+        cnx.bind_s.side_effect = ldap.TIMEOUT()
+        with patch('ckanext.ldap.lib.search.open_connection', return_value=cnx):
+            assert not check_ldap_password('cn=beans', 'password')
+        # both bind servers were tried
+        assert cnx.bind_s.call_count == 2
+
+    @pytest.mark.ckan_config('ckanext.ldap.login.same_connection', True)
+    def test_same_connection_is_not_used_with_separate_bind_servers(self):
+        ldap_user_dict = {'cn': 'cn=beans', 'username': 'beans', 'email': 'b@e.ans'}
+        with patch(
+            'ckanext.ldap.lib.search.find_ldap_user', return_value=ldap_user_dict
+        ), patch(
+            'ckanext.ldap.lib.search.check_ldap_password', return_value=True
+        ) as check, patch('ckanext.ldap.lib.search.get_pool') as get_pool:
+            assert authenticate_ldap_user('beans', 'password') == (ldap_user_dict, True)
+        check.assert_called_once_with('cn=beans', 'password')
+        get_pool.assert_not_called()
+
+
+@pytest.mark.ckan_config('ckanext.ldap.admission.limit', 0)
+@pytest.mark.ckan_config('ckanext.ldap.credential_cache.ttl', 60)
+class TestCredentialCache:
+    def setup_method(self):
+        reset_admission()
+
+    def test_verified_passwords_skip_the_bind(self):
+        verify = MagicMock(return_value=True)
+        get_servers = MagicMock()
+        with patch('ckanext.ldap.lib.search.credentials.verify', verify), patch(
+            'ckanext.ldap.lib.search.get_servers', get_servers
+        ):
+            assert check_ldap_password('cn=beans', 'password')
+        get_servers.assert_not_called()
+
+    def test_successful_binds_are_remembered(self):
+        remember = MagicMock()
+        servers = MagicMock(call=MagicMock(return_value=True))
+        with patch(
+            'ckanext.ldap.lib.search.credentials.verify', return_value=False
+        ), patch('ckanext.ldap.lib.search.credentials.remember', remember), patch(
+            'ckanext.ldap.lib.search.get_servers', return_value=servers
+        ):
+            assert check_ldap_password('cn=beans', 'password')
+        remember.assert_called_once_with('cn=beans', 'password')
+
+
+@pytest.mark.ckan_config(
+    'ckanext.ldap.search.filter', fake_ldap.CONFIG['ckanext.ldap.search.filter']
+)
+@pytest.mark.ckan_config('ckanext.ldap.username', 'uid')
+@pytest.mark.ckan_config('ckanext.ldap.email', 'mail')
+@pytest.mark.ckan_config('ckanext.ldap.fullname', 'cn')
+@pytest.mark.ckan_config('ckanext.ldap.admission.limit', 0)
+@pytest.mark.ckan_config('ckanext.ldap.credential_cache.ttl', 0)
+@pytest.mark.ckan_config('ckanext.ldap.login.same_connection', False)
+class TestKnownUsers:
+    @pytest.fixture
+    def directory(self):
+        self.users = fake_ldap.generate_users(5, alt_only_rate=0, seed=1)
+        directory = fake_ldap.make_directory(self.users)
+        with patch(
+            'ckanext.ldap.lib.search.open_connection',
+            side_effect=lambda uri: directory.initialize(uri),
+        ), patch(
+            'ckanext.ldap.lib.search.get_servers',
+            return_value=ServerSet([fake_ldap.CONFIG['ckanext.ldap.uri']]),
+        ), patch(
+            'ckanext.ldap.lib.search.get_lookup_cache', return_value=TTLCache(10, 60)
+        ):
+            yield directory
+
+    def known(self, directory, user):
+        cnx = directory.initialize(fake_ldap.CONFIG['ckanext.ldap.uri'])
+        [(dn, attributes)] = cnx.search_s(
+            user['dn'], ldap.SCOPE_BASE, attrlist=['entryUUID']
+        )
+        directory.reset_counts()
+        return dn, attributes['entryUUID'][0].decode()
+
+    def test_binds_without_searching(self, directory):
+        user = self.users[0]
+        with patch('ckanext.ldap.lib.search.find_ldap_user') as find_ldap_user:
+            ldap_user_dict, authenticated = authenticate_ldap_user(
+                user['uid'], user['password'], known=self.known(directory, user)
+            )
+        assert authenticated
+        assert ldap_user_dict['cn'] == user['dn']
+        assert ldap_user_dict['username'] == user['uid']
+        find_ldap_user.assert_not_called()
+        # one bind as the user and one read of their entry, on one connection
+        assert directory.counts == {'connect': 1, 'bind': 1, 'search': 1, 'unbind': 1}
+
+    def test_wrong_password(self, directory):
+        user = self.users[0]
+        ldap_user_dict = {'cn': user['dn'], 'username': user['uid']}
+        with patch(
+            'ckanext.ldap.lib.search.find_ldap_user', return_value=ldap_user_dict
+        ), patch('ckanext.ldap.lib.search.check_ldap_password') as check_password:
+            result = authenticate_ldap_user(
+                user['uid'], 'nope', known=self.known(directory, user)
+            )
+        assert result == (ldap_user_dict, False)
+        # the entry is where it was, so it isn't bound to again
+        check_password.assert_not_called()
+
+    def test_moved_entry(self, directory):
+        user = self.users[0]
+        _, entry_uuid = self.known(directory, user)
+        ldap_user_dict = {'cn': user['dn'], 'username': user['uid']}
+        with patch(
+            'ckanext.ldap.lib.search.find_ldap_user', return_value=ldap_user_dict
+        ), patch(
+            'ckanext.ldap.lib.search.check_ldap_password', return_value=True
+        ) as check_password:
+            result = authenticate_ldap_user(
+                user['uid'],
+                user['password'],
+                known=(f'uid={user["uid"]},ou=old,dc=example,dc=com', entry_uuid),
+            )
+        assert result == (ldap_user_dict, True)
+        check_password.assert_called_once_with(user['dn'], user['password'])
+
+    @pytest.mark.ckan_config('ckanext.ldap.credential_cache.ttl', 60)
+    def test_verified_passwords_skip_the_bind(self, directory):
+        user = self.users[0]
+        known = self.known(directory, user)
+        lookups = TTLCache(10, 60)
+        with patch(
+            'ckanext.ldap.lib.credentials.get_store', return_value=MemoryStore()
+        ), patch('ckanext.ldap.lib.search.get_lookup_cache', return_value=lookups):
+            ldap_user_dict, authenticated = authenticate_ldap_user(
+                user['uid'], user['password'], known=known
+            )
+            assert authenticated
+            # e.g. the lookup has expired, or CKAN has been restarted
+            lookups.clear()
+            directory.reset_counts()
+            with patch(
+                'ckanext.ldap.lib.search.find_ldap_user', return_value=ldap_user_dict
+            ) as find_ldap_user:
+                result = authenticate_ldap_user(
+                    user['uid'], user['password'], known=known
+                )
+        assert result == (ldap_user_dict, True)
+        find_ldap_user.assert_called_once_with(user['uid'])
+        assert directory.counts['bind'] == 0
+
+    @pytest.mark.parametrize('change', ['entry_uuid', 'filter'])
+    def test_searches_if_the_entry_cant_be_confirmed(self, directory, change):
+        user = self.users[0]
+        dn, entry_uuid = self.known(directory, user)
+        if change == 'entry_uuid':
+            entry_uuid = 'something-else'
+        else:
+            # the user no longer matches the search filter
+            directory.add_entry(
+                dn,
+                {'objectClass': ['account'], 'uid': [user['uid']]},
+                password=user['password'],
+            )
+        with patch(
+            'ckanext.ldap.lib.search.find_ldap_user', return_value=None
+        ) as find_ldap_user:
+            result = authenticate_ldap_user(
+                user['uid'], user['password'], known=(dn, entry_uuid)
+            )
+        assert result == (None, False)
+        find_ldap_user.assert_called_once()
+
+
+@pytest.mark.ckan_config('ckanext.ldap.search.filter', 'uid={login}')
+class TestFindLdapUser:
+    def test_concurrent_lookups_share_one_search(self):
+        ldap_user_dict = {'cn': 'cn=beans', 'username': 'beans', 'email': 'b@e.ans'}
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_run(function, default=None):
+            started.set()
+            release.wait(5)
+            return ldap_user_dict
+
+        results = []
+        run = MagicMock(side_effect=slow_run)
+        with patch('ckanext.ldap.lib.search._run', run), patch(
+            'ckanext.ldap.lib.search.get_lookup_cache', return_value=TTLCache(10, 60)
+        ):
+            leader = threading.Thread(
+                target=lambda: results.append(find_ldap_user('beans'))
+            )
+            leader.start()
+            started.wait(5)
+            coalesced = _lookups.coalesced
+            followers = [
+                threading.Thread(target=lambda: results.append(find_ldap_user('Beans')))
+                for _ in range(3)
+            ]
+            for follower in followers:
+                follower.start()
+            for _ in range(500):
+                if _lookups.coalesced == coalesced + 3:
+                    break
+                threading.Event().wait(0.01)
+            release.set()
+            for thread in [leader, *followers]:
+                thread.join()
+
+        assert results == [ldap_user_dict] * 4
+        run.assert_called_once()
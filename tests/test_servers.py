@@ -0,0 +1,219 @@
+import random
+from collections import Counter
+
+import ldap
+import pytest
+from mock import MagicMock, patch
+
+from ckanext.ldap.lib.exceptions import NoServerAvailableError
+from ckanext.ldap.lib.servers import (
+    BIND,
+    SEARCH,
+    CircuitBreaker,
+    Server,
+    ServerSet,
+    get_uris,
+    roles_share_servers,
+)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    clock = Clock()
+    with patch('ckanext.ldap.lib.servers.time.monotonic', clock):
+        yield clock
+
+
+def down(server):
+    raise ldap.SERVER_DOWN()
+
+
+class TestCircuitBreaker:
+    def test_opens_after_threshold(self, clock):
+        breaker = CircuitBreaker(failure_threshold=3, cooldown=30)
+        assert not breaker.record_failure()
+        assert not breaker.record_failure()
+        assert breaker.allow()
+        assert breaker.record_failure()
+        assert breaker.state == CircuitBreaker.OPEN
+        assert not breaker.allow()
+
+    def test_success_resets_failures(self, clock):
+        breaker = CircuitBreaker(failure_threshold=2)
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        assert breaker.state == CircuitBreaker.CLOSED
+
+    def test_half_open_allows_one_probe(self, clock):
+        breaker = CircuitBreaker(failure_threshold=1, cooldown=30)
+        breaker.record_failure()
+        clock.now += 30
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        assert breaker.allow()
+        assert not breaker.allow()
+
+    def test_probe_success_closes(self, clock):
+        breaker = CircuitBreaker(failure_threshold=1, cooldown=30)
+        breaker.record_failure()
+        clock.now += 30
+        breaker.allow()
+        breaker.record_success()
+        assert breaker.state == CircuitBreaker.CLOSED
+        assert breaker.allow()
+
+    def test_probe_failure_reopens(self, clock):
+        breaker = CircuitBreaker(failure_threshold=3, cooldown=30)
+        for _ in range(3):
+            breaker.record_failure()
+        clock.now += 30
+        breaker.allow()
+        assert breaker.record_failure()
+        assert breaker.state == CircuitBreaker.OPEN
+        clock.now += 29
+        assert not breaker.allow()
+
+
+class TestServerSet:
+    def test_uses_first_server(self, clock):
+        servers = ServerSet(['ldap://one', 'ldap://two'])
+        assert servers.call(lambda server: server.uri) == 'ldap://one'
+
+    def test_fails_over(self, clock):
+        servers = ServerSet(['ldap://one', 'ldap://two'])
+        function = MagicMock(
+            side_effect=lambda server: down(server)
+            if server.uri == 'ldap://one'
+            else server.uri
+        )
+        assert servers.call(function) == 'ldap://two'
+        assert servers.servers[0].breaker.failures == 1
+
+    def test_skips_open_servers(self, clock):
+        servers = ServerSet(['ldap://one', 'ldap://two'], failure_threshold=1)
+        servers.record_failure(servers.servers[0])
+        function = MagicMock(side_effect=lambda server: server.uri)
+
+        assert servers.call(function) == 'ldap://two'
+        assert function.call_count == 1
+
+    def test_raises_last_error_when_all_servers_fail(self, clock):
+        servers = ServerSet(['ldap://one', 'ldap://two'])
+        with pytest.raises(ldap.SERVER_DOWN) as e:
+            servers.call(down)
+        assert not isinstance(e.value, NoServerAvailableError)
+
+    def test_fails_fast_when_all_breakers_are_open(self, clock):
+        servers = ServerSet(['ldap://one', 'ldap://two'], failure_threshold=1)
+        with pytest.raises(ldap.SERVER_DOWN):
+            servers.call(down)
+        function = MagicMock()
+
+        with pytest.raises(NoServerAvailableError):
+            servers.call(function)
+        function.assert_not_called()
+
+    def test_other_errors_are_not_failures(self, clock):
+        servers = ServerSet(['ldap://one', 'ldap://two'], failure_threshold=1)
+
+        def invalid(server):
+            raise ldap.INVALID_CREDENTIALS()
+
+        with pytest.raises(ldap.INVALID_CREDENTIALS):
+            servers.call(invalid)
+        assert servers.servers[0].breaker.state == CircuitBreaker.CLOSED
+
+    def test_healthy_servers_are_tried_first(self, clock):
+        servers = ServerSet(
+            ['ldap://one', 'ldap://two'], failure_threshold=1, cooldown=30
+        )
+        servers.record_failure(servers.servers[0])
+        assert servers.call(lambda server: server.uri) == 'ldap://two'
+        clock.now += 30
+        # the healthy server is tried first, so the recovering one isn't probed
+        assert servers.call(lambda server: server.uri) == 'ldap://two'
+
+    def test_record_disconnect(self, clock):
+        servers = ServerSet(['ldap://one', 'ldap://two'], failure_threshold=1)
+        cnx = servers.connect(lambda uri: MagicMock(uri=uri))
+        assert servers.server_for(cnx).uri == 'ldap://one'
+
+        servers.record_disconnect(cnx)
+
+        assert servers.servers[0].breaker.state == CircuitBreaker.OPEN
+        assert servers.connect(lambda uri: MagicMock(uri=uri)).uri == 'ldap://two'
+
+
+class TestBalancedServerSet:
+    def make(self, *latencies):
+        servers = ServerSet(
+            [f'ldap://{i}' for i in range(len(latencies))],
+            balanced=True,
+            rng=random.Random(1),
+        )
+        for server, latency in zip(servers.servers, latencies):
+            server.latency = latency
+        return servers
+
+    def test_prefers_faster_servers(self):
+        servers = self.make(0.001, 0.1)
+        firsts = Counter(servers.ordered()[0].uri for _ in range(1000))
+        assert firsts['ldap://0'] > 900
+        assert firsts['ldap://1'] > 0
+
+    def test_unmeasured_servers_are_tried(self):
+        servers = self.make(0.001, None)
+        firsts = Counter(servers.ordered()[0].uri for _ in range(1000))
+        assert 300 < firsts['ldap://1'] < 700
+
+    def test_open_servers_come_last(self, clock):
+        servers = self.make(0.001, 0.1)
+        servers.record_failure(servers.servers[0])
+        servers.record_failure(servers.servers[0])
+        servers.record_failure(servers.servers[0])
+        for _ in range(100):
+            assert servers.ordered()[0].uri == 'ldap://1'
+
+    def test_record_latency(self):
+        servers = ServerSet(['ldap://one'])
+        cnx = servers.connect(lambda uri: MagicMock())
+        servers.record_latency(cnx, 0.5)
+        servers.record_latency(cnx, 1.5)
+        # the latency measured by connect is tiny, so only the moving average matters
+        assert 0.3 < servers.servers[0].latency < 0.5
+        # unknown connections are ignored
+        servers.record_latency(MagicMock(), 10)
+
+
+class TestServer:
+    def test_moving_average(self):
+        server = Server('ldap://one', CircuitBreaker())
+        server.observe(1.0)
+        assert server.latency == 1.0
+        server.observe(2.0)
+        assert server.latency == pytest.approx(1.2)
+
+
+@pytest.mark.ckan_config('ckanext.ldap.uri', 'ldap://primary ldap://secondary')
+class TestRoles:
+    def test_defaults_to_uri(self):
+        assert get_uris(SEARCH) == ['ldap://primary', 'ldap://secondary']
+        assert get_uris(BIND) == ['ldap://primary', 'ldap://secondary']
+        assert roles_share_servers()
+
+    @pytest.mark.ckan_config(
+        'ckanext.ldap.search.uri', 'ldap://replica1 ldap://replica2'
+    )
+    @pytest.mark.ckan_config('ckanext.ldap.bind.uri', 'ldap://primary')
+    def test_role_uris(self):
+        assert get_uris(SEARCH) == ['ldap://replica1', 'ldap://replica2']
+        assert get_uris(BIND) == ['ldap://primary']
+        assert not roles_share_servers()
@@ -0,0 +1,115 @@
+import time
+
+import pytest
+from mock import MagicMock, patch
+from redis.exceptions import RedisError
+
+from ckanext.ldap.lib.exceptions import StoreError
+from ckanext.ldap.lib.store import MemoryStore, RedisStore, refill
+
+
+class TestRefill:
+    def test_new_bucket_is_full(self):
+        assert refill(None, None, 100, 5, 1) == (4, 0)
+
+    def test_tokens_accumulate(self):
+        assert refill(0, 100, 102, 5, 1) == (1, 0)
+
+    def test_tokens_are_capped(self):
+        assert refill(0, 100, 200, 5, 1) == (4, 0)
+
+    def test_empty(self):
+        tokens, wait = refill(0.5, 100, 100, 5, 0.5)
+        assert tokens == 0.5
+        assert wait == 1
+
+
+class TestMemoryStore:
+    @pytest.fixture
+    def now(self):
+        now = MagicMock(return_value=1000.0)
+        with patch('ckanext.ldap.lib.store.time.monotonic', now):
+            yield now
+
+    def test_burst_then_limited(self, now):
+        store = MemoryStore()
+        for _ in range(3):
+            assert store.take('beans', 3, 0.5) == 0
+        assert store.take('beans', 3, 0.5) == 2
+        # other keys have their own buckets
+        assert store.take('other', 3, 0.5) == 0
+
+    def test_refills(self, now):
+        store = MemoryStore()
+        for _ in range(3):
+            store.take('beans', 3, 0.5)
+        now.return_value += 2
+        assert store.take('beans', 3, 0.5) == 0
+        assert store.take('beans', 3, 0.5) == 2
+
+    def test_full_buckets_are_forgotten(self, now):
+        store = MemoryStore()
+        store.take('beans', 3, 0.5)
+        assert len(store._buckets) == 1
+        now.return_value += 2
+        store._buckets.get('beans')
+        assert len(store._buckets) == 0
+
+
+class TestRedisStore:
+    def test_take(self):
+        script = MagicMock(return_value=b'1.5')
+        redis = MagicMock(register_script=MagicMock(return_value=script))
+        with patch('ckanext.ldap.lib.store.connect_to_redis', return_value=redis):
+            store = RedisStore()
+            assert store.take('beans', 3, 0.5) == 1.5
+            store.take('beans', 3, 0.5)
+        redis.register_script.assert_called_once()
+        assert script.call_args.kwargs['args'][:2] == [3, 0.5]
+
+    def test_errors(self):
+        redis = MagicMock(register_script=MagicMock(side_effect=RedisError('down')))
+        with patch('ckanext.ldap.lib.store.connect_to_redis', return_value=redis):
+            with pytest.raises(StoreError):
+                RedisStore().take('beans', 3, 0.5)
+
+
+class TestSlots:
+    def test_acquire_and_release(self):
+        store = MemoryStore()
+        assert store.acquire('slots', 'a', 2, 60) == (True, 1)
+        assert store.acquire('slots', 'b', 2, 60) == (True, 2)
+        assert store.acquire('slots', 'c', 2, 60) == (False, 2)
+        assert store.release('slots', 'a') == 1
+        assert store.acquire('slots', 'c', 2, 60) == (True, 2)
+        assert store.count('other') == 0
+
+    def test_leases_expire(self):
+        store = MemoryStore()
+        store.acquire('slots', 'a', 1, 60)
+        with patch(
+            'ckanext.ldap.lib.store.time.monotonic',
+            MagicMock(return_value=time.monotonic() + 61),
+        ):
+            assert store.count('slots') == 0
+            assert store.acquire('slots', 'b', 1, 60) == (True, 1)
+
+
+class TestValues:
+    def test_get_set_delete(self):
+        store = MemoryStore()
+        assert store.get('beans') is None
+        store.set('beans', 'value', 60)
+        assert store.get('beans') == 'value'
+        assert store.delete('beans')
+        assert not store.delete('beans')
+        assert store.get('beans') is None
+
+    def test_values_expire(self):
+        store = MemoryStore()
+        store.set('beans', 'value', 60)
+        with patch(
+            'ckanext.ldap.lib.cache.time.monotonic',
+            MagicMock(return_value=time.monotonic() + 61),
+        ):
+            assert store.get('beans') is None
@@ -0,0 +1,302 @@
+import json
+
+import pytest
+from ckan.model import Member, Session, User
+from ckan.plugins import toolkit
+from ckan.tests import factories
+from ldap.controls import SimplePagedResultsControl
+from mock import MagicMock, patch
+
+from ckanext.ldap.lib import fake_ldap, groups
+from ckanext.ldap.lib.sync import (
+    GroupResolver,
+    HighWaterMark,
+    MembershipChange,
+    _batched,
+    apply_membership_changes,
+    iter_entries,
+    iter_groups,
+    plan_group_sync,
+    sync_users,
+)
+from ckanext.ldap.model.ldap_user import LdapUser
+from ckanext.ldap.routes._helpers import create_user, get_attributes_digest
+
+PAGED_RESULTS = SimplePagedResultsControl.controlType
+
+
+class TestIterEntries:
+    @pytest.mark.ckan_config('ckanext.ldap.base_dn', 'dc=example,dc=com')
+    def test_follows_the_paging_cookie(self):
+        pages = [
+            ([('cn=a', {}), ('cn=b', {})], b'cookie'),
+            ([('cn=c', {}), (None, ['ldap://referral'])], b''),
+        ]
+        cnx = MagicMock()
+        cnx.result3.side_effect = [
+            (101, data, 1, [MagicMock(controlType=PAGED_RESULTS, cookie=cookie)])
+            for data, cookie in pages
+        ]
+
+        entries = list(iter_entries(cnx, '(uid=*)', ['uid'], page_size=2))
+
+        assert [dn for dn, _ in entries] == ['cn=a', 'cn=b', 'cn=c']
+        assert cnx.search_ext.call_count == 2
+        # the cookie from the first page is sent with the second request
+        second_control = cnx.search_ext.call_args_list[1][1]['serverctrls'][0]
+        assert second_control.cookie == b'cookie'
+
+
+def test_batched():
+    assert list(_batched(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(_batched([], 2)) == []
+
+
+def test_high_water_mark():
+    high_water_mark = HighWaterMark('20240101000000Z')
+    high_water_mark.update({'modifytimestamp': [b'20231231235959Z']})
+    assert high_water_mark.value == '20240101000000Z'
+    high_water_mark.update({'modifyTimestamp': [b'20240102000000Z']})
+    assert high_water_mark.value == '20240102000000Z'
+
+
+def test_high_water_mark_is_held_back():
+    high_water_mark = HighWaterMark('20240101000000Z')
+    for timestamp in ('20240103000000Z', '20240102000000Z', '20240104000000Z'):
+        assert high_water_mark.update({'modifyTimestamp': [timestamp.encode()]}) == (
+            timestamp
+        )
+    assert high_water_mark.safe_value() == '20240104000000Z'
+    # entries which weren't applied are fetched again by the next incremental sync
+    high_water_mark.hold({HighWaterMark.key: '20240103000000Z'})
+    high_water_mark.hold({HighWaterMark.key: '20240102000000Z'})
+    assert high_water_mark.safe_value() == '20240102000000Z'
+    high_water_mark.hold({})
+    assert high_water_mark.safe_value() == '20240101000000Z'
+
+
+class TestGroupResolver:
+    graph = {
+        'cn=a': {'uid=1', 'cn=b'},
+        'cn=b': {'uid=2', 'cn=c'},
+        'cn=c': {'uid=3', 'cn=a'},
+    }
+
+    def test_direct(self):
+        assert GroupResolver(self.graph).members('cn=a') == {'uid=1', 'cn=b'}
+
+    def test_nested_with_cycle(self):
+        resolver = GroupResolver(self.graph, nested=True)
+        everyone = {'uid=1', 'uid=2', 'uid=3', 'cn=a', 'cn=b', 'cn=c'}
+        for group_dn in self.graph:
+            assert resolver.members(group_dn) == everyone
+
+    def test_memoized(self):
+        graph = {'cn=a': {'cn=c'}, 'cn=b': {'cn=c'}, 'cn=c': {'uid=1'}}
+        resolver = GroupResolver(graph, nested=True)
+        resolver.members('cn=a')
+        graph['cn=c'] = set()
+        assert 'uid=1' in resolver.members('cn=b')
+
+
+@pytest.mark.ckan_config('ckanext.ldap.base_dn', 'dc=example,dc=com')
+def test_iter_groups():
+    directory = fake_ldap.FakeDirectory()
+    for i in range(5):
+        directory.add_entry(
+            f'cn=group{i},ou=groups,dc=example,dc=com',
+            {
+                'objectClass': ['groupOfNames'],
+                'member': [f'UID=user{i},dc=example,dc=com'],
+            },
+        )
+    directory.add_entry('uid=user0,dc=example,dc=com', {'objectClass': ['person']})
+    cnx = directory.initialize('ldap://fake')
+
+    groups = dict(iter_groups(cnx, page_size=2))
+
+    assert groups['cn=group3,ou=groups,dc=example,dc=com'] == {
+        'uid=user3,dc=example,dc=com'
+    }
+    assert len(groups) == 5
+    assert directory.counts['search'] == 3
+
+
+CURATORS = 'cn=curators,ou=groups,dc=example,dc=com'
+ADMINS = 'cn=admins,ou=groups,dc=example,dc=com'
+
+
+@pytest.mark.filterwarnings('ignore::sqlalchemy.exc.SADeprecationWarning')
+@pytest.mark.usefixtures('clean_db', 'ensure_db_init')
+class TestSyncUsers:
+    def test_only_changed_users_are_updated(self):
+        ldap_user_dicts = []
+        for uid in ('same', 'moved'):
+            user = factories.User(name=uid, email=f'{uid}@example.com')
+            ldap_user_dict = {
+                'username': uid,
+                'cn': f'uid={uid},ou=people,dc=example,dc=com',
+                'email': f'{uid}@example.com',
+                'fullname': user['fullname'],
+            }
+            Session.add(
+                LdapUser(
+                    user_id=user['id'],
+                    ldap_id=uid,
+                    attributes_digest=get_attributes_digest(ldap_user_dict),
+                )
+            )
+            ldap_user_dicts.append(ldap_user_dict)
+        Session.commit()
+        ldap_user_dicts[1]['email'] = 'moved@example.org'
+
+        stats = sync_users(ldap_user_dicts)
+
+        assert stats == {'unchanged': 1, 'updated': 1}
+        Session.expire_all()
+        assert User.by_name('moved').email == 'moved@example.org'
+        assert LdapUser.by_ldap_id('moved').attributes_digest == get_attributes_digest(
+            ldap_user_dicts[1]
+        )
+
+    @pytest.mark.ckan_config('ckanext.ldap.organization.id', 'ldap-users')
+    @pytest.mark.ckan_config('ckanext.ldap.organization.role', 'editor')
+    def test_new_users_are_created_with_the_actions(self):
+        organization = factories.Organization(name='ldap-users')
+        ldap_user_dict = {
+            'username': 'new',
+            'cn': 'uid=new,ou=people,dc=example,dc=com',
+            'email': 'new@example.com',
+            'fullname': 'New User',
+        }
+
+        with patch('ckanext.ldap.lib.sync.create_user', wraps=create_user) as create:
+            stats = sync_users([ldap_user_dict])
+
+        assert stats == {'created': 1}
+        create.assert_called_once()
+        user = User.by_name('new')
+        assert user.fullname == 'New User'
+        ldap_user = LdapUser.by_ldap_id('new')
+        assert ldap_user.user_id == user.id
+        assert ldap_user.dn == ldap_user_dict['cn']
+        assert groups.get_organization_members(organization['id']) == {
+            user.id: 'editor'
+        }
+
+
+@pytest.mark.filterwarnings('ignore::sqlalchemy.exc.SADeprecationWarning')
+@pytest.mark.usefixtures('clean_db', 'ensure_db_init')
+@pytest.mark.ckan_config(
+    'ckanext.ldap.groups.mapping',
+    json.dumps(
+        {CURATORS: 'collections:editor', ADMINS: ['collections:admin', 'sysadmin']}
+    ),
+)
+@pytest.mark.ckan_config('ckanext.ldap.groups.nested', True)
+class TestSyncGroupMemberships:
+    def make_ldap_user(self, uid, **kwargs):
+        user = factories.User(**kwargs)
+        Session.add(
+            LdapUser(
+                user_id=user['id'],
+                ldap_id=uid,
+                dn=f'uid={uid},ou=people,dc=example,dc=com',
+            )
+        )
+        Session.commit()
+        return user
+
+    def add_member(self, organization, user, capacity):
+        toolkit.get_action('member_create')(
+            {'ignore_auth': True},
+            {
+                'id': organization['id'],
+                'object': user['id'],
+                'object_type': 'user',
+                'capacity': capacity,
+            },
+        )
+
+    @pytest.mark.ckan_config('ckanext.ldap.groups.manage_sysadmin', True)
+    def test_plan_and_apply(self):
+        organization = factories.Organization(name='collections')
+        curator = self.make_ldap_user('curator')
+        admin = self.make_ldap_user('admin')
+        leaver = self.make_ldap_user('leaver', sysadmin=True)
+        local = factories.User()
+        self.add_member(organization, leaver, 'editor')
+        self.add_member(organization, local, 'member')
+        self.add_member(organization, admin, 'editor')
+        graph = {
+            CURATORS: {'uid=curator,ou=people,dc=example,dc=com', ADMINS},
+            ADMINS: {'uid=admin,ou=people,dc=example,dc=com', 'uid=stranger'},
+        }
+
+        stats, changes = plan_group_sync(graph)
+
+        assert stats['added'] == 1
+        assert stats['changed'] == 1
+        assert stats['removed'] == 1
+        assert stats['sysadmin_granted'] == 1
+        assert stats['sysadmin_revoked'] == 1
+        assert stats['unknown_members'] == 1
+        assert apply_membership_changes(changes, batch_size=2)['applied'] == 5
+
+        Session.expire_all()
+        memberships = groups.get_organization_members(organization['id'])
+        assert memberships == {
+            curator['id']: 'editor',
+            admin['id']: 'admin',
+            local['id']: 'member',
+        }
+        assert User.get(admin['id']).sysadmin
+        assert not User.get(leaver['id']).sysadmin
+        _, changes = plan_group_sync(graph)
+        assert changes == []
+
+    def test_sysadmins_are_only_granted_by_default(self):
+        admin = self.make_ldap_user('admin')
+        self.make_ldap_user('leaver', sysadmin=True)
+        graph = {ADMINS: {'uid=admin,ou=people,dc=example,dc=com'}}
+
+        stats, changes = plan_group_sync(graph)
+
+        assert stats['sysadmin_granted'] == 1
+        assert stats['sysadmin_revoked'] == 0
+        assert changes == [
+            MembershipChange(groups.SYSADMIN, admin['id'], None, groups.SYSADMIN)
+        ]
+
+    def test_old_memberships_are_reactivated(self):
+        organization = factories.Organization(name='collections')
+        curator = self.make_ldap_user('curator')
+        self.add_member(organization, curator, 'member')
+        toolkit.get_action('member_delete')(
+            {'ignore_auth': True},
+            {'id': organization['id'], 'object': curator['id'], 'object_type': 'user'},
+        )
+        graph = {CURATORS: {'uid=curator,ou=people,dc=example,dc=com'}, ADMINS: set()}
+
+        _, changes = plan_group_sync(graph)
+        assert apply_membership_changes(changes)['applied'] == 1
+
+        Session.expire_all()
+        members = (
+            Session.query(Member)
+            .filter(Member.group_id == organization['id'], Member.table_name == 'user')
+            .all()
+        )
+        assert [(m.table_id, m.capacity, m.state) for m in members] == [
+            (curator['id'], 'editor', 'active')
+        ]
+
+    def test_missing_group_removes_nobody(self):
+        organization = factories.Organization(name='collections')
+        user = self.make_ldap_user('curator')
+        self.add_member(organization, user, 'editor')
+
+        stats, changes = plan_group_sync({CURATORS: set()})
+
+        assert stats['missing_groups'] == 1
+        assert changes == []
@@ -0,0 +1,54 @@
+import pytest
+from mock import MagicMock, patch
+
+from ckanext.ldap.lib.exceptions import StoreError
+from ckanext.ldap.lib.store import MemoryStore
+from ckanext.ldap.lib.throttle import check_login_attempt
+
+
+@pytest.fixture
+def store():
+    store = MemoryStore()
+    with patch('ckanext.ldap.lib.throttle.get_store', return_value=store):
+        yield store
+
+
+@pytest.mark.ckan_config('ckanext.ldap.throttle.enabled', True)
+@pytest.mark.ckan_config('ckanext.ldap.throttle.ip.burst', 3)
+@pytest.mark.ckan_config('ckanext.ldap.throttle.ip.per_minute', 60)
+@pytest.mark.ckan_config('ckanext.ldap.throttle.login.burst', 2)
+@pytest.mark.ckan_config('ckanext.ldap.throttle.login.per_minute', 30)
+class TestCheckLoginAttempt:
+    def test_login_limit(self, store):
+        assert check_login_attempt('10.0.0.1', 'beans') is None
+        assert check_login_attempt('10.0.0.2', ' Beans') is None
+        limit, wait = check_login_attempt('10.0.0.3', 'BEANS')
+        assert limit == 'login'
+        assert wait == pytest.approx(2, abs=0.1)
+        assert check_login_attempt('10.0.0.3', 'other') is None
+
+    def test_ip_limit(self, store):
+        for login in ('a', 'b', 'c'):
+            assert check_login_attempt('10.0.0.1', login) is None
+        limit, wait = check_login_attempt('10.0.0.1', 'd')
+        assert limit == 'ip'
+        assert wait == pytest.approx(1, abs=0.1)
+        # the login's attempts aren't used up when the IP is over its limit
+        assert check_login_attempt('10.0.0.2', 'd') is None
+        assert check_login_attempt('10.0.0.2', 'd') is None
+
+    @pytest.mark.ckan_config('ckanext.ldap.throttle.login.burst', 0)
+    def test_disabled_limit(self, store):
+        for _ in range(3):
+            assert check_login_attempt('10.0.0.1', 'beans') is None
+        assert check_login_attempt('10.0.0.1', 'beans')[0] == 'ip'
+
+    @pytest.mark.ckan_config('ckanext.ldap.throttle.enabled', False)
+    def test_disabled(self, store):
+        for _ in range(10):
+            assert check_login_attempt('10.0.0.1', 'beans') is None
+
+    def test_store_errors_allow_attempts(self):
+        store = MagicMock(take=MagicMock(side_effect=StoreError('down')))
+        with patch('ckanext.ldap.lib.throttle.get_store', return_value=store):
+            assert check_login_attempt('10.0.0.1', 'beans') is None